@@ -0,0 +1,102 @@
+"""Moving finished seasons' attempts out of the main db.
+
+Only the running seasons' attempts are hot, but every attempt ever made sits in the same table and
+indexes. Archiving a season moves its raw attempts into a second db file (archive_db in the config),
+which every connection attaches as `archive`, and compacts the main db.
+
+Nothing the bot reads needs the raw rows: attempt counts come from user_problem_state and
+problem_stats, which are rolled up from the season's attempts (wherever they are) when it is archived
+and keep counting anything submitted to its problems afterwards, and scores come from solves and
+rankings. The raw rows stay queryable as archive.attempts.
+
+Archiving takes two transactions, since a transaction across attached dbs isn't atomic in WAL mode:
+roll_up copies the attempts into the archive, then remove_archived deletes only the rows that made it
+there. Either can be run again after a crash. """
+import os
+import sqlite3
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS archive.attempts ('
+    '"id" INTEGER NOT NULL PRIMARY KEY, '
+    '"user_id" INTEGER NOT NULL, '
+    '"potd_id" INTEGER NOT NULL, '
+    '"official" BOOLEAN, '
+    '"submission" INTEGER, '
+    '"submit_time" DATETIME)',
+    'CREATE INDEX IF NOT EXISTS archive.attempts_potd_user ON attempts (potd_id, user_id, official)',
+]
+
+SEASON_PROBLEMS = 'SELECT id from main.problems where season = ?'
+
+
+def create(conn: sqlite3.Connection, path: str):
+    """Create the archive db if it doesn't exist yet, and bring its schema up to date. """
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    try:
+        conn.execute('PRAGMA archive.journal_mode = WAL')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.execute('DETACH DATABASE archive')
+
+
+def attach(conn: sqlite3.Connection, path: str, read_only: bool):
+    """Attach the archive db as `archive`. Read-only connections have to be opened with uri=True. """
+    if read_only:
+        if not os.path.exists(path):
+            # Nothing has been archived from this db yet
+            return
+        path = f'file:{path}?mode=ro'
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+
+
+def roll_up(conn: sqlite3.Connection, season_id: int) -> int:
+    """Recount a finished season's attempt counters from its attempts in both dbs, copy the ones still in
+    the main db into the archive and mark the season archived. Returns how many attempts were copied. """
+    season = conn.execute('SELECT running from seasons where id = ?', (season_id,)).fetchone()
+    if season is None:
+        raise ValueError(f'No season with id {season_id}. ')
+    if season[0]:
+        raise ValueError(f'Season {season_id} is still running. ')
+
+    conn.execute('CREATE TEMP TABLE season_rollup ("potd_id" INTEGER NOT NULL, "user_id" INTEGER NOT NULL, '
+                 '"official" INTEGER NOT NULL, "unofficial" INTEGER NOT NULL, PRIMARY KEY("potd_id", "user_id"))')
+    try:
+        # Rows copied by a previous run that was interrupted are in both dbs, which UNION only counts once
+        conn.execute(f'INSERT INTO season_rollup SELECT potd_id, user_id, sum(official IS 1), sum(official IS 0) '
+                     f'from (SELECT id, potd_id, user_id, official from main.attempts '
+                     f'where potd_id in ({SEASON_PROBLEMS}) UNION SELECT id, potd_id, user_id, official '
+                     f'from archive.attempts where potd_id in ({SEASON_PROBLEMS})) '
+                     f'group by potd_id, user_id', (season_id, season_id))
+        conn.execute('INSERT OR IGNORE INTO user_problem_state (problem_id, user_id) '
+                     'SELECT potd_id, user_id from season_rollup')
+        conn.execute(f'UPDATE user_problem_state SET '
+                     f'official_attempts = coalesce((SELECT official from season_rollup '
+                     f'where potd_id = problem_id and season_rollup.user_id = user_problem_state.user_id), 0), '
+                     f'unofficial_attempts = coalesce((SELECT unofficial from season_rollup '
+                     f'where potd_id = problem_id and season_rollup.user_id = user_problem_state.user_id), 0) '
+                     f'where problem_id in ({SEASON_PROBLEMS})', (season_id,))
+        conn.execute(f'UPDATE problem_stats SET '
+                     f'attempts = coalesce((SELECT sum(official + unofficial) from season_rollup '
+                     f'where potd_id = problem_id), 0), '
+                     f'attempters = (SELECT count(1) from season_rollup where potd_id = problem_id) '
+                     f'where problem_id in ({SEASON_PROBLEMS})', (season_id,))
+    finally:
+        conn.execute('DROP TABLE temp.season_rollup')
+
+    copied = conn.execute(f'INSERT OR IGNORE INTO archive.attempts '
+                          f'(id, user_id, potd_id, official, submission, submit_time) '
+                          f'SELECT id, user_id, potd_id, official, submission, submit_time from main.attempts '
+                          f'where potd_id in ({SEASON_PROBLEMS})', (season_id,)).rowcount
+    conn.execute('UPDATE seasons SET archived = 1 where id = ?', (season_id,))
+    return copied
+
+
+def remove_archived(conn: sqlite3.Connection, season_id: int) -> int:
+    """Delete an archived season's attempts that are safely in the archive from the main db. Returns how
+    many were deleted. """
+    if conn.execute('SELECT archived from seasons where id = ?', (season_id,)).fetchone() != (1,):
+        raise ValueError(f'Season {season_id} has not been archived. ')
+    return conn.execute(f'DELETE FROM main.attempts where potd_id in ({SEASON_PROBLEMS}) '
+                        f'and id in (SELECT id from archive.attempts)', (season_id,)).rowcount
@@ -0,0 +1,6 @@
+"""Offline benchmarks of the bot's hot paths.
+
+Run `python -m benchmarks.run` from the repository root. Each scale gets a freshly generated
+synthetic season (see benchmarks.synthetic), and the cogs run against fake discord objects (see
+benchmarks.fakes), so no Discord connection or token is needed. Results are written as JSON so that
+runs on different commits can be compared. """
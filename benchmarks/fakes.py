@@ -0,0 +1,279 @@
+"""Lightweight stand-ins for the discord.py objects the cogs use, so they can run offline.
+
+Every call that would be a REST request is counted in FakeBot.rest, and can be given an artificial
+latency. Only the attributes and methods the cogs actually touch are implemented. """
+import asyncio
+import itertools
+import threading
+import time
+from collections import Counter
+
+import discord
+from ruamel import yaml
+
+import database
+import guilds
+import image_posts
+import image_store
+import members
+import metrics
+import problem_cache
+import roles
+
+_ids = itertools.count(1)
+
+
+class CountingDatabase(database.Database):
+    """A Database that counts the SQL statements run on any of its connections, and how long writes waited. """
+
+    def __init__(self, *args, **kwargs):
+        self.statements = 0
+        self.write_waits = []  # Seconds each write waited for the writer
+        self.counter_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _open(self, read_only: bool):
+        super()._open(read_only)
+        self.local.conn.set_trace_callback(self._count)
+
+    def _count(self, statement):
+        with self.counter_lock:
+            self.statements += 1
+
+    async def write(self, fn, *args):
+        if self.remote is not None:
+            # Waits happen in the writer service
+            return await super().write(fn, *args)
+        queued = time.perf_counter()
+
+        def timed(conn, *args):
+            # Time spent waiting for the writer thread to be free
+            with self.counter_lock:
+                self.write_waits.append(time.perf_counter() - queued)
+            return fn(conn, *args)
+
+        return await super().write(timed, *args)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str = None, bot: bool = False):
+        self.id = user_id
+        self.name = name or f'user{user_id}'
+        self.display_name = self.name
+        self.bot = bot
+        self.mention = f'<@{user_id}>'
+
+
+class FakeMember(FakeUser):
+    def __init__(self, fake_bot, guild, user_id: int, name: str = None):
+        super().__init__(user_id, name)
+        self.fake_bot = fake_bot
+        self.guild = guild
+        self.roles = []
+
+    async def add_roles(self, *roles, reason=None):
+        await self.fake_bot.rest_call('add_roles')
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        await self.fake_bot.rest_call('remove_roles')
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class FakeRole:
+    def __init__(self, guild, role_id: int, name: str):
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+
+    @property
+    def members(self):
+        return [member for member in self.guild.members.values() if self in member.roles]
+
+
+class FakeMessage:
+    def __init__(self, fake_bot, channel, content: str = '', author=None, embed=None, files=None):
+        self.fake_bot = fake_bot
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.author = author
+        self.embed = embed
+        self.attachments = [FakeAttachment(i) for i, _ in enumerate(files or [])]
+
+    async def edit(self, content=None, embed=None):
+        await self.fake_bot.rest_call('edit_message')
+        self.content = content if content is not None else self.content
+        self.embed = embed if embed is not None else self.embed
+
+    async def delete(self):
+        await self.fake_bot.rest_call('delete_message')
+
+
+class FakeAttachment:
+    def __init__(self, index: int):
+        self.url = f'https://cdn.example.com/attachments/{next(_ids)}/{index}.png'
+
+
+class FakeChannel:
+    def __init__(self, fake_bot, channel_id: int = None, guild=None, keep: int = 100):
+        """Keeps the last keep messages sent, so that long runs don't hold on to every reply. """
+        self.fake_bot = fake_bot
+        self.id = channel_id or next(_ids)
+        self.guild = guild
+        self.keep = keep
+        self.sent = []
+        self.messages = {}
+
+    async def send(self, content=None, *, embed=None, files=None, file=None):
+        await self.fake_bot.rest_call('send_message')
+        message = FakeMessage(self.fake_bot, self, content or '', self.fake_bot.user, embed,
+                              files or ([file] if file else None))
+        self.sent.append(message)
+        self.messages[message.id] = message
+        if len(self.sent) > self.keep:
+            self.messages.pop(self.sent.pop(0).id, None)
+        return message
+
+    async def fetch_message(self, message_id: int):
+        await self.fake_bot.rest_call('fetch_message')
+        if message_id in self.messages:
+            return self.messages[message_id]
+        return FakeMessage(self.fake_bot, self)
+
+
+class FakeGuild:
+    def __init__(self, fake_bot, guild_id: int = None, name: str = 'Benchmark'):
+        self.fake_bot = fake_bot
+        self.id = guild_id or next(_ids)
+        self.name = name
+        self.members = {}
+        self.roles = {}
+
+    @property
+    def member_count(self):
+        return len(self.members)
+
+    def add_member(self, user_id: int, name: str = None) -> FakeMember:
+        self.members[user_id] = FakeMember(self.fake_bot, self, user_id, name)
+        return self.members[user_id]
+
+    def add_role(self, name: str) -> FakeRole:
+        role = FakeRole(self, next(_ids), name)
+        self.roles[role.id] = role
+        return role
+
+    def get_member(self, user_id: int):
+        return self.members.get(user_id)
+
+    def get_role(self, role_id: int):
+        return self.roles.get(role_id)
+
+    async def fetch_member(self, user_id: int):
+        await self.fake_bot.rest_call('fetch_member')
+        if user_id not in self.members:
+            raise discord.NotFound(FakeResponse(404), 'Unknown Member')
+        return self.members[user_id]
+
+    async def query_members(self, user_ids, limit: int = 5):
+        # A gateway request rather than REST, but count it alongside
+        await self.fake_bot.rest_call('query_members')
+        return [self.members[user_id] for user_id in user_ids if user_id in self.members][:limit]
+
+
+class FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = ''
+
+
+class FakeContext:
+    def __init__(self, fake_bot, author, channel, content: str = ''):
+        self.bot = fake_bot
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.message = FakeMessage(fake_bot, channel, content, author)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class FakeBot:
+    """Enough of openpotd.OpenPOTD for the cogs to run, backed by a real db. """
+
+    def __init__(self, db_path: str, config_overrides: dict = None, rest_latency: float = 0,
+                 config_file: str = 'config/config.yml', writer_socket: str = None, headless: bool = False):
+        """Pass writer_socket to write through the writer service listening there, like a shard process. """
+        with open(config_file) as f:
+            self.config = yaml.safe_load(f)
+        self.config.update(config_overrides or {})
+        self.loop = asyncio.get_event_loop()
+        self.rest = Counter()
+        self.rest_latency = rest_latency
+
+        self.user = FakeUser(next(_ids), 'OpenPOTD', bot=True)
+        self.guild = FakeGuild(self)
+        self.guilds = [self.guild]
+        self.potd_channel = FakeChannel(self, self.config['potd_channel'] or None, self.guild)
+        self.config['potd_channel'] = self.potd_channel.id
+        self.channels = {self.potd_channel.id: self.potd_channel}
+        self.solved_role = self.guild.add_role('Solved')
+        self.config['solved_role_id'] = self.solved_role.id
+
+        self.low_memory = self.config.get('low_memory_members', False)
+        self.headless = headless
+        self.metrics = metrics.Metrics()
+        self.db = CountingDatabase(db_path, readers=self.config.get('db_readers', 4),
+                                   mmap_size=self.config.get('db_mmap_size', 256 * 1024 * 1024),
+                                   cache_size=self.config.get('db_cache_size', 16 * 1024), metrics=self.metrics,
+                                   writer_socket=writer_socket)
+        self.guild_config = guilds.GuildConfig(self.config)
+        self.current_problems = problem_cache.CurrentProblems()
+        self.images = image_store.ImageStore(self.config.get('image_dir', 'data/images'))
+        self.image_posts = image_posts.ImagePoster(self)
+        self.roles = roles.RoleFanout(concurrency=self.config.get('role_concurrency', 5),
+                                      rate=self.config.get('role_rate', 5))
+        self.role_index = roles.RoleIndex(self, self.guild_config.role_ids())
+        self.role_index.build()
+        self.members = members.MemberCache(size=self.config.get('member_cache_size', 1000),
+                                           ttl=self.config.get('member_cache_ttl', 600))
+        self.cogs = {}
+
+    async def rest_call(self, route: str):
+        self.rest[route] += 1
+        if self.rest_latency:
+            await asyncio.sleep(self.rest_latency)
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+
+    def get_cog(self, name: str):
+        return self.cogs.get(name)
+
+    def get_guild(self, guild_id: int):
+        return self.guild if guild_id == self.guild.id else None
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id: int):
+        await self.rest_call('fetch_channel')
+        return self.channels[channel_id]
+
+    def get_user(self, user_id: int):
+        return self.guild.get_member(user_id)
+
+    def dm_channel(self, user) -> FakeChannel:
+        """A DM channel with user. Not kept, since there would be one per user. """
+        return FakeChannel(self, keep=1)
+
+    def dm(self, user, content: str) -> FakeMessage:
+        return FakeMessage(self, self.dm_channel(user), content, user)
+
+    def close(self):
+        for cog in self.cogs.values():
+            if hasattr(cog, 'cog_unload'):
+                cog.cog_unload()
+        self.db.close()
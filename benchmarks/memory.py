@@ -0,0 +1,113 @@
+"""Compare time to ready and memory use with and without low_memory_members.
+
+    python -m benchmarks.memory --runs 3 --output memory.json
+
+Unlike the other benchmarks this one connects to Discord, since what it measures is the member cache
+the gateway fills. It starts openpotd.py once per run and mode, alternating between the modes, with
+your config/config.yml and token but low_memory_members set for that run. Each run happens in a
+scratch directory with an empty db and no cogs loaded, so nothing is posted or written to data/. A
+run ends as soon as the bot logs that it is ready, with its time to ready and peak RSS. """
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from ruamel import yaml
+
+from benchmarks import run
+
+READY = re.compile(r'Ready in ([\d.]+)s \((.*) member cache\), peak RSS ([\d.]+) MiB')
+MODES = {'full': False, 'low memory': True}
+
+
+def scratch_directory(low_memory: bool) -> str:
+    """A directory to run the bot from, with a copy of config/ set to the given mode and an empty db. """
+    work = tempfile.mkdtemp(prefix='openpotd-memory-')
+    shutil.copytree(os.path.join(run.REPO, 'config'), os.path.join(work, 'config'))
+    config_path = os.path.join(work, 'config', 'config.yml')
+    with open(config_path) as f:
+        config = yaml.safe_load(f)
+    config['low_memory_members'] = low_memory
+    # Cogs load after the bot is ready, so they don't change the measurement, and without them nothing is posted
+    config['cogs'] = []
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+    os.makedirs(os.path.join(work, 'data'))
+    conn = sqlite3.connect(os.path.join(work, 'data', 'data.db'))
+    with open(os.path.join(run.REPO, 'schema.sql')) as f:
+        conn.executescript(f.read())
+    conn.close()
+    return work
+
+
+def measure(low_memory: bool, timeout: float) -> dict:
+    """Start the bot in one mode and return its time to ready and peak RSS. """
+    work = scratch_directory(low_memory)
+    start = time.perf_counter()
+    bot = subprocess.Popen([sys.executable, os.path.join(run.REPO, 'openpotd.py')], cwd=work,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        for line in bot.stderr:
+            match = READY.search(line)
+            if match:
+                return {'ready_seconds': float(match.group(1)), 'peak_rss_mib': float(match.group(3))}
+            if time.perf_counter() - start > timeout:
+                break
+        raise SystemExit(f'The bot did not get ready within {timeout:.0f}s. ')
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def summary(results: list) -> dict:
+    return {key: {'median': statistics.median(result[key] for result in results),
+                  'min': min(result[key] for result in results),
+                  'max': max(result[key] for result in results)}
+            for key in ('ready_seconds', 'peak_rss_mib')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help='runs of each mode')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the bot to get ready')
+    parser.add_argument('--output', default='memory.json')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    if not os.path.exists(os.path.join(run.REPO, 'config', 'config.yml')):
+        raise SystemExit('This needs config/config.yml and a token, see init.sh. ')
+
+    results = {mode: [] for mode in MODES}
+    for i in range(args.runs):
+        # Alternate, so that both modes see the same conditions on Discord's side
+        for mode, low_memory in MODES.items():
+            result = measure(low_memory, args.timeout)
+            results[mode].append(result)
+            print(f'  run {i + 1} {mode:<10} ready in {result["ready_seconds"]:6.1f}s  '
+                  f'peak RSS {result["peak_rss_mib"]:8.1f} MiB')
+
+    report = {'commit': run.commit(), 'timestamp': datetime.now().isoformat(), 'args': vars(args),
+              'modes': {mode: {'runs': runs, **summary(runs)} for mode, runs in results.items()}}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'{"":<12}{"ready (median)":>16}{"peak RSS (median)":>20}')
+    for mode, result in report['modes'].items():
+        print(f'{mode:<12}{result["ready_seconds"]["median"]:>15.1f}s{result["peak_rss_mib"]["median"]:>16.1f} MiB')
+    print(f'Wrote {output}')
+
+
+if __name__ == '__main__':
+    main()
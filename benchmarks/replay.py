@@ -0,0 +1,216 @@
+"""Replay recorded attempts from a real db against an offline bot.
+
+    python -m benchmarks.replay data/data.db --speed 10 --output replay.json
+
+Official attempts are replayed as DMs and unofficial ones as %check commands, at the times they were
+originally submitted, sped up by --speed. By default the replay covers the day after the busiest
+problem was posted. The db is copied first and the replayed attempts and their solves are removed
+from the copy, so the bot sees the same state it had when they came in. The original is never
+modified.
+
+Reports reply latency, how late events were dispatched, event loop lag, how long writes waited for
+the db writer, and the REST calls that were made. """
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from benchmarks import fakes, run
+
+logger = logging.getLogger('replay')
+
+
+def default_window(conn: sqlite3.Connection):
+    """The day starting at the first official attempt at the problem with the most official attempts. """
+    busiest = conn.execute('SELECT potd_id from attempts where official = ? group by potd_id '
+                           'order by count(1) desc limit 1', (True,)).fetchone()
+    if busiest is None:
+        raise SystemExit('There are no official attempts to replay. ')
+    start = conn.execute('SELECT min(submit_time) from attempts where potd_id = ? and official = ?',
+                         (busiest[0], True)).fetchone()[0]
+    start = datetime.fromisoformat(start)
+    return start, start + timedelta(days=1)
+
+
+def prepare(source: str, path: str, start: datetime, end: datetime) -> list:
+    """Copy source to path, take the attempts in [start, end) out of the copy and return them in order. """
+    shutil.copy(source, path)
+    conn = sqlite3.connect(path)
+    attempts = conn.execute('SELECT id, user_id, potd_id, official, submission, submit_time from attempts '
+                            'where submit_time >= ? and submit_time < ? order by submit_time, id',
+                            (str(start), str(end))).fetchall()
+
+    # Solves don't have a time, so take out the ones of anyone who attempted that problem during the replay
+    pairs = {(user_id, potd_id) for _, user_id, potd_id, _, _, _ in attempts}
+    conn.executemany('DELETE FROM solves WHERE user = ? and problem_id = ?', pairs)
+    conn.execute('DELETE FROM attempts WHERE submit_time >= ? and submit_time < ?', (str(start), str(end)))
+    conn.commit()
+    conn.close()
+    return [(datetime.fromisoformat(submit_time), user_id, potd_id, official, submission)
+            for _, user_id, potd_id, official, submission, submit_time in attempts]
+
+
+class Replay:
+    def __init__(self, bot, interface, events: list, speed: float, lag_interval: float = 0.05):
+        self.bot = bot
+        self.interface = interface
+        self.events = events
+        self.speed = speed
+        self.lag_interval = lag_interval
+        self.current_potd = None
+
+        self.latencies = {'dm': [], 'check': []}
+        self.lateness = []
+        self.lags = []
+        self.errors = 0
+
+    async def sample_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    async def post(self, potd_id: int):
+        """Make potd_id the current problem, like the daily post would. """
+
+        def advance(conn):
+            season_id = conn.execute('SELECT season from problems where id = ?', (potd_id,)).fetchone()[0]
+            conn.execute('UPDATE seasons SET latest_potd = ?, running = ? WHERE id = ?', (potd_id, True, season_id))
+            self.bot.current_problems.load(conn, season_id)
+
+        await self.bot.db.write(advance)
+        self.interface.router.invalidate()
+        self.current_potd = potd_id
+
+    async def handle(self, user_id: int, potd_id: int, official: bool, submission: int):
+        member = self.bot.guild.get_member(user_id) or self.bot.guild.add_member(user_id)
+        start = time.perf_counter()
+        try:
+            if official:
+                await self.interface.on_message(self.bot.dm(member, str(submission)))
+                kind = 'dm'
+            else:
+                ctx = fakes.FakeContext(self.bot, member, self.bot.dm_channel(member))
+                await self.interface.check.callback(self.interface, ctx, str(potd_id), submission)
+                kind = 'check'
+        except Exception:
+            self.errors += 1
+            logger.exception(f'Replaying an attempt by {user_id} at potd {potd_id} failed. ')
+            return
+        self.latencies[kind].append(time.perf_counter() - start)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        sampler = loop.create_task(self.sample_lag())
+        tasks = []
+        first = self.events[0][0]
+        started = loop.time()
+        try:
+            for submit_time, user_id, potd_id, official, submission in self.events:
+                if official and potd_id != self.current_potd:
+                    # Let everything sent for the previous problem finish, as the post would have taken a while
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    await self.post(potd_id)
+
+                due = started + (submit_time - first).total_seconds() / self.speed
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                self.lateness.append(max(0.0, loop.time() - due))
+                tasks.append(loop.create_task(self.handle(user_id, potd_id, official, submission)))
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            sampler.cancel()
+        return loop.time() - started
+
+
+async def replay(args, db_path: str, events: list) -> dict:
+    # openpotd reads config/config.yml when it's imported, so this has to wait until we're in the scratch directory
+    import cogs.interface
+
+    bot = fakes.FakeBot(db_path, {'embed_update_interval': args.embed_interval}, rest_latency=args.rest_latency)
+    for user_id in {event[1] for event in events}:
+        bot.guild.add_member(user_id)
+    interface = cogs.interface.Interface(bot)
+    bot.add_cog(interface)
+
+    # Replay any stats message edits too
+    for potd_id in {event[2] for event in events}:
+        interface.embeds.track(potd_id, await bot.potd_channel.send('Stats'))
+    bot.rest.clear()
+
+    session = Replay(bot, interface, events, args.speed)
+    try:
+        duration = await session.run()
+        # Let the last role changes and embed edits go through before counting REST calls
+        await asyncio.sleep(args.settle)
+    finally:
+        bot.close()
+
+    return {
+        'events': len(events),
+        'duration_seconds': duration,
+        'errors': session.errors,
+        'reply_latency': {kind: run.percentiles(latencies) for kind, latencies in session.latencies.items()},
+        'dispatch_lateness': run.percentiles(session.lateness),
+        'loop_lag': run.percentiles(session.lags),
+        'write_wait': run.percentiles(bot.db.write_waits),
+        'sql_statements': bot.db.statements,
+        'rest_calls': dict(bot.rest),
+        'metrics': bot.metrics.snapshot(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('db', help='db to take recorded attempts from, e.g. data/data.db')
+    parser.add_argument('--start', type=datetime.fromisoformat, help='replay attempts submitted from this time on')
+    parser.add_argument('--end', type=datetime.fromisoformat, help='replay attempts submitted before this time')
+    parser.add_argument('--speed', type=float, default=1, help='how many times faster than real time to replay')
+    parser.add_argument('--rest-latency', type=float, default=0.05, help='seconds each fake REST call takes')
+    parser.add_argument('--embed-interval', type=float, default=5, help='embed_update_interval to run with')
+    parser.add_argument('--settle', type=float, default=5, help='seconds to wait for background work at the end')
+    parser.add_argument('--output', default='replay.json')
+    args = parser.parse_args()
+    source, output = os.path.abspath(args.db), os.path.abspath(args.output)
+
+    conn = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+    start, end = default_window(conn)
+    conn.close()
+    start, end = args.start or start, args.end or end
+
+    started_in = os.getcwd()
+    work = run.scratch_directory()
+    os.chdir(work)
+    try:
+        events = prepare(source, os.path.join(work, 'replay.db'), start, end)
+        if not events:
+            raise SystemExit(f'No attempts were submitted between {start} and {end}. ')
+        print(f'Replaying {len(events)} attempts from {start} to {end} at {args.speed}x')
+        result = asyncio.get_event_loop().run_until_complete(replay(args, os.path.join(work, 'replay.db'), events))
+    finally:
+        os.chdir(started_in)
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {'commit': run.commit(), 'timestamp': datetime.now().isoformat(), 'source': source,
+              'start': str(start), 'end': str(end), 'args': vars(args), **result}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    for kind, summary in result['reply_latency'].items():
+        if summary['count']:
+            print(f'{kind:>6} replies: p50 {summary["p50_ms"]:.1f}ms, p95 {summary["p95_ms"]:.1f}ms, '
+                  f'p99 {summary["p99_ms"]:.1f}ms, max {summary["max_ms"]:.1f}ms')
+    if result['loop_lag']['count']:
+        print(f'Loop lag: p99 {result["loop_lag"]["p99_ms"]:.1f}ms, max {result["loop_lag"]["max_ms"]:.1f}ms')
+    print(f'REST calls: {sum(result["rest_calls"].values())} {result["rest_calls"]}')
+    print(f'Wrote {output}')
+
+
+if __name__ == '__main__':
+    main()
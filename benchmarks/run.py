@@ -0,0 +1,230 @@
+"""Benchmark the scoring and submission paths on synthetic seasons of several sizes.
+
+    python -m benchmarks.run --users 1000 10000 100000 --output benchmark.json
+
+Everything runs in a scratch directory with a copy of default_config.yml, so config/ and data/ are
+never touched. Latencies are reported as percentiles in milliseconds, along with the mean number of
+SQL statements and REST calls per operation. """
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import shared
+from benchmarks import fakes, synthetic
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(ordered: list, q: float):
+    """Nearest rank percentile of an already sorted list. """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def percentiles(latencies) -> dict:
+    """Summary of a list of durations in seconds, in milliseconds. """
+    ordered = sorted(latencies)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def summarise(latencies: list, statements: int, rest: int) -> dict:
+    return {**percentiles(latencies), 'sql_per_op': statements / len(latencies), 'rest_per_op': rest / len(latencies)}
+
+
+class Benchmark:
+    def __init__(self, bot, interface, data: dict, seed: int = 0):
+        self.bot = bot
+        self.interface = interface
+        self.data = data
+        self.rng = random.Random(seed)
+        self.results = {}
+
+    async def measure(self, name: str, iterations: int, operation):
+        """Await operation(i) iterations times, one after another. """
+        latencies = []
+        statements, rest = self.bot.db.statements, sum(self.bot.rest.values())
+        for i in range(iterations):
+            start = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - start)
+        self._record(name, latencies, statements, rest)
+
+    async def measure_burst(self, name: str, size: int, operation):
+        """Start operation(i) size times at once, like a burst of answers right after a post. """
+        statements, rest = self.bot.db.statements, sum(self.bot.rest.values())
+
+        async def timed(i):
+            start = time.perf_counter()
+            await operation(i)
+            return time.perf_counter() - start
+
+        latencies = await asyncio.gather(*[timed(i) for i in range(size)])
+        self._record(name, latencies, statements, rest)
+
+    def _record(self, name: str, latencies: list, statements: int, rest: int):
+        self.results[name] = summarise(latencies, self.bot.db.statements - statements,
+                                       sum(self.bot.rest.values()) - rest)
+        result = self.results[name]
+        print(f'  {name:<32} p50 {result["p50_ms"]:9.3f}ms  p95 {result["p95_ms"]:9.3f}ms  '
+              f'p99 {result["p99_ms"]:9.3f}ms  {result["sql_per_op"]:8.1f} sql/op  '
+              f'{result["rest_per_op"]:5.1f} rest/op')
+
+    def random_user(self):
+        return self.bot.guild.members[self.rng.choice(self.data['user_ids'])]
+
+    async def submit(self, i: int):
+        user = self.random_user()
+        potd_id = self.data['problem_ids'][-1]
+        answer = self.data['answers'][potd_id]
+        if self.rng.random() >= 0.1:
+            answer += self.rng.randrange(1, 1000)
+        await self.interface.on_message(self.bot.dm(user, str(answer)))
+
+    async def check(self, i: int):
+        # Any problem but the current one, which doesn't take unofficial answers
+        potd_id = self.rng.choice(self.data['problem_ids'][:-1])
+        user = self.random_user()
+        ctx = fakes.FakeContext(self.bot, user, self.bot.dm_channel(user))
+        await self.interface.check.callback(self.interface, ctx, str(potd_id), self.rng.randrange(1, 10 ** 6))
+
+    async def run(self, iterations: int, burst: int):
+        season_id = self.data['season_id']
+        latest = self.data['problem_ids'][-1]
+        dates = [str(row[0]) for row in await self.bot.db.fetchall('SELECT date from problems')]
+        slow = max(1, iterations // 20)  # For operations that touch the whole season
+
+        await self.measure('update_rankings (season)', slow,
+                           lambda i: self.bot.db.write(self.interface.update_rankings, season_id))
+        await self.measure('update_rankings (problem)', iterations,
+                           lambda i: self.bot.db.write(self.interface.update_rankings, season_id,
+                                                       self.rng.choice(self.data['problem_ids'])))
+        await self.measure('build_embed', iterations, lambda i: self.interface.build_embed(latest, True))
+        await self.measure('id_from_date_or_id (date)', iterations, lambda i: self.bot.db.read(
+            lambda conn: shared.id_from_date_or_id(self.rng.choice(dates), conn, is_public=True)))
+        await self.measure('id_from_date_or_id (id)', iterations, lambda i: self.bot.db.read(
+            lambda conn: shared.id_from_date_or_id(str(self.rng.choice(self.data['problem_ids'])), conn,
+                                                   is_public=True)))
+        await self.measure('on_message', iterations, self.submit)
+        await self.measure_burst('on_message (burst)', burst, self.submit)
+        await self.measure('check', iterations, self.check)
+
+        async def score(i):
+            user = self.random_user()
+            ctx = fakes.FakeContext(self.bot, user, self.bot.dm_channel(user))
+            await self.interface.score.callback(self.interface, ctx)
+
+        async def rank(i):
+            user = self.random_user()
+            ctx = fakes.FakeContext(self.bot, user, self.bot.dm_channel(user))
+            await self.interface.rank.callback(self.interface, ctx, None, 'me')
+
+        await self.measure('score', iterations, score)
+        await self.measure('rank me', iterations, rank)
+        return self.results
+
+
+async def run_scale(users: int, args) -> dict:
+    # openpotd reads config/config.yml when it's imported, so this has to wait until we're in the scratch directory
+    import cogs.interface
+
+    db_path = os.path.abspath(f'bench-{users}.db')
+    start = time.perf_counter()
+    data = synthetic.generate(db_path, users, problems=args.problems, participation=args.participation,
+                              seed=args.seed)
+    generate_seconds = time.perf_counter() - start
+    print(f'{users} users: {data["attempts"]} attempts, {data["solves"]} solves '
+          f'(generated in {generate_seconds:.1f}s)')
+
+    bot = fakes.FakeBot(db_path, {'embed_update_interval': 3600})
+    for user_id in data['user_ids']:
+        bot.guild.add_member(user_id)
+    interface = cogs.interface.Interface(bot)
+    bot.add_cog(interface)
+    try:
+        results = await Benchmark(bot, interface, data, args.seed).run(args.iterations, args.burst)
+    finally:
+        bot.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+    summary = {key: value for key, value in data.items() if key not in ('problem_ids', 'answers', 'user_ids')}
+    return {'data': summary, 'generate_seconds': generate_seconds, 'write_wait': percentiles(bot.db.write_waits),
+            'rest_calls': dict(bot.rest), 'operations': results}
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scratch_directory() -> str:
+    """Make a scratch directory to run the bot from, with its own config, and return it. """
+    work = tempfile.mkdtemp(prefix='openpotd-bench-')
+    os.makedirs(os.path.join(work, 'config'))
+    shutil.copy(os.path.join(REPO, 'default_config.yml'), os.path.join(work, 'config', 'config.yml'))
+    return work
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--problems', type=int, default=30)
+    parser.add_argument('--participation', type=float, default=0.3,
+                        help='chance that a user attempts any given problem')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--burst', type=int, default=500, help='number of simultaneous DM answers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    report = {
+        'commit': commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'args': vars(args),
+        'scales': {},
+    }
+
+    started_in = os.getcwd()
+    work = scratch_directory()
+    os.chdir(work)
+    try:
+        for users in args.users:
+            report['scales'][str(users)] = asyncio.get_event_loop().run_until_complete(run_scale(users, args))
+    finally:
+        os.chdir(started_in)
+        shutil.rmtree(work, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""Run several shard processes against one writer service under simulated load, then check the db.
+
+    python -m benchmarks.shards --processes 4 --users 4000 --answers 1000 --output shards.json
+
+A synthetic season is generated first. The writer service runs in a process of its own with the
+Interface cog, like writer.py. Every shard process runs its own Interface that writes through the
+service, with its own share of the users DMing answers to the current problem and checking old ones.
+
+Afterwards the db is checked: every answer that was accepted is recorded exactly once, nobody has
+solved a problem twice, the counters kept by triggers agree with the attempts and the stored rankings
+match a full recompute. The run fails if any of these doesn't hold. """
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import time
+from datetime import datetime
+
+from ruamel import yaml
+
+import ranking
+import writer
+from benchmarks import fakes, run, synthetic
+
+
+def run_writer(db_path: str, socket_path: str, ready, results):
+    # openpotd reads config/config.yml when it's imported, so this waits until we're in the scratch directory
+    import cogs.interface
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = fakes.FakeBot(db_path, {'embed_update_interval': 3600}, headless=True)
+    bot.add_cog(cogs.interface.Interface(bot))
+    service = writer.WriterService(bot.db, socket_path)
+    loop.run_until_complete(service.start())
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    ready.set()
+    loop.run_forever()
+
+    results.put({'service': service.metrics(), 'write_wait': run.percentiles(bot.db.write_waits),
+                 'sql_statements': bot.db.statements})
+    bot.close()
+
+
+class Shard:
+    def __init__(self, bot, interface, users: list, data: dict, seed: int):
+        self.bot = bot
+        self.interface = interface
+        self.users = users
+        self.data = data
+        self.rng = random.Random(seed)
+        self.latencies = {'dm': [], 'check': []}
+        self.recorded = 0  # Answers that should have been recorded as attempts
+        self.errors = 0
+
+    async def reply_to(self, user_id: int, send):
+        """Run send(member, channel) and return the bot's reply and how long it took, or None if it failed. """
+        member = self.bot.guild.get_member(user_id)
+        channel = self.bot.dm_channel(member)
+        start = time.perf_counter()
+        try:
+            await send(member, channel)
+        except Exception:
+            self.errors += 1
+            return None
+        return (channel.sent[-1].content if channel.sent else ''), time.perf_counter() - start
+
+    async def answer(self, i: int):
+        user_id = self.rng.choice(self.users)
+        potd_id = self.data['problem_ids'][-1]
+        answer = self.data['answers'][potd_id] + (0 if self.rng.random() < 0.1 else self.rng.randrange(1, 1000))
+
+        async def send(member, channel):
+            await self.interface.on_message(fakes.FakeMessage(self.bot, channel, str(answer), member))
+
+        reply = await self.reply_to(user_id, send)
+        if reply:
+            text, elapsed = reply
+            self.latencies['dm'].append(elapsed)
+            if text.startswith(('Thank you!', 'You did not solve')):
+                self.recorded += 1
+
+    async def check(self, i: int):
+        user_id = self.rng.choice(self.users)
+        potd_id = self.rng.choice(self.data['problem_ids'][:-1])
+
+        async def send(member, channel):
+            ctx = fakes.FakeContext(self.bot, member, channel)
+            await self.interface.check.callback(self.interface, ctx, str(potd_id), self.rng.randrange(1, 10 ** 6))
+
+        reply = await self.reply_to(user_id, send)
+        if reply:
+            text, elapsed = reply
+            self.latencies['check'].append(elapsed)
+            if text.startswith(('Nice job', 'Sorry')):
+                self.recorded += 1
+
+    async def run(self, answers: int, checks: int, concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(operation, i):
+            async with semaphore:
+                await operation(i)
+
+        operations = [self.answer] * answers + [self.check] * checks
+        self.rng.shuffle(operations)
+        await asyncio.gather(*[limited(operation, i) for i, operation in enumerate(operations)])
+
+
+def run_shard(index: int, db_path: str, socket_path: str, users: list, data: dict, args, results):
+    import cogs.interface
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Throttling would turn away most of a load test
+    bot = fakes.FakeBot(db_path, {'embed_update_interval': 3600, 'submission_burst': 0}, writer_socket=socket_path)
+    for user_id in users:
+        bot.guild.add_member(user_id)
+    interface = cogs.interface.Interface(bot)
+    bot.add_cog(interface)
+
+    shard = Shard(bot, interface, users, data, args.seed + index)
+    start = time.perf_counter()
+    loop.run_until_complete(shard.run(args.answers, args.checks, args.concurrency))
+    duration = time.perf_counter() - start
+    bot.close()
+
+    results.put({'shard': index, 'duration_seconds': duration, 'recorded': shard.recorded, 'errors': shard.errors,
+                 'latency': {kind: run.percentiles(latencies) for kind, latencies in shard.latencies.items()}})
+
+
+def count(conn: sqlite3.Connection, sql: str) -> int:
+    return conn.execute(sql).fetchone()[0]
+
+
+def consistency(conn: sqlite3.Connection, season_id: int, base_points: float, attempts_before: int,
+                recorded: int) -> dict:
+    """Problems with the db after the run, as check name -> description. Empty if there are none. """
+    import cogs.interface
+
+    problems = {}
+    attempts = count(conn, 'SELECT count(1) from attempts') - attempts_before
+    if attempts != recorded:
+        problems['attempts'] = f'{attempts} attempts were recorded for {recorded} accepted answers'
+
+    duplicates = count(conn, 'SELECT count(1) from (SELECT 1 from solves group by user, problem_id '
+                             'having count(1) > 1)')
+    if duplicates:
+        problems['solves'] = f'{duplicates} users solved a problem more than once'
+
+    drift = count(conn, 'SELECT count(1) from user_problem_state left join (SELECT potd_id, user_id, '
+                        'sum(official IS 1) as official, sum(official IS 0) as unofficial from attempts '
+                        'group by potd_id, user_id) counted on counted.potd_id = user_problem_state.problem_id '
+                        'and counted.user_id = user_problem_state.user_id '
+                        'where user_problem_state.official_attempts != coalesce(counted.official, 0) '
+                        'or user_problem_state.unofficial_attempts != coalesce(counted.unofficial, 0)')
+    if drift:
+        problems['user_problem_state'] = f'{drift} rows disagree with the attempts'
+
+    drift = count(conn, 'SELECT count(1) from problem_stats where attempts != '
+                        '(SELECT count(1) from attempts where potd_id = problem_stats.problem_id) '
+                        'or official_solves != (SELECT count(1) from solves '
+                        'where problem_id = problem_stats.problem_id and official IS 1)')
+    if drift:
+        problems['problem_stats'] = f'{drift} rows disagree with the attempts and solves'
+
+    recomputed = ranking.SeasonRanking(season_id, base_points, cogs.interface.weighted_score)
+    recomputed.load(conn.cursor())
+    stored = recomputed.stored_ranks
+    wrong = [user for index, (score, user) in enumerate(recomputed.order)
+             if stored.get(user, (None, None))[0] != index + 1
+             or not math.isclose(stored[user][1] or 0, -score, rel_tol=1e-9, abs_tol=1e-9)]
+    if wrong:
+        problems['rankings'] = f'{len(wrong)} users have a stored rank or score that differs from a full recompute'
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4, help='number of shard processes')
+    parser.add_argument('--users', type=int, default=4000)
+    parser.add_argument('--problems', type=int, default=30)
+    parser.add_argument('--answers', type=int, default=1000, help='DM answers sent by each shard')
+    parser.add_argument('--checks', type=int, default=200, help='%%check commands run by each shard')
+    parser.add_argument('--concurrency', type=int, default=50, help='requests in flight in each shard')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='shards.json')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    started_in = os.getcwd()
+    work = run.scratch_directory()
+    os.chdir(work)
+    # Nothing has started a thread yet, so forking is safe and keeps the children's imports cheap
+    context = multiprocessing.get_context('fork')
+    try:
+        db_path, socket_path = os.path.join(work, 'shards.db'), os.path.join(work, 'writer.sock')
+        data = synthetic.generate(db_path, args.users, problems=args.problems, seed=args.seed)
+        conn = sqlite3.connect(db_path)
+        attempts_before = count(conn, 'SELECT count(1) from attempts')
+        conn.close()
+        print(f'{args.users} users, {data["attempts"]} attempts. {args.processes} shard processes, each sending '
+              f'{args.answers} answers and {args.checks} checks')
+
+        ready, writer_results, shard_results = context.Event(), context.Queue(), context.Queue()
+        writer_process = context.Process(target=run_writer, args=(db_path, socket_path, ready, writer_results))
+        writer_process.start()
+        if not ready.wait(60):
+            raise SystemExit('The writer service did not start. ')
+
+        start = time.perf_counter()
+        shards = [context.Process(target=run_shard, args=(index, db_path, socket_path,
+                                                          data['user_ids'][index::args.processes], data, args,
+                                                          shard_results))
+                  for index in range(args.processes)]
+        for shard in shards:
+            shard.start()
+        results = sorted((shard_results.get() for _ in shards), key=lambda result: result['shard'])
+        for shard in shards:
+            shard.join()
+        duration = time.perf_counter() - start
+
+        writer_process.terminate()
+        service = writer_results.get()
+        writer_process.join()
+
+        recorded = sum(result['recorded'] for result in results)
+        conn = sqlite3.connect(db_path)
+        with open('config/config.yml') as f:
+            base_points = yaml.safe_load(f)['base_points']
+        problems = consistency(conn, data['season_id'], base_points, attempts_before, recorded)
+        conn.close()
+    finally:
+        os.chdir(started_in)
+        shutil.rmtree(work, ignore_errors=True)
+
+    requests = args.processes * (args.answers + args.checks)
+    report = {'commit': run.commit(), 'timestamp': datetime.now().isoformat(), 'args': vars(args),
+              'duration_seconds': duration, 'requests_per_second': requests / duration, 'recorded': recorded,
+              'writer': service, 'shards': results, 'consistency': problems}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for result in results:
+        dm = result['latency']['dm']
+        if dm['count']:
+            print(f'  shard {result["shard"]}: {result["duration_seconds"]:.1f}s, DM p50 {dm["p50_ms"]:.1f}ms, '
+                  f'p99 {dm["p99_ms"]:.1f}ms, {result["errors"]} errors')
+    print(f'{requests} requests in {duration:.1f}s ({requests / duration:.0f}/s), {service["service"]["requests"]} '
+          f'writes, write wait p99 {service["write_wait"].get("p99_ms", 0):.1f}ms')
+    print(f'Wrote {output}')
+    if problems or any(result['errors'] for result in results):
+        for check, problem in problems.items():
+            print(f'Inconsistent {check}: {problem}')
+        raise SystemExit(1)
+    print('The db is consistent. ')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Synthetic seasons for benchmarking.
+
+Generates a db with one running season whose problems have been attempted and solved by a
+configurable number of users. Generation is seeded, so the same arguments always give the same db. """
+import os
+import random
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import migrate
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema.sql')
+
+# Ids of generated users start here, so they look like discord ids
+FIRST_USER_ID = 10 ** 17
+
+
+def generate(path: str, users: int, problems: int = 30, participation: float = 0.3, solve_rate: float = 0.5,
+             max_attempts: int = 5, seed: int = 0, schema: str = SCHEMA) -> dict:
+    """Create a db at path and return a summary of what's in it.
+
+    Each user takes part in each problem with probability participation. A participant makes up to
+    max_attempts attempts and gets the last one right with probability solve_rate. The last problem
+    is the current one, and was posted today. """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    with open(schema) as f:
+        conn.executescript(f.read())
+    migrate.migrate(conn)
+
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    conn.executemany('INSERT INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)',
+                     ((user_id, f'user{i}', True) for i, user_id in enumerate(user_ids)))
+
+    season_id = conn.execute('INSERT INTO seasons (running, name) VALUES (?, ?)', (True, 'Benchmark')).lastrowid
+    first_day = date.today() - timedelta(days=problems - 1)
+    problem_ids, answers = [], {}
+    for day in range(problems):
+        answer = rng.randrange(1, 10 ** 6)
+        problem_id = conn.execute('INSERT INTO problems (date, season, statement, difficulty, answer, public) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)',
+                                  (str(first_day + timedelta(days=day)), season_id, f'Problem {day + 1}',
+                                   rng.randrange(1, 10), answer, True)).lastrowid
+        problem_ids.append(problem_id)
+        answers[problem_id] = answer
+    conn.execute('UPDATE seasons SET latest_potd = ? WHERE id = ?', (problem_ids[-1], season_id))
+
+    # Insert one problem at a time so the largest scales don't need every attempt in memory at once
+    num_attempts, num_solves, ranked = 0, 0, set()
+    for day, problem_id in enumerate(problem_ids):
+        posted = datetime.combine(first_day + timedelta(days=day), datetime.min.time())
+        attempts, solves = [], []
+        for user_id in user_ids:
+            if rng.random() >= participation:
+                continue
+            ranked.add(user_id)
+            tries = rng.randrange(1, max_attempts + 1)
+            solved = rng.random() < solve_rate
+            submit_time = posted
+            for attempt in range(tries):
+                correct = solved and attempt == tries - 1
+                submission = answers[problem_id] if correct else answers[problem_id] + rng.randrange(1, 1000)
+                submit_time += timedelta(seconds=rng.expovariate(1 / 600))
+                attempts.append((user_id, problem_id, True, submission, submit_time))
+            if solved:
+                solves.append((user_id, problem_id, tries, True))
+
+        conn.executemany('INSERT INTO attempts (user_id, potd_id, official, submission, submit_time) '
+                         'VALUES (?, ?, ?, ?, ?)', attempts)
+        conn.executemany('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                         solves)
+        num_attempts += len(attempts)
+        num_solves += len(solves)
+
+    conn.executemany('INSERT INTO rankings (season_id, user_id) VALUES (?, ?)',
+                     ((season_id, user_id) for user_id in sorted(ranked)))
+    conn.commit()
+    conn.close()
+
+    return {'users': users, 'problems': problems, 'attempts': num_attempts, 'solves': num_solves,
+            'ranked': len(ranked), 'season_id': season_id, 'problem_ids': problem_ids, 'answers': answers,
+            'user_ids': user_ids}
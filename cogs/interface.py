@@ -1,13 +1,21 @@
-import io
 import logging
+import typing
 from datetime import datetime
 
 import discord
 from discord.ext import commands
 import dpymenus
 
+import embeds
+import guilds
+import ingest
+import leaderboard
 import openpotd
+import ranking
+import roles
 import shared
+import snapshot
+import throttle
 
 
 # Change this if you want a different algorithm
@@ -19,118 +27,183 @@ class Interface(commands.Cog):
     def __init__(self, bot: openpotd.OpenPOTD):
         self.bot = bot
         self.logger = logging.getLogger('interface')
+        self.ranking = ranking.RankingEngine(self.bot.config['base_points'], weighted_score)
+        self.leaderboard = leaderboard.Leaderboard(self.bot.db)
+        self.router = guilds.SeasonRouter(self.bot.db)
+        # One submission queue per community, so that a burst in one doesn't queue up everyone else's answers
+        self.submissions = {}  # server id -> SubmissionQueue
+        self.ingest_tasks = {}  # server id -> task running its queue
+        self.embeds = embeds.EmbedUpdater(self.bot, lambda potd_id: self.build_embed(potd_id, False),
+                                          interval=self.bot.config.get('embed_update_interval', 5))
+        self.embeds_task = self.bot.loop.create_task(self.embeds.run())
+        self.throttle = throttle.Throttle(burst=self.bot.config.get('submission_burst', 10),
+                                          refill=self.bot.config.get('submission_refill', 30))
+        self.bot.metrics.add_source('ingest', self.ingest_metrics)
+        self.bot.metrics.add_source('throttle', self.throttle.metrics)
+
+        # Everything this cog writes, so that it can be written through the writer service
+        self.bot.db.register(self.record_registration, self.update_rankings, self.record_submissions,
+                             self.record_check, self.set_nickname, self.toggle_anonymous)
+        self.bot.db.on_remote_write(self.remote_write)
+        self.bot.metrics.add_source('embeds', lambda: {'edits': self.embeds.edits, 'dirty': len(self.embeds.dirty)})
+
+    def cog_unload(self):
+        for task in self.ingest_tasks.values():
+            task.cancel()
+        self.embeds_task.cancel()
+
+    def queue(self, server_id: int) -> ingest.SubmissionQueue:
+        """The submission queue of a community, started the first time it's needed. """
+        if server_id not in self.submissions:
+            self.submissions[server_id] = ingest.SubmissionQueue(
+                self.bot.db, self.record_submissions, max_size=self.bot.config.get('submission_queue_size', 1000),
+                max_batch=self.bot.config.get('submission_batch_size', 50),
+                max_delay=self.bot.config.get('submission_batch_delay', 0.05))
+            self.ingest_tasks[server_id] = self.bot.loop.create_task(self.submissions[server_id].run())
+        return self.submissions[server_id]
+
+    def ingest_metrics(self) -> dict:
+        """Metrics of all the submission queues together. """
+        totals = {'submissions': 0, 'batches': 0, 'largest_batch': 0, 'max_depth': 0, 'full': 0, 'depth': 0}
+        for queue in self.submissions.values():
+            for key, value in queue.metrics().items():
+                totals[key] = max(totals[key], value) if key in ('largest_batch', 'max_depth') else totals[key] + value
+        totals['queues'] = len(self.submissions)
+        return totals
+
+    def remote_write(self, procedure: str):
+        """Another process wrote something, so drop whatever it might have made stale. """
+        self.leaderboard.invalidate()
+        if procedure not in ('Interface.record_submissions', 'Interface.record_check', 'Interface.set_nickname',
+                             'Interface.toggle_anonymous'):
+            self.leaderboard.invalidate_seasons()
+            self.router.invalidate()
+
+    def record_registration(self, conn, user_id: int, display_name: str, season_id: int) -> bool:
+        """Register a user for a season. Returns False if they already were. """
+        cursor = conn.cursor()
+        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                       (user_id, display_name, True))
+
+        cursor.execute('''SELECT 1 from registrations where season_id = ? and user_id = ?''', (season_id, user_id))
+        if cursor.fetchall():
+            return False
+        cursor.execute('''INSERT into registrations (user_id, season_id) VALUES (?, ?)''', (user_id, season_id))
+        return True
 
     @commands.command()
-    @commands.check(lambda ctx: False)  # This command is disabled since it only applies for multi-server config
     async def register(self, ctx, *, season):
-        cursor = self.bot.db.cursor()
-        cursor.execute('''SELECT id from seasons where name = ? and server_id = ?''', (season, ctx.guild.id))
-        ids = cursor.fetchall()
+        """Sign up for a season of this server, so that your DM answers count towards it. """
+        ids = await self.bot.db.fetchall('''SELECT id from seasons where name = ? and server_id IS ?''',
+                                         (season, self.bot.guild_config.server_id(ctx.guild)))
         if len(ids) == 0:
             await ctx.send('No such season!')
             return
         else:
             season_id = ids[0][0]
-        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (ctx.author.id, ctx.author.display_name, True))
 
-        cursor.execute('''SELECT EXISTS (SELECT 1 from registrations WHERE registrations.user_id = ? 
-                            AND registrations.season_id = ?)''', (ctx.author.id, season_id))
-        existence = cursor.fetchall()[0][0]
-        if existence:
-            await ctx.send("You've already signed up for this season!")
-            return
-        else:
-            cursor.execute('''INSERT into registrations (user_id, season_id) VALUES (?, ?)''',
-                           (ctx.author.id, season_id))
+        if await self.bot.db.write(self.record_registration, ctx.author.id, ctx.author.display_name, season_id):
+            self.router.register(ctx.author.id, season_id)
             await ctx.send(f"Registered you for {season}. ")
-        self.bot.db.commit()
+        else:
+            await ctx.send("You've already signed up for this season!")
 
-    def update_rankings(self, season: int, potd_id: int = -1):
-        cursor = self.bot.db.cursor()
+    def update_rankings(self, conn, season: int, potd_id: int = -1):
+        """Runs on the db writer as part of the caller's transaction. """
+        if snapshot.finalized(conn, season):
+            raise ValueError(f'Season {season} has been finalized, its rankings can no longer change. ')
+        cursor = conn.cursor()
 
-        # Get all solves this season
-        cursor.execute('select solves.user, solves.problem_id, solves.num_attempts from problems left join solves '
-                       'where problems.season = ? and problems.id = solves.problem_id and official = ?', (season, True))
-        solves = cursor.fetchall()
+        # Log stuff
+        self.logger.info('Updating rankings')
 
-        # Get weighted attempts for each problem
-        weighted_attempts = {}
-        for solve in solves:
-            if solve[1] in weighted_attempts:
-                weighted_attempts[solve[1]] += weighted_score(solve[2])
+        try:
+            if potd_id == -1:
+                # Then we shall reload the whole season
+                self.ranking.invalidate(season)
+                season_ranking = self.ranking.season(cursor, season)
             else:
-                weighted_attempts[solve[1]] = weighted_score(solve[2])
+                # Only rescore the specified potd and its solvers
+                season_ranking = self.ranking.season(cursor, season)
+                season_ranking.refresh_problem(cursor, potd_id)
 
-        # Calculate how many points each problem should be worth on the 1st attempt
-        problem_points = {i: self.bot.config['base_points'] / weighted_attempts[i] for i in weighted_attempts}
+            # Write back only the rows that changed
+            season_ranking.flush(cursor)
+        except Exception:
+            # The transaction will be rolled back, so the in-memory rankings can't be trusted either
+            self.ranking.invalidate(season)
+            raise
 
-        # Get all ranked people
-        cursor.execute('select user_id from rankings where season_id = ?', (season,))
-        ranked_users = cursor.fetchall()
+    def refresh(self, potd_id: int):
+        # The rankings were already updated along with the submission, so just update the embed showing stats
+        self.embeds.mark_dirty(potd_id)
 
-        # Calculate scores of each person
-        total_score = {user[0]: 0 for user in ranked_users}
-        for solve in solves:
-            total_score[solve[0]] += problem_points[solve[1]] * weighted_score(solve[2])
+    def record_submission(self, conn, user_id: int, display_name: str, answer: int, season_id: int):
+        """Record a DM submission against the season's current potd. Runs on the db writer.
 
-        # Log stuff
-        self.logger.info('Updating rankings')
+        Returns (status, potd_id, season_id, num_attempts) where status is one of 'no_potd', 'already_solved',
+        'correct' or 'incorrect'. """
+        cursor = conn.cursor()
 
-        if potd_id == -1:
-            # Then we shall update all the potds
-            cursor.executemany('UPDATE problems SET weighted_solves = ?, base_points = ? WHERE problems.id = ?',
-                               [(weighted_attempts[i], problem_points[i], i) for i in weighted_attempts])
-        else:
-            # Only update the specified potd
-            if potd_id in weighted_attempts:
-                cursor.execute('UPDATE problems SET weighted_solves = ?, base_points = ? WHERE problems.id = ?',
-                               (weighted_attempts[potd_id], problem_points[potd_id], potd_id))
-            else:
-                self.logger.error(f'No potd with id {potd_id} present. Cannot refresh stats [update_rankings]')
-
-        # Prepare data to be put into the db
-        total_score_list = [(i, total_score[i]) for i in total_score]
-        total_score_list.sort(key=lambda x: -x[1])
-        cursor.executemany('update rankings SET rank = ?, score = ? WHERE user_id = ? and season_id = ?',
-                           [(i + 1, total_score_list[i][1], total_score_list[i][0], season) for i in
-                            range(len(total_score_list))])
-
-        # Commit
-        self.bot.db.commit()
-
-    async def update_embed(self, potd_id: int):
-        # Find the message ID in the database
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT stats_message_id from problems where problems.id = ?', (potd_id,))
-        result = cursor.fetchall()
-        if len(result) == 0:
-            self.logger.error(f'No problem with id {potd_id}. Failed to refresh. ')
-            return
-        message_id = result[0][0]
-        if message_id is None:
-            self.logger.warning(f'No stats message registered for potd {potd_id}. ')
-            return
+        # Get the current answer from the cache
+        problem = self.bot.current_problems.get(conn, season_id)
 
-        # Find the correct channel
-        channel = self.bot.get_channel(self.bot.config['potd_channel'])
-        if channel is None:
-            self.logger.error(f'Could not find potd_channel {self.bot.config["potd_channel"]}')
-            return
-        message = await channel.fetch_message(message_id)
+        # Make sure the user is registered
+        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                       (user_id, display_name, True))
+
+        if problem is None:
+            return 'no_potd', None, None, None
+        potd_id = problem.potd_id
 
-        # Construct the new embed
-        new_embed = self.build_embed(potd_id, False)
+        # Put a ranking entry in for them
+        cursor.execute('INSERT or IGNORE into rankings (season_id, user_id) VALUES (?, ?)', (season_id, user_id))
+        self.ranking.season(cursor, season_id).add_user(user_id)
 
-        # Update the message
-        await message.edit(embed=new_embed)
+        # Check that they have not already solved this problem
+        if user_id in problem.solved:
+            return 'already_solved', potd_id, season_id, None
 
-    def refresh(self, season: int, potd_id: int):
-        # Update the rankings in the db
-        self.update_rankings(season, potd_id)
+        # We got to record the submission anyway even if it is right or wrong
+        try:
+            cursor.execute('INSERT into attempts (user_id, potd_id, official, submission, submit_time) '
+                           'VALUES (?, ?, ?, ?, ?)', (user_id, potd_id, True, answer, datetime.utcnow()))
+        except OverflowError:
+            cursor.execute('INSERT into attempts (user_id, potd_id, official, submission, submit_time) '
+                           'VALUES (?, ?, ?, ?, ?)', (user_id, potd_id, True, -1000, datetime.utcnow()))
+        num_attempts = problem.record_attempt(user_id)
+
+        if answer == problem.answer:  # Then the answer is correct. Let's give them points.
+            cursor.execute('INSERT into solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                           (user_id, potd_id, num_attempts, True))
+            problem.record_solve(user_id)
+            status = 'correct'
+        else:
+            status = 'incorrect'
 
-        # Update the embed showing stats
-        self.bot.loop.create_task(self.update_embed(potd_id))
+        return status, potd_id, season_id, num_attempts
+
+    def record_submissions(self, conn, submissions: list):
+        """Record a batch of DM submissions in order, as one transaction on the db writer. """
+        try:
+            ingest.begin(conn)
+            results = [ingest.isolated(conn, self.record_submission, *submission) for submission in submissions]
+
+            # Recalculate the scoreboard once per problem. Do this even for wrong answers since the user might
+            # have just been ranked.
+            touched = {(result[2], result[1]) for result in results
+                       if not isinstance(result, Exception) and result[0] in ('correct', 'incorrect')}
+            for season_id, potd_id in touched:
+                self.update_rankings(conn, season_id, potd_id)
+        except Exception:
+            # Everything is rolled back, so reload the current problems from the db next time
+            self.bot.current_problems.invalidate()
+            raise
+
+        if any(isinstance(result, Exception) for result in results):
+            # Some submissions were rolled back after they were counted
+            self.bot.current_problems.invalidate()
+        return results
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -138,200 +211,215 @@ class Interface(commands.Cog):
                 or message.content[0] == self.bot.config['prefix']:  # you can't submit answers in a server
             return
 
+        with self.bot.metrics.timer('dm submission'):
+            await self.handle_submission(message, message.content)
+
+    async def throttled(self, channel, user_id: int, potd_id, kind: str) -> bool:
+        """Take a token for this submission, or count it and (the first time) tell them to slow down. """
+        if self.throttle.allow(user_id, potd_id):
+            return False
+        self.bot.metrics.count(f'throttled {kind}')
+        if self.throttle.warn(user_id, potd_id):
+            await channel.send(f'You are submitting answers too quickly! '
+                               f'Please wait {self.throttle.retry_after(user_id, potd_id):.0f} seconds. ')
+        return True
+
+    async def handle_submission(self, message: discord.Message, content: str, season_id: int = None):
+        """Check an answer to the current potd of season_id, or of the season the user's DMs go to. """
+        # Apart from the router being loaded the first time, routing is in memory, so throttle right after it and
+        # before any reply or the queue. The bucket is the current problem's as the router last loaded it. Answers
+        # that could be for several seasons, and so are turned away below, share one bucket per user.
+        seasons = await self.router.route(message.author.id)
+        if season_id is None:
+            throttle_season = seasons[0] if len(seasons) == 1 else None
+        else:
+            throttle_season = season_id if season_id in seasons else None
+        if await self.throttled(message.channel, message.author.id, self.router.current_potd(throttle_season), 'dm'):
+            return
+
+        if season_id is None:
+            if len(seasons) > 1:
+                await message.channel.send(
+                    f'You are taking part in more than one season: {self.router.describe(seasons)}. Please send '
+                    f'`{self.bot.config["prefix"]}submit <season id> <answer>` instead. ')
+                return
+            season_id = seasons[0] if seasons else None
+        elif season_id not in seasons:
+            await message.channel.send(f'You are not taking part in a running season with id {season_id}. ')
+            return
+
+        if season_id is None:
+            await self.no_season(message.channel)
+            return
+        server_id = self.router.server_of(season_id)
+
         # Validating int-ness
-        s = message.content
+        s = content
         if not (s[1:].isdecimal() if s[0] in ('-', '+') else s.isdecimal()):
             await message.channel.send('Please provide an integer answer! ')
             return
         else:
             answer = int(s)
 
-        # Get the current answer from the database
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT answer, problems.id, seasons.id from seasons left join problems '
-                       'where seasons.running = ? and problems.id = seasons.latest_potd', (True,))
-        correct_answer_list = cursor.fetchall()
-
-        # Make sure the user is registered
-        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (message.author.id, message.author.display_name, True))
-        self.bot.db.commit()
+        status, potd_id, season_id, num_attempts = await self.queue(server_id).submit(
+            message.author.id, message.author.display_name, answer, season_id)
+        if status in ('correct', 'incorrect'):
+            self.leaderboard.invalidate(season_id)
 
-        if len(correct_answer_list) == 0:
+        if status == 'no_potd':
             await message.channel.send(
                 f'There is no current {self.bot.config["otd_prefix"]}OTD to check answers against. ')
-            return
-        else:
-            correct_answer, potd_id, season_id = correct_answer_list[0][0], correct_answer_list[0][1], \
-                                                 correct_answer_list[0][2]
-
-            # Put a ranking entry in for them
-            cursor.execute('INSERT or IGNORE into rankings (season_id, user_id) VALUES (?, ?)',
-                           (season_id, message.author.id,))
-            self.bot.db.commit()
-
-            # Check that they have not already solved this problem
-            cursor.execute('SELECT exists (select 1 from solves where problem_id = ? and solves.user = ?)',
-                           (potd_id, message.author.id))
-            if cursor.fetchall()[0][0]:
-                await message.channel.send(f'You have already solved this {self.bot.config["otd_prefix"].lower()}otd! ')
-                return
-
-            # We got to record the submission anyway even if it is right or wrong
-            try:
-                cursor.execute('INSERT into attempts (user_id, potd_id, official, submission, submit_time) '
-                               'VALUES (?, ?, ?, ?, ?)',
-                               (message.author.id, potd_id, True, int(message.content), datetime.utcnow()))
-                self.bot.db.commit()
-            except OverflowError:
-                cursor.execute('INSERT into attempts (user_id, potd_id, official, submission, submit_time '
-                               'VALUES (?, ?, ?, ?, ?)',
-                               (message.author.id, potd_id, True, -1000, datetime.utcnow()))
-                self.bot.db.commit()
-
-            # Calculate the number of attempts
-            cursor.execute('SELECT count(1) from attempts where attempts.potd_id = ? and attempts.user_id = ?',
-                           (potd_id, message.author.id))
-            num_attempts = cursor.fetchall()[0][0]
-
-            if answer == correct_answer:  # Then the answer is correct. Let's give them points.
-                # Insert data
-                cursor.execute('INSERT into solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
-                               (message.author.id, potd_id, num_attempts, True))
-                self.bot.db.commit()
-
-                # Recalculate scoreboard
-                self.refresh(season_id, potd_id)
-
-                # Alert user that they got the question correct
-                await message.channel.send(f'Thank you! You solved the problem after {num_attempts} attempts. ')
-
-                # Give them the "solved" role
-                role_id = self.bot.config['solved_role_id']
-                if role_id is not None:
-                    for guild in self.bot.guilds:
-                        if guild.get_role(role_id) is not None:
-                            member = guild.get_member(message.author.id)
-                            if member is not None:
-                                await member.add_roles(guild.get_role(role_id),
-                                                       reason=f'Solved {self.bot.config["otd_prefix"].lower()}otd')
-                            else:
-                                self.logger.warning(
-                                    f'User {message.author.id} solved the {self.bot.config["otd_prefix"]}OTD despite not being '
-                                    f'in the server. ')
-                            break
-                    else:
-                        self.logger.error('No guild found with a role matching the id set in solved_role_id!')
+        elif status == 'already_solved':
+            await message.channel.send(f'You have already solved this {self.bot.config["otd_prefix"].lower()}otd! ')
+        elif status == 'correct':
+            # Update the stats embed
+            self.refresh(potd_id)
+
+            # Alert user that they got the question correct
+            await message.channel.send(f'Thank you! You solved the problem after {num_attempts} attempts. ')
+
+            # Give them the "solved" role of the season's community. A missing role was reported at startup.
+            role_id = self.bot.guild_config.get(server_id, 'solved_role_id')
+            role = self.bot.role_index.get(role_id)
+            if role is None and role_id is not None and server_id is not None and self.bot.db.remote is not None \
+                    and self.bot.get_guild(server_id) is None:
+                # The guild is on another process's shards
+                self.bot.roles.apply([roles.RemoteMember(self.bot.http, server_id, message.author.id)],
+                                     roles.RemoteRole(role_id, server_id), add=True,
+                                     reason=f'Solved {self.bot.config["otd_prefix"].lower()}otd')
+            elif role is not None:
+                member = await self.bot.members.get(role.guild, message.author.id)
+                if member is not None:
+                    self.bot.roles.apply([member], role, add=True,
+                                         reason=f'Solved {self.bot.config["otd_prefix"].lower()}otd')
                 else:
-                    self.logger.warning('Config variable solved_role_id is not set!')
+                    self.logger.warning(
+                        f'User {message.author.id} solved the {self.bot.config["otd_prefix"]}OTD despite not being '
+                        f'in the server. ')
 
-                # Logged that they solved it
-                self.logger.info(
-                    f'User {message.author.id} just solved {self.bot.config["otd_prefix"].lower()}otd {potd_id}. ')
+            # Logged that they solved it
+            self.logger.info(
+                f'User {message.author.id} just solved {self.bot.config["otd_prefix"].lower()}otd {potd_id}. ')
 
-            else:
-                # They got it wrong
-                await message.channel.send(f'You did not solve this problem! Number of attempts: `{num_attempts}`. ')
+        else:
+            # They got it wrong
+            await message.channel.send(f'You did not solve this problem! Number of attempts: `{num_attempts}`. ')
 
-                # Recalculate stuff anyway
-                self.refresh(season_id, potd_id)
+            # Update the stats embed anyway
+            self.refresh(potd_id)
 
-                # Log that they didn't solve it
-                self.logger.info(
-                    f'User {message.author.id} submitted incorrect answer {answer} for {self.bot.config["otd_prefix"].lower()}otd {potd_id}. ')
+            # Log that they didn't solve it
+            self.logger.info(
+                f'User {message.author.id} submitted incorrect answer {answer} for {self.bot.config["otd_prefix"].lower()}otd {potd_id}. ')
+
+    async def no_season(self, channel):
+        """Tell someone whose DM answers don't go to any running season why. """
+        if any(server_id is not None for server_id, _ in (self.router.running or {}).values()):
+            await channel.send(f'You are not taking part in any running season. Use '
+                               f'`{self.bot.config["prefix"]}register <season>` in your server to sign up. ')
+        else:
+            await channel.send(f'There is no current {self.bot.config["otd_prefix"]}OTD to check answers against. ')
+
+    @commands.command()
+    async def submit(self, ctx, season: int, answer: str):
+        """Answer the current problem of a season, for when you are taking part in several. """
+        if ctx.guild is not None:
+            # Don't leave answers lying around in public
+            await ctx.message.delete()
+            await ctx.send('Please DM your answers to me. ')
+            return
+        with self.bot.metrics.timer('dm submission'):
+            await self.handle_submission(ctx.message, answer, season)
+
+    async def selected_season(self, ctx, season: int = None):
+        """(id, name) of the given season, or by default of the running season of this server, or in DMs of
+        the season the user's DM answers go to. """
+        if season is None and ctx.guild is None:
+            seasons = await self.router.route(ctx.author.id)
+            if len(seasons) == 1:
+                season = seasons[0]
+        return await self.leaderboard.season(season, self.bot.guild_config.server_id(ctx.guild))
 
     @commands.command()
     async def score(self, ctx, season: int = None):
-        cursor = self.bot.db.cursor()
-        if season is None:
-            cursor.execute('SELECT id, name from seasons where running = ?', (True,))
-            running_seasons = cursor.fetchall()
-            if len(running_seasons) == 0:
+        selected_season = await self.selected_season(ctx, season)
+        if selected_season is None:
+            if season is None:
                 await ctx.send('No current running season. Please specify a season. ')
-                return
             else:
-                season = running_seasons[0][0]
-                szn_name = running_seasons[0][1]
-        else:
-            cursor.execute('SELECT id, name from seasons where id = ?', (season,))
-            selected_seasons = cursor.fetchall()
-            if len(selected_seasons) == 0:
                 await ctx.send(f'No season with id {season}. Please specify a valid season. ')
-                return
-            else:
-                season = selected_seasons[0][0]
-                szn_name = selected_seasons[0][1]
+            return
+        season, szn_name = selected_season
 
-        cursor.execute('SELECT rank, score from rankings where season_id = ? and user_id = ?', (season, ctx.author.id))
-        rank = cursor.fetchall()
-        if len(rank) == 0:
+        rank = await self.leaderboard.user_rank(season, ctx.author.id)
+        if rank is None:
             await ctx.send('You are not ranked in this season!')
         else:
             embed = discord.Embed(title=f'{szn_name} ranking for {ctx.author.name}')
-            if rank[0][0] <= 3:
+            if rank[0] <= 3:
                 colours = [0xc9b037, 0xd7d7d7, 0xad8a56]  # gold, silver, bronze
-                embed.colour = discord.Color(colours[rank[0][0] - 1])
+                embed.colour = discord.Color(colours[rank[0] - 1])
             else:
                 embed.colour = discord.Color(0xffffff)
-            embed.add_field(name='Rank', value=rank[0][0])
-            embed.add_field(name='Score', value=f'{rank[0][1]:.2f}')
+            embed.add_field(name='Rank', value=rank[0])
+            embed.add_field(name='Score', value=f'{rank[1]:.2f}')
+            if len(rank) > 2:
+                # The season is over, so its snapshot also has their solves
+                embed.add_field(name='Solved', value=f'{rank[2]} ({rank[3]} attempts)')
             await ctx.send(embed=embed)
 
     @commands.command()
-    async def rank(self, ctx, season: int = None):
-        cursor = self.bot.db.cursor()
-        if season is None:
-            cursor.execute('SELECT id, name from seasons where running = ?', (True,))
-            running_seasons = cursor.fetchall()
-            if len(running_seasons) == 0:
+    async def rank(self, ctx, season: typing.Optional[int] = None, page: str = None):
+        """Show the rankings. Pass a page number, or `me` for the page you're on, to only show that page. """
+        selected_season = await self.selected_season(ctx, season)
+        if selected_season is None:
+            if season is None:
                 await ctx.send('No current running season. Please specify a season. ')
-                return
             else:
-                season = running_seasons[0][0]
-                szn_name = running_seasons[0][1]
-        else:
-            cursor.execute('SELECT id, name from seasons where id = ?', (season,))
-            selected_seasons = cursor.fetchall()
-            if len(selected_seasons) == 0:
                 await ctx.send(f'No season with id {season}. Please specify a valid season. ')
-                return
+            return
+        season, szn_name = selected_season
+
+        num_pages = await self.leaderboard.page_count(season)
+        if page is not None:
+            if page.lower() == 'me':
+                page_number = await self.leaderboard.page_of(season, ctx.author.id)
+                if page_number is None:
+                    await ctx.send('You are not ranked in this season!')
+                    return
+            elif page.isdecimal() and 1 <= int(page) <= num_pages:
+                page_number = int(page)
             else:
-                season = selected_seasons[0][0]
-                szn_name = selected_seasons[0][1]
-
-        cursor.execute('SELECT rank, score, user_id from rankings where season_id = ? order by rank', (season,))
-        rankings = cursor.fetchall()
+                await ctx.send(f'Please give a page between 1 and {num_pages}, or `me`. ')
+                return
 
-        if len(rankings) <= 20:
-            # If there are less than 20 rankings, we don't need a whole menu (in fact dpymenus will throw us an error)
+            embed = discord.Embed(title=f'{szn_name} rankings - Page {page_number}')
+            embed.description = await self.leaderboard.page(season, page_number)
+            await ctx.send(embed=embed)
+        elif num_pages == 1:
+            # If there is only one page, we don't need a whole menu (in fact dpymenus will throw us an error)
             embed = discord.Embed(title=f'{szn_name} rankings')
-            scores = '\n'.join([f'{rank}. {score:.2f} [<@!{user_id}>]' for (rank, score, user_id) in rankings])
-            embed.description = scores
+            embed.description = await self.leaderboard.page(season, 1)
             await ctx.send(embed=embed)
         else:
             pages = []
-            for i in range(len(rankings) // 20 + 1):
-                page = dpymenus.Page(title=f'{szn_name} rankings - Page {i + 1}')
-                scores = '\n'.join(
-                    [f'{rank}. {score:.2f} [<@!{user_id}>]' for (rank, score, user_id) in rankings[20 * i:20 * i + 20]])
-                page.description = scores
+            for i in range(1, num_pages + 1):
+                page = dpymenus.Page(title=f'{szn_name} rankings - Page {i}')
+                page.description = await self.leaderboard.page(season, i)
                 pages.append(page)
             menu = dpymenus.PaginatedMenu(ctx).set_timeout(60).add_pages(pages).persist_on_close()
             await menu.open()
 
-    def build_embed(self, problem_id, full_stats: bool):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT date, season, difficulty, weighted_solves, base_points from problems where '
-                       'problems.id = ? and problems.public = ?', (problem_id, True))
-        result = cursor.fetchall()
+    async def build_embed(self, problem_id, full_stats: bool):
+        # Solve counts are kept up to date in problem_stats by triggers
+        result = await self.bot.db.fetchall('SELECT date, season, difficulty, weighted_solves, base_points, '
+                                            'official_solves, unofficial_solves from problems '
+                                            'left join problem_stats on problem_stats.problem_id = problems.id '
+                                            'where problems.id = ? and problems.public = ?', (problem_id, True))
         if len(result) == 0:
             raise Exception('No such potd available.')
         potd_information = result[0]
-
-        cursor.execute('SELECT count(1) from solves where problem_id = ? and official = ?', (problem_id, True))
-        official_solves = cursor.fetchall()[0][0]
-        cursor.execute('SELECT count(1) from solves where problem_id = ? and official = ?', (problem_id, False))
-        unofficial_solves = cursor.fetchall()[0][0]
+        official_solves, unofficial_solves = potd_information[5] or 0, potd_information[6] or 0
 
         embed = discord.Embed(title=f'{self.bot.config["otd_prefix"]}oTD {problem_id} Stats')
 
@@ -349,81 +437,84 @@ class Interface(commands.Cog):
     @commands.command()
     async def fetch(self, ctx, date_or_id):
         try:
-            potd_id = shared.id_from_date_or_id(date_or_id, self.bot.db, is_public=True)
+            potd_id = await self.bot.db.read(lambda conn: shared.id_from_date_or_id(date_or_id, conn, is_public=True))
         except Exception as e:
             await ctx.send(e)
             return
 
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT date from problems where id = ?', (potd_id,))
-        potd_date = cursor.fetchall()[0][0]
+        potd_date = (await self.bot.db.fetchone('SELECT date from problems where id = ?', (potd_id,)))[0]
 
         # Display the potd to the user
-        cursor.execute('''SELECT image FROM images WHERE potd_id = ?''', (potd_id,))
-        images = cursor.fetchall()
-        if len(images) == 0:
+        if not await self.bot.image_posts.send(ctx, f'{self.bot.config["otd_prefix"]}OTD {potd_id} of {potd_date}',
+                                               potd_id):
             await ctx.send(f'{self.bot.config["otd_prefix"]}OTD {potd_id} of {potd_date} has no picture attached. ')
-        else:
-            await ctx.send(f'{self.bot.config["otd_prefix"]}OTD {potd_id} of {potd_date}',
-                           file=discord.File(io.BytesIO(images[0][0]),
-                                             filename=f'POTD-{potd_id}-0.png'))
-            for i in range(1, len(images)):
-                await ctx.send(file=discord.File(io.BytesIO(images[i][0]), filename=f'POTD-{potd_id}-{i}.png'))
 
         # Log this stuff
         self.logger.info(
             f'User {ctx.author.id} requested {self.bot.config["otd_prefix"]}OTD with date {potd_date} and number {potd_id}. ')
 
-    @commands.command()
-    async def check(self, ctx, date_or_id, answer: int):
-        # Get the POTD id
-        try:
-            potd_id = shared.id_from_date_or_id(date_or_id, self.bot.db, is_public=True)
-        except Exception as e:
-            await ctx.send(e)
-            return
+    def record_check(self, conn, user_id: int, display_name: str, potd_id: int, answer: int):
+        """Record an unofficial attempt. Runs on the db writer as one transaction.
 
-        cursor = self.bot.db.cursor()
+        Returns (running_season, answer_is_correct, solved_before, official_attempts, unofficial_attempts). If
+        running_season is not None then the problem is part of that running season and nothing was recorded. """
+        cursor = conn.cursor()
 
         # Check that it's not part of a currently running season.
         cursor.execute('SELECT name from seasons where latest_potd = ?', (potd_id,))
         seasons = cursor.fetchall()
         if len(seasons) > 0:
-            await ctx.send(f'This {self.bot.config["otd_prefix"].lower()}otd is part of {seasons[0][0]}. '
-                           f'Please just DM your answer for this {self.bot.config["otd_prefix"]}OTD to me. ')
-            return
+            return seasons[0][0], None, None, None, None
 
         # Get the correct answer
         cursor.execute('SELECT answer from problems where id = ?', (potd_id,))
         correct_answer = cursor.fetchall()[0][0]
         answer_is_correct = correct_answer == answer
 
-        # See whether they've solved it before
-        cursor.execute('SELECT exists (select * from solves where solves.user = ? and solves.problem_id = ?)',
-                       (ctx.author.id, potd_id))
-        solved_before = cursor.fetchall()[0][0]
+        # See whether they've solved it before, and how many attempts they've had so far
+        cursor.execute('SELECT official_attempts, unofficial_attempts, solved from user_problem_state '
+                       'where problem_id = ? and user_id = ?', (potd_id, user_id))
+        state = cursor.fetchall()
+        official_attempts, unofficial_attempts, solved_before = state[0] if state else (0, 0, False)
 
         # Make sure the user is registered
         cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (ctx.author.id, ctx.author.display_name, True))
+                       (user_id, display_name, True))
 
-        # Record an attempt even if they've solved before
+        # Record an attempt even if they've solved before. This also counts it in user_problem_state.
         cursor.execute('INSERT INTO attempts (user_id, potd_id, official, submission, submit_time) VALUES (?,?,?,?,?)',
-                       (ctx.author.id, potd_id, False, answer, datetime.now()))
+                       (user_id, potd_id, False, answer, datetime.now()))
+        unofficial_attempts += 1
 
-        # Get the number of both official and unofficial attempts
-        cursor.execute('SELECT COUNT(1) from attempts WHERE user_id = ? and potd_id = ? and official = ?',
-                       (ctx.author.id, potd_id, True))
-        official_attempts = cursor.fetchall()[0][0]
-        cursor.execute('SELECT COUNT(1) from attempts WHERE user_id = ? and potd_id = ? and official = ?',
-                       (ctx.author.id, potd_id, False))
-        unofficial_attempts = cursor.fetchall()[0][0]
+        if answer_is_correct and not solved_before:
+            # Record that they solved it.
+            cursor.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                           (user_id, potd_id, official_attempts + unofficial_attempts, False))
+
+        return None, answer_is_correct, solved_before, official_attempts, unofficial_attempts
+
+    @commands.command()
+    async def check(self, ctx, date_or_id, answer: int):
+        # Get the POTD id
+        try:
+            potd_id = await self.bot.db.read(lambda conn: shared.id_from_date_or_id(date_or_id, conn, is_public=True))
+        except Exception as e:
+            await ctx.send(e)
+            return
+
+        if await self.throttled(ctx.channel, ctx.author.id, potd_id, 'check'):
+            return
+
+        running_season, answer_is_correct, solved_before, official_attempts, unofficial_attempts = \
+            await self.bot.db.write(self.record_check, ctx.author.id, ctx.author.display_name, potd_id, answer)
+
+        if running_season is not None:
+            await ctx.send(f'This {self.bot.config["otd_prefix"].lower()}otd is part of {running_season}. '
+                           f'Please just DM your answer for this {self.bot.config["otd_prefix"]}OTD to me. ')
+            return
 
         if answer_is_correct:
             if not solved_before:
-                # Record that they solved it.
-                cursor.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
-                               (ctx.author.id, potd_id, official_attempts + unofficial_attempts, False))
                 await ctx.send(
                     f'Nice job! You solved {self.bot.config["otd_prefix"]}OTD `{potd_id}` after `{official_attempts + unofficial_attempts}` '
                     f'attempts (`{official_attempts}` official and `{unofficial_attempts}` unofficial). ')
@@ -447,9 +538,13 @@ class Interface(commands.Cog):
             await ctx.message.delete()
 
         # Still should refresh the embed
-        await self.update_embed(potd_id)
+        self.refresh(potd_id)
 
-        self.bot.db.commit()
+    def set_nickname(self, conn, user_id: int, display_name: str, nickname: str):
+        cursor = conn.cursor()
+        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                       (user_id, display_name, True))
+        cursor.execute('UPDATE users SET nickname = ? WHERE discord_id = ?', (nickname, user_id))
 
     @commands.command()
     async def nick(self, ctx, *, new_nick):
@@ -457,20 +552,15 @@ class Interface(commands.Cog):
             await ctx.send('Nickname is too long!')
             return
 
-        cursor = self.bot.db.cursor()
-        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (ctx.author.id, ctx.author.display_name, True))
-        cursor.execute('UPDATE users SET nickname = ? WHERE discord_id = ?', (new_nick, ctx.author.id))
-        self.bot.db.commit()
+        await self.bot.db.write(self.set_nickname, ctx.author.id, ctx.author.display_name, new_nick)
 
     @commands.command(name='self')
     async def userinfo(self, ctx):
         embed = discord.Embed()
-        cursor = self.bot.db.cursor()
 
         # Retrieve nickname information
-        cursor.execute('SELECT nickname, anonymous from users where discord_id = ?', (ctx.author.id,))
-        result = cursor.fetchall()
+        result = await self.bot.db.fetchall('SELECT nickname, anonymous from users where discord_id = ?',
+                                            (ctx.author.id,))
         if len(result) > 0:
             embed.add_field(name='Nickname', value=result[0][0])
             embed.add_field(name='Anonymous', value=result[0][1])
@@ -479,17 +569,20 @@ class Interface(commands.Cog):
 
         await ctx.send(embed=embed)
 
-    @commands.command()
-    async def toggle_anon(self, ctx):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT anonymous from users where discord_id = ?', (ctx.author.id,))
+    def toggle_anonymous(self, conn, user_id: int) -> bool:
+        """Returns False if the user isn't registered. """
+        cursor = conn.cursor()
+        cursor.execute('SELECT anonymous from users where discord_id = ?', (user_id,))
         result = cursor.fetchall()
-
         if len(result) == 0:
+            return False
+        cursor.execute('UPDATE users SET anonymous = ? WHERE discord_id = ?', (not result[0][0], user_id))
+        return True
+
+    @commands.command()
+    async def toggle_anon(self, ctx):
+        if not await self.bot.db.write(self.toggle_anonymous, ctx.author.id):
             await ctx.send('You are not registered.')
-        else:
-            cursor.execute('UPDATE users SET anonymous = ? WHERE discord_id = ?', (not result[0][0], ctx.author.id))
-            self.bot.db.commit()
 
 
 def setup(bot: openpotd.OpenPOTD):
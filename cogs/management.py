@@ -1,16 +1,25 @@
-import io
+import os
 import re
-import sqlite3
+import tempfile
+import typing
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
 import logging
 
 import discord
-import schedule
 from discord.ext import commands
 from discord.ext import flags
 
+import archive
+import database
 import openpotd
+import problem_import
+import scheduler
+import scoring
+import snapshot
+import writer
+from cogs.interface import weighted_score
 
 authorised_set = set()
 
@@ -24,55 +33,113 @@ class Management(commands.Cog):
     def __init__(self, bot: openpotd.OpenPOTD):
         self.bot = bot
         self.logger = logging.getLogger('management')
-        schedule.every().day.at(self.bot.config['posting_time']).do(self.schedule_potd)
         global authorised_set
         authorised_set = self.bot.config['authorised']
 
-    def schedule_potd(self):
-        self.bot.loop.create_task(self.advance_potd())
-
-    async def advance_potd(self):
-        print(f'Advancing {self.bot.config["otd_prefix"]}OTD at {datetime.now()}')
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT problems.id, difficulty, seasons.name, seasons.id from (seasons left join problems on '
-                       'seasons.running = ? and seasons.id = problems.season and problems.date = ? ) where '
-                       'problems.id IS NOT NULL',
-                       (True, str(date.today())))
-        result = cursor.fetchall()
-        potd_channel = self.bot.get_channel(self.bot.config['potd_channel'])
+        # Everything this cog writes, so that it can be written through the writer service
+        self.bot.db.register(self.warm, self.advance_season, self.update_problem, self.set_running, self.run_sql,
+                             self.finalize, problem_import.insert_problems, archive.roll_up, archive.remove_archived)
+        if self.bot.headless:
+            # The writer service only runs the writes
+            return
+
+        # Post every day in every community, catching up on a post missed while the bot was down
+        for server_id in self.bot.guild_config.server_ids():
+            posting_time = self.bot.guild_config.get(server_id, 'posting_time')
+            if posting_time is None:
+                self.logger.warning(f'No posting_time set for {self.community(server_id)}, not posting there. ')
+                continue
+            # With several shard processes, only the one with the potd_channel posts, so that only it records the
+            # post in scheduled_runs
+            potd_channel = self.bot.get_channel(self.bot.guild_config.get(server_id, 'potd_channel'))
+            if self.bot.db.remote is None or potd_channel is not None:
+                self.bot.scheduler.every_day(self.job_name('post_potd', server_id), posting_time,
+                                             lambda server_id=server_id: self.advance_potd(server_id), catch_up=True)
+
+            # Load caches a few minutes before the post so that the first answers don't have to. Every process has
+            # caches of its own, so each gets a job of its own.
+            prewarm_minutes = self.bot.config.get('prewarm_minutes', 5)
+            if prewarm_minutes:
+                hour, minute = scheduler.parse_time(posting_time)
+                # Any date does, only the time of day is used
+                prewarm_time = datetime(2000, 1, 1, hour, minute) - timedelta(minutes=prewarm_minutes)
+                prewarm_job = self.job_name('prewarm', server_id)
+                if self.bot.process_name is not None:
+                    prewarm_job += f'@{self.bot.process_name}'
+                self.bot.scheduler.every_day(prewarm_job, prewarm_time.strftime('%H:%M'),
+                                             lambda server_id=server_id: self.prewarm(server_id))
+
+    @staticmethod
+    def job_name(job: str, server_id: int) -> str:
+        # The default community keeps the names jobs had before there were several
+        return job if server_id is None else f'{job}:{server_id}'
+
+    @staticmethod
+    def community(server_id: int) -> str:
+        return 'the default community' if server_id is None else f'guild {server_id}'
+
+    def warm(self, conn, server_id: int):
+        """Load the db writer's caches for a community's running seasons. """
+        interface = self.bot.get_cog('Interface')
+        cursor = conn.cursor()
+        cursor.execute('SELECT id from seasons where running = ? and server_id IS ?', (True, server_id))
+        for season_id, in cursor.fetchall():
+            self.bot.current_problems.get(conn, season_id)
+            if interface is not None:
+                interface.ranking.season(cursor, season_id)
+
+    async def prewarm(self, server_id: int = None):
+        await self.bot.db.write(self.warm, server_id)
+        interface = self.bot.get_cog('Interface')
+        if interface is not None:
+            await interface.leaderboard.season(None, server_id)
+            await interface.router.load()
+
+    async def advance_potd(self, server_id: int = None):
+        print(f'Advancing {self.bot.config["otd_prefix"]}OTD for {self.community(server_id)} at {datetime.now()}')
+        result = await self.bot.db.fetchall('SELECT problems.id, difficulty, seasons.name, seasons.id, '
+                                            'seasons.latest_potd from seasons '
+                                            'join problems on seasons.id = problems.season where seasons.running = ? '
+                                            'and seasons.server_id IS ? and problems.date = ?',
+                                            (True, server_id, str(date.today())))
+        potd_channel = self.bot.get_channel(self.bot.guild_config.get(server_id, 'potd_channel'))
+        if potd_channel is None:
+            if self.bot.db.remote is None:
+                self.logger.error(f'Could not find the potd_channel of {self.community(server_id)}. ')
+            # Otherwise its guild is on another process's shards, and that process posts
+            return
         if len(result) == 0 or result[0][0] is None:
             await potd_channel.send(
                 f'Sorry! We are running late on the {self.bot.config["otd_prefix"].lower()}otd today. ')
             return
+        if result[0][0] == result[0][4]:
+            # Already posted, e.g. by a catch up run or %post earlier today
+            self.logger.warning(f'{self.bot.config["otd_prefix"]}OTD {result[0][0]} is already the current problem '
+                                f'of {self.community(server_id)}, not posting it again. ')
+            return
 
         # Get the number of the problem in that season
-        cursor.execute('SELECT COUNT(1) from problems where problems.season = ? and date(problems.date) < date(?)',
-                       (result[0][3], str(date.today())))
-        problem_number = cursor.fetchall()[0][0]
+        problem_number = (await self.bot.db.fetchone('SELECT COUNT(1) from problems where problems.season = ? '
+                                                     'and date(problems.date) < date(?)',
+                                                     (result[0][3], str(date.today()))))[0]
 
         # Send the potd
         potd_id = result[0][0]
         season_name = result[0][2]
-        cursor.execute('SELECT images.image from images where images.potd_id = ?', (potd_id,))
-        images = cursor.fetchall()
-        if len(images) == 0:
+        if not await self.bot.image_posts.send(
+                potd_channel, f'**{season_name} - {self.bot.config["otd_prefix"]}{problem_number}** ', potd_id,
+                record=True):
             await potd_channel.send(f'**{season_name} - {self.bot.config["otd_prefix"]}{problem_number}** '
                                     f'[No Picture]')
             # Should probably warn?
             self.logger.warning(f'No picture linked to potd {potd_id} just posted. ')
-        else:
-            await potd_channel.send(f'**{season_name} - {self.bot.config["otd_prefix"]}{problem_number}** ',
-                                    file=discord.File(io.BytesIO(images[0][0]),
-                                                      filename=f'POTD-{potd_id}-0.png'))
-            for i in range(1, len(images)):
-                await potd_channel.send(file=discord.File(io.BytesIO(images[i][0]), filename=f'POTD-{potd_id}-{i}.png'))
 
-        potd_role_id = self.bot.config['ping_role_id']
+        potd_role_id = self.bot.guild_config.get(server_id, 'ping_role_id')
         if potd_role_id is not None:
             await potd_channel.send(f'DM your answers to me! <@&{potd_role_id}>')
         else:
             await potd_channel.send(f'DM your answers to me!')
-            self.logger.warning('Config variable ping_role_id is not set! ')
+            self.logger.warning(f'Config variable ping_role_id is not set for {self.community(server_id)}! ')
 
         # Construct embed and send
         embed = discord.Embed(title=f'{self.bot.config["otd_prefix"]}oTD {potd_id} Stats')
@@ -83,60 +150,83 @@ class Management(commands.Cog):
         embed.add_field(name='Solves (unofficial)', value='0')
         stats_message = await potd_channel.send(embed=embed)
 
+        # Let the embed updater edit this message directly instead of fetching it again
+        interface = self.bot.get_cog('Interface')
+        if interface is not None:
+            interface.embeds.track(potd_id, stats_message)
+
+        # Commit db
+        previous_solvers = await self.bot.db.write(self.advance_season, potd_id, stats_message.id)
+        self.seasons_changed()
+
+        # Remove the solved role from everyone, in the background. A missing role was reported at startup.
+        role = self.bot.role_index.get(self.bot.guild_config.get(server_id, 'solved_role_id'))
+        if role is not None:
+            if self.bot.low_memory:
+                # role.members is empty without the member cache, so go by who solved the last problem
+                members = await self.bot.members.get_many(role.guild, previous_solvers)
+            else:
+                members = role.members
+            self.bot.roles.apply(members, role, add=False,
+                                 reason=f'New {self.bot.config["otd_prefix"].lower()}otd')
+
+        # Log this
+        self.logger.info(f'Posted {self.bot.config["otd_prefix"]}OTD {potd_id} for {self.community(server_id)}. ')
+
+    def advance_season(self, conn, potd_id: int, stats_message_id: int) -> list:
+        """Make potd_id the current problem of its season. Returns who solved the previous one. """
+        cursor = conn.cursor()
+
         # Update stats embed in db
-        cursor.execute('UPDATE problems SET stats_message_id = ? WHERE problems.id = ?', (stats_message.id, potd_id))
+        cursor.execute('UPDATE problems SET stats_message_id = ? WHERE problems.id = ?', (stats_message_id, potd_id))
 
         # Advance the season
         cursor.execute('SELECT season FROM problems WHERE id = ?', (potd_id,))
         season_id = cursor.fetchall()[0][0]
+        cursor.execute('SELECT DISTINCT user from solves where problem_id = '
+                       '(SELECT latest_potd from seasons where id = ?)', (season_id,))
+        previous_solvers = [user for user, in cursor.fetchall()]
         cursor.execute('UPDATE seasons SET latest_potd = ? WHERE id = ?', (potd_id, season_id))
 
         # Make the new potd publicly available
         cursor.execute('UPDATE problems SET public = ? WHERE id = ?', (True, potd_id))
 
-        # Remove the solved role from everyone
-        role_id = self.bot.config['solved_role_id']
-        if role_id is not None:
-            self.bot.logger.warning('Config variable solved_role_id is not set!')
-            for guild in self.bot.guilds:
-                if guild.get_role(role_id) is not None:
-                    role = guild.get_role(role_id)
-                    for member in role.members:
-                        await member.remove_roles(role)
-                    break
-            else:
-                self.bot.logger.error('No guild found with a role matching the id set in solved_role_id!')
-
-        # Commit db
-        self.bot.db.commit()
-
-        # Log this
-        self.logger.info(f'Posted {self.bot.config["otd_prefix"]}OTD {potd_id}. ')
+        # Start accepting answers for the new potd
+        self.bot.current_problems.load(conn, season_id)
+        return previous_solvers
 
     @commands.command()
     @commands.check(authorised)
     async def post(self, ctx):
-        await self.advance_potd()
+        await self.advance_potd(self.bot.guild_config.server_id(ctx.guild))
+
+    @commands.command()
+    @commands.check(authorised)
+    async def roles(self, ctx):
+        """Show the progress of recent bulk role changes. """
+        if len(self.bot.roles.jobs) == 0:
+            await ctx.send('No bulk role changes yet. ')
+        else:
+            await ctx.send('\n'.join(job.status() for job in self.bot.roles.jobs))
 
     @commands.command()
     @commands.check(authorised)
     async def newseason(self, ctx, *, name):
-        cursor = self.bot.db.cursor()
-        cursor.execute('''INSERT INTO seasons (running, name) VALUES (?, ?)''', (False, name))
-        self.bot.db.commit()
-        cursor.execute('''SELECT LAST_INSERT_ROWID()''')
-        rowid = cursor.fetchone()[0]
+        """Add a season to this server's community, or to the default one if this server has none. """
+        server_id = self.bot.guild_config.server_id(ctx.guild)
+        rowid = await self.bot.db.execute('''INSERT INTO seasons (running, name, server_id) VALUES (?, ?, ?)''',
+                                          (False, name, server_id))
+        self.seasons_changed()
         await ctx.send(f'Added a new season called `{name}` with id `{rowid}`. ')
-        self.logger.info(f'{ctx.author.id} added a new season called {name} with id {rowid}. ')
+        self.logger.info(f'{ctx.author.id} added a new season called {name} with id {rowid} '
+                         f'to {self.community(server_id)}. ')
 
     @commands.command()
     @commands.check(authorised)
     async def add(self, ctx, season: int, prob_date, answer, *, statement):
-        cursor = self.bot.db.cursor()
         prob_date_parsed = date.fromisoformat(prob_date)
-        cursor.execute('''INSERT INTO problems ("date", season, statement, answer, public) VALUES (?, ?, ?, ?, ?)''',
-                       (prob_date_parsed, season, statement, answer, False))
-        self.bot.db.commit()
+        await self.bot.db.execute('''INSERT INTO problems ("date", season, statement, answer, public) '''
+                                  '''VALUES (?, ?, ?, ?, ?)''', (prob_date_parsed, season, statement, answer, False))
         await ctx.send('Added problem. ')
         self.logger.info(f'{ctx.author.id} added a new problem. ')
 
@@ -147,26 +237,48 @@ class Management(commands.Cog):
             await ctx.send("No attached file. ")
             return
         else:
-            save_path = io.BytesIO()
-            await ctx.message.attachments[0].save(save_path)
-            cursor = self.bot.db.cursor()
-            cursor.execute('''INSERT INTO images (potd_id, image) VALUES (?, ?)''',
-                           (potd, sqlite3.Binary(save_path.getbuffer())))
-            self.bot.db.commit()
-            save_path.close()
+            digest = await self.bot.images.put_async(await ctx.message.attachments[0].read())
+            await self.bot.db.execute('''INSERT INTO images (potd_id, sha256) VALUES (?, ?)''', (potd, digest))
+
+            # The recorded upload of this problem's images is now incomplete
+            await self.bot.image_posts.forget(potd)
+
+    @commands.command(name='import')
+    @commands.check(authorised)
+    async def import_problems(self, ctx, season: int):
+        """Add all the problems in an attached zip file to a season at once. See problem_import.py for what goes
+        in the zip file. """
+        if len(ctx.message.attachments) < 1:
+            await ctx.send("No attached file. ")
+            return
+
+        with tempfile.TemporaryFile() as upload:
+            await problem_import.download(ctx.message.attachments[0].url, upload)
+            try:
+                report = await problem_import.import_archive(self.bot.db, self.bot.images, upload, season)
+            except problem_import.InvalidArchive as e:
+                errors = '\n'.join(e.errors)
+                await ctx.send(f'Nothing was imported. ```\n{errors[:1800]}\n```')
+                return
+            except (ValueError, writer.WriterError) as e:
+                # The season changed after the archive was checked, e.g. a problem was added on one of its dates
+                await ctx.send(f'Nothing was imported. ```\n{str(e)[:1800]}\n```')
+                return
+
+        await ctx.send(f'{problem_import.describe(report)}Their ids are `{report["ids"][0]}` to '
+                       f'`{report["ids"][-1]}`. ')
+        self.logger.info(f'{ctx.author.id} imported {report["problems"]} problems into season {season}. ')
 
     @commands.command()
     @commands.check(authorised)
     async def showpotd(self, ctx, potd):
         """Note: this is the admin version of the command so all problems are visible. """
 
-        cursor = self.bot.db.cursor()
         potd_date, potd_id = None, None
         # Find the right potd for the user
         if potd.isdecimal():  # User passed in an id
             potd_id = potd
-            cursor.execute('''SELECT "date" from problems WHERE problems.id = ?''', (potd_id,))
-            result = cursor.fetchall()
+            result = await self.bot.db.fetchall('''SELECT "date" from problems WHERE problems.id = ?''', (potd_id,))
             try:
                 potd_date = result[0][0]
             except IndexError:
@@ -175,8 +287,7 @@ class Management(commands.Cog):
 
         else:  # User passed in a date
             potd_date = potd
-            cursor.execute('''SELECT id from problems WHERE date = ?''', (potd_date,))
-            result = cursor.fetchall()
+            result = await self.bot.db.fetchall('''SELECT id from problems WHERE date = ?''', (potd_date,))
             if len(result) == 0:
                 await ctx.send(f'No such {self.bot.config["otd_prefix"]}OTD found. ')
                 return
@@ -184,16 +295,9 @@ class Management(commands.Cog):
                 potd_id = result[0][0]
 
         # Display the potd to the user
-        cursor.execute('''SELECT image FROM images WHERE potd_id = ?''', (potd_id,))
-        images = cursor.fetchall()
-        if len(images) == 0:
+        if not await self.bot.image_posts.send(ctx, f'{self.bot.config["otd_prefix"]}OTD {potd_id} of {potd_date}',
+                                               potd_id):
             await ctx.send(f'{self.bot.config["otd_prefix"]}OTD {potd_id} of {potd_date} has no picture attached. ')
-        else:
-            await ctx.send(f'{self.bot.config["otd_prefix"]}OTD {potd_id} of {potd_date}',
-                           file=discord.File(io.BytesIO(images[0][0]),
-                                             filename=f'POTD-{potd_id}-0.png'))
-            for i in range(1, len(images)):
-                await ctx.send(file=discord.File(io.BytesIO(images[i][0]), filename=f'POTD-{potd_id}-{i}.png'))
 
     @flags.add_flag('--date')
     @flags.add_flag('--season', type=int)
@@ -205,53 +309,80 @@ class Management(commands.Cog):
     @flags.command()
     @commands.check(authorised)
     async def update(self, ctx, potd: int, **flags):
-        cursor = self.bot.db.cursor()
         if not flags['date'] is None and not bool(re.match(r'\d\d\d\d-\d\d-\d\d', flags['date'])):
             await ctx.send('Invalid date (specify yyyy-mm-dd)')
             return
 
-        for param in flags:
-            if flags[param] is not None:
-                cursor.execute(f'UPDATE problems SET {param} = ? WHERE id = ?', (flags[param], potd))
-        self.bot.db.commit()
+        await self.bot.db.write(self.update_problem, potd, flags)
         await ctx.send(f'Updated {self.bot.config["otd_prefix"].lower()}otd. ')
 
+    def invalidate_caches(self):
+        """Make the db writer reload the current problems and rankings after an arbitrary change. """
+        self.bot.current_problems.invalidate()
+        interface = self.bot.get_cog('Interface')
+        if interface is not None:
+            interface.ranking.invalidate()
+
+    def update_problem(self, conn, potd: int, changes: dict):
+        for param in changes:
+            if changes[param] is not None:
+                conn.execute(f'UPDATE problems SET {param} = ? WHERE id = ?', (changes[param], potd))
+
+        # The answer, season or base points of a problem might have changed, which changes who solved what
+        self.invalidate_caches()
+
     @commands.command()
     @commands.check(authorised)
     async def info(self, ctx, potd):
-        cursor = self.bot.db.cursor()
+        columns = ['id', 'date', 'season', 'statement',
+                   'difficulty', 'weighted_solves', 'base_points', 'answer', 'public', 'source',
+                   'official_solves', 'unofficial_solves', 'attempts', 'attempters']
+        query = (f'SELECT {", ".join(columns)} FROM problems '
+                 f'LEFT JOIN problem_stats ON problem_stats.problem_id = problems.id WHERE ')
         if potd.isdecimal():
-            cursor.execute('SELECT * FROM problems WHERE id = ?', (int(potd),))
+            result = await self.bot.db.fetchall(query + 'id = ?', (int(potd),))
         else:
-            cursor.execute('SELECT * FROM problems WHERE date = ?', (potd,))
+            result = await self.bot.db.fetchall(query + 'date = ?', (potd,))
 
-        result = cursor.fetchall()
         if len(result) == 0:
             await ctx.send(f'No such {self.bot.config["otd_prefix"].lower()}otd. ')
             return
 
-        columns = ['id', 'date', 'season', 'statement',
-                   'difficulty', 'weighted_solves', 'base_points', 'answer', 'public', 'source']
         embed = discord.Embed(title=f'{self.bot.config["otd_prefix"]}OTD {result[0][0]}')
         for i in range(len(columns)):
             embed.add_field(name=columns[i], value=result[0][i], inline=False)
         await ctx.send(embed=embed)
 
+    def seasons_changed(self, rankings_changed: bool = False):
+        """Drop cached season details (and rankings) after committing a change to them. """
+        interface = self.bot.get_cog('Interface')
+        if interface is not None:
+            interface.leaderboard.invalidate_seasons()
+            interface.router.invalidate()
+            if rankings_changed:
+                interface.leaderboard.invalidate()
+
+    def set_running(self, conn, season: int, running: bool):
+        conn.execute('UPDATE seasons SET running = ? where seasons.id = ?', (running, season))
+
+        # Which problem is accepting answers might have changed
+        self.bot.current_problems.load(conn, season)
+
     @commands.command()
     @commands.check(authorised)
     async def start_season(self, ctx, season: int):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT running from seasons where seasons.id = ?', (season,))
-        result = cursor.fetchall()
+        result = await self.bot.db.fetchall('SELECT running from seasons where seasons.id = ?', (season,))
 
         if len(result) == 0:
             await ctx.send(f'No season with id {season}.')
             return
 
         running = result[0][0]
-        if not running:
-            cursor.execute('UPDATE seasons SET running = ? where seasons.id = ?', (True, season))
-            self.bot.db.commit()
+        if await self.bot.db.read(snapshot.finalized, season):
+            await ctx.send(f'Season {season} has been finalized, so it can not be started again. ')
+        elif not running:
+            await self.bot.db.write(self.set_running, season, True)
+            self.seasons_changed()
             self.logger.info(f'Started season with id {season}. ')
         else:
             await ctx.send(f'Season {season} already running!')
@@ -259,9 +390,7 @@ class Management(commands.Cog):
     @commands.command()
     @commands.check(authorised)
     async def end_season(self, ctx, season: int):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT running from seasons where seasons.id = ?', (season,))
-        result = cursor.fetchall()
+        result = await self.bot.db.fetchall('SELECT running from seasons where seasons.id = ?', (season,))
 
         if len(result) == 0:
             await ctx.send(f'No season with id {season}.')
@@ -269,12 +398,72 @@ class Management(commands.Cog):
 
         running = result[0][0]
         if running:
-            cursor.execute('UPDATE seasons SET running = ? where seasons.id = ?', (False, season))
-            self.bot.db.commit()
+            await self.bot.db.write(self.set_running, season, False)
+            self.seasons_changed()
             self.logger.info(f'Ended season with id {season}. ')
+            await ctx.send(await self.finalize_results(season))
+            if self.bot.config.get('archive_on_season_end', True) and self.bot.db.archive_path is not None:
+                await ctx.send(await self.archive_attempts(season))
         else:
             await ctx.send(f'Season {season} already stopped!')
 
+    def finalize(self, conn, season: int) -> tuple:
+        """Bring a finished season's rankings up to date one last time and snapshot them. """
+        running = conn.execute('SELECT running from seasons where id = ?', (season,)).fetchone()
+        if running is None or running[0]:
+            raise ValueError(f'Season {season} is not a finished season. ')
+        if snapshot.finalized(conn, season):
+            raise ValueError(f'Season {season} has already been finalized. ')
+        self.bot.get_cog('Interface').update_rankings(conn, season)
+        return snapshot.take(conn, season)
+
+    async def finalize_results(self, season: int) -> str:
+        ranked, pages = await self.bot.db.write(self.finalize, season)
+        self.seasons_changed(rankings_changed=True)
+        self.logger.info(f'Finalized season {season} with {ranked} ranked users. ')
+        return f'Finalized the results of season {season}: {ranked} ranked users on {pages} pages. '
+
+    @commands.command()
+    @commands.check(authorised)
+    async def finalize_season(self, ctx, season: int):
+        """Freeze the results of a season that ended before seasons were finalized by end_season. """
+        result = await self.bot.db.fetchall('SELECT running from seasons where seasons.id = ?', (season,))
+        if len(result) == 0:
+            await ctx.send(f'No season with id {season}.')
+        elif result[0][0]:
+            await ctx.send(f'Season {season} is still running, end it instead. ')
+        elif await self.bot.db.read(snapshot.finalized, season):
+            await ctx.send(f'Season {season} has already been finalized. ')
+        else:
+            await ctx.send(await self.finalize_results(season))
+
+    async def archive_attempts(self, season: int) -> str:
+        """Move a finished season's attempts into the archive db and compact the main db. """
+        before = os.path.getsize(self.bot.db.path)
+        copied = await self.bot.db.write(archive.roll_up, season)
+        removed = await self.bot.db.write(archive.remove_archived, season)
+        await self.bot.db.write(database.vacuum)
+        after = os.path.getsize(self.bot.db.path)
+        self.logger.info(f'Archived season {season}, copying {copied} attempts and removing {removed}. ')
+        return (f'Moved {removed} attempts from season {season} into the archive. The database went from '
+                f'{before / 1024 / 1024:.1f} MB to {after / 1024 / 1024:.1f} MB. ')
+
+    @commands.command()
+    @commands.check(authorised)
+    async def archive_season(self, ctx, season: int):
+        """Move a finished season's attempts out of the main db. Its scores and attempt counts stay as they are. """
+        if self.bot.db.archive_path is None:
+            await ctx.send('Set archive_db in the config to archive seasons. ')
+            return
+
+        result = await self.bot.db.fetchall('SELECT running from seasons where seasons.id = ?', (season,))
+        if len(result) == 0:
+            await ctx.send(f'No season with id {season}.')
+        elif result[0][0]:
+            await ctx.send(f'Season {season} is still running, end it first. ')
+        else:
+            await ctx.send(await self.archive_attempts(season))
+
     @commands.command()
     @commands.check(authorised)
     async def otd_prefix(self, ctx, new_otd_prefix: str = None):
@@ -284,33 +473,129 @@ class Management(commands.Cog):
             self.bot.config["otd_prefix"] = new_otd_prefix.upper()
             await ctx.send(f'OTD prefix has been changed to {self.bot.config["otd_prefix"]}')
 
+    @commands.command()
+    @commands.check(authorised)
+    async def whatif(self, ctx, season: typing.Optional[int] = None, *formulas):
+        """Compare the season's rankings under other scoring formulas, e.g. `whatif decay:0.8 harmonic flat@500`.
+
+        Formulas are decay:r, linear:k, harmonic and flat, optionally followed by @base_points. """
+        if not scoring.available():
+            await ctx.send('This needs numpy, which is not installed. ')
+            return
+        if len(formulas) == 0:
+            await ctx.send(f'Please give some formulas to compare, from {", ".join(scoring.FAMILIES)}. ')
+            return
+
+        try:
+            parsed = [('current', weighted_score, None)] + [(spec, *scoring.parse_formula(spec)) for spec in formulas]
+        except ValueError as e:
+            await ctx.send(str(e))
+            return
+
+        if season is None:
+            result = await self.bot.db.fetchall('SELECT id from seasons where running = ? and server_id IS ?',
+                                                (True, self.bot.guild_config.server_id(ctx.guild)))
+            if len(result) == 0:
+                await ctx.send('No current running season. Please specify a season. ')
+                return
+            season = result[0][0]
+
+        report = await self.bot.db.read(scoring.compare, season, parsed, self.bot.config['base_points'], 10, 5)
+
+        # Keep each message within Discord's length limit
+        message = []
+        for line in report.split('\n'):
+            if sum(len(x) + 1 for x in message) + len(line) > 1900:
+                await ctx.send('```\n' + '\n'.join(message) + '\n```')
+                message = []
+            message.append(line)
+        await ctx.send('```\n' + '\n'.join(message) + '\n```')
+
     @commands.command()
     @commands.is_owner()
     async def execute_sql(self, ctx, *, sql):
-        cursor = self.bot.db.cursor()
         try:
-            cursor.execute(sql)
+            result = await self.bot.db.write(self.run_sql, sql)
         except Exception as e:
             await ctx.send(e)
-        await ctx.send(str(cursor.fetchall()))
+            return
+        self.seasons_changed(rankings_changed=True)
+        await ctx.send(str(result))
+
+    def run_sql(self, conn, sql: str):
+        # Anything could have changed
+        self.invalidate_caches()
+        return conn.execute(sql).fetchall()
+
+    @commands.command()
+    @commands.is_owner()
+    async def perf(self, ctx):
+        """Show command latencies, the slowest SQL statements and event loop lag since startup. """
+        stats = self.bot.metrics.snapshot()
+        lines = [f'{"":<20} {"calls":>7} {"p50":>8} {"p95":>8} {"p99":>8}']
+        for name, timing in sorted(stats['timings'].items(), key=lambda item: item[1]['count'], reverse=True):
+            lines.append(f'{name[:20]:<20} {timing["count"]:>7} {timing["p50_ms"]:>6.1f}ms {timing["p95_ms"]:>6.1f}ms '
+                         f'{timing["p99_ms"]:>6.1f}ms')
+        lag = stats['loop_lag']
+        lines.append(f'\nLoop lag: p50 {lag["p50_ms"]:.1f}ms, p99 {lag["p99_ms"]:.1f}ms, max {lag["max_ms"]:.1f}ms')
+        ingest = stats.get('ingest')
+        if ingest is not None:
+            lines.append(f'Ingest: {ingest["submissions"]} submissions in {ingest["batches"]} batches, '
+                         f'largest {ingest["largest_batch"]}, max depth {ingest["max_depth"]}, '
+                         f'full {ingest["full"]} times, {ingest["depth"]} queued')
+        if stats['counters']:
+            lines.append(', '.join(f'{name}: {value}' for name, value in stats['counters'].items()))
+
+        lines.append(f'\nSlowest SQL ({stats["sql_statements"]} statements run):')
+        for statement in stats['slowest_sql'][:8]:
+            lines.append(f'{statement["count"]:>7}x {statement["mean_ms"]:>7.2f}ms avg '
+                         f'{statement["max_ms"]:>8.1f}ms max {statement["sql"][:60]}')
+
+        # Keep within Discord's message length limit
+        await ctx.send('```\n' + '\n'.join(lines)[:1900] + '\n```')
+
+    @commands.command()
+    @commands.is_owner()
+    async def migrate_images(self, ctx):
+        """Move images still stored as BLOBs in the db into the image store, then compact the db. """
+        moved = 0
+        while True:
+            rows = await self.bot.db.fetchall('SELECT id, image from images where sha256 is NULL limit 100')
+            if len(rows) == 0:
+                break
+
+            updates = []
+            for image_id, blob in rows:
+                updates.append((await self.bot.images.put_async(blob), image_id))
+            await self.bot.db.executemany('UPDATE images SET sha256 = ?, image = NULL WHERE id = ?', updates)
+            moved += len(updates)
+
+        # Give the space back
+        await self.bot.db.write(database.vacuum)
+        await ctx.send(f'Moved {moved} images out of the database. ')
+        self.logger.info(f'Moved {moved} images out of the database. ')
 
     @commands.command()
     @commands.is_owner()
     async def init_nicks(self, ctx):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT discord_id from users where nickname is NULL')
-        users_to_check = [x[0] for x in cursor.fetchall()]
+        result = await self.bot.db.fetchall('SELECT discord_id from users where nickname is NULL')
+        users_to_check = [x[0] for x in result]
 
         to_update = []
         for user_id in users_to_check:
             user: discord.User = self.bot.get_user(user_id)
+            if user is None and self.bot.low_memory:
+                # Users aren't cached from member lists in low memory mode
+                try:
+                    user = await self.bot.fetch_user(user_id)
+                except discord.NotFound:
+                    pass
             if user is not None:
                 to_update.append((user.display_name, user_id))
             else:
                 to_update.append(('Unknown', user_id))
 
-        cursor.executemany('UPDATE users SET nickname = ? where discord_id = ?', to_update)
-        self.bot.db.commit()
+        await self.bot.db.executemany('UPDATE users SET nickname = ? where discord_id = ?', to_update)
         await ctx.send('Done!')
 
 
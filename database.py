@@ -0,0 +1,150 @@
+"""Async access to the sqlite database.
+
+sqlite3 calls block, so none of them run on the event loop. Every write goes through one dedicated
+writer thread and its connection, which keeps writes serialised. Reads are spread over a small pool
+of read-only connections, which in WAL mode never wait for the writer.
+
+When the bot runs as several processes, writes are sent to the writer service instead (see writer.py),
+which runs them by name. Anything written that way has to be registered as a procedure first. """
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import archive
+import metrics
+import migrate
+import writer
+
+
+def execute(conn: sqlite3.Connection, sql: str, params=()):
+    return conn.execute(sql, params).lastrowid
+
+
+def executemany(conn: sqlite3.Connection, sql: str, seq_of_params):
+    return conn.executemany(sql, seq_of_params).rowcount
+
+
+def vacuum(conn: sqlite3.Connection):
+    conn.execute('VACUUM')
+    # In WAL mode the file only shrinks once the WAL is checkpointed
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+class Database:
+    def __init__(self, path: str, readers: int = 4, mmap_size: int = 256 * 1024 * 1024,
+                 cache_size: int = 16 * 1024, metrics: metrics.Metrics = None, writer_socket: str = None,
+                 archive_path: str = None):
+        """If metrics is given, every statement and how long writes wait for the writer are recorded in it. If
+        writer_socket is given, writes go to the writer service listening there. If archive_path is given, that
+        db is attached to every connection as `archive` (see archive.py). """
+        self.path = path
+        self.archive_path = archive_path
+        self.metrics = metrics
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size  # In KiB
+        self.logger = logging.getLogger('database')
+        self.local = threading.local()
+        self.procedures = {}  # name -> fn(conn, *args) that can be written by name
+        self.names = {}  # fn -> name
+        for fn in (execute, executemany, vacuum):
+            self.register(fn)
+
+        if writer_socket is not None:
+            # The writer service owns the schema and the only write connection
+            self.remote = writer.WriterClient(writer_socket)
+            self.writer = None
+        else:
+            self.remote = None
+            # Switch to WAL and bring the schema up to date before anything else touches the db
+            setup = sqlite3.connect(path)
+            setup.execute('PRAGMA journal_mode = WAL')
+            self.logger.info(f'Database schema at version {migrate.migrate(setup)}')
+            if archive_path is not None:
+                archive.create(setup, archive_path)
+            setup.close()
+            self.writer = ThreadPoolExecutor(1, thread_name_prefix='db-writer', initializer=self._open,
+                                             initargs=(False,))
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix='db-reader', initializer=self._open,
+                                          initargs=(True,))
+
+    def _open(self, read_only: bool):
+        """Open the connection belonging to the current worker thread. """
+        factory = sqlite3.Connection if self.metrics is None else metrics.TimedConnection
+        if read_only:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, factory=factory)
+        else:
+            conn = sqlite3.connect(self.path, factory=factory)
+        if self.metrics is not None:
+            conn.metrics = self.metrics
+        if not read_only:
+            conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = {-int(self.cache_size)}')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        if self.archive_path is not None:
+            archive.attach(conn, self.archive_path, read_only)
+        self.local.conn = conn
+
+    def _run(self, fn, args, commit: bool, queued: float = None):
+        if queued is not None:
+            self.metrics.record('db write wait', time.perf_counter() - queued)
+        conn = self.local.conn
+        try:
+            result = fn(conn, *args)
+        except Exception:
+            conn.rollback()
+            raise
+        if commit:
+            conn.commit()
+        else:
+            # End the implicit read transaction so the next read sees fresh data
+            conn.rollback()
+        return result
+
+    async def read(self, fn, *args):
+        """Run fn(conn, *args) on a read-only connection. """
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self._run, fn, args, False)
+
+    def register(self, *fns):
+        """Make functions (or bound methods) writable by name, which is their qualified name, e.g.
+        Interface.record_check. Both the writer service and its shards have to register them. """
+        for fn in fns:
+            self.procedures[fn.__qualname__] = fn
+            self.names[fn] = fn.__qualname__
+
+    def on_remote_write(self, listener):
+        """Call listener(procedure name) after every write made by another process. """
+        if self.remote is not None:
+            self.remote.listeners.append(listener)
+
+    async def write(self, fn, *args):
+        """Run fn(conn, *args) on the writer connection, in one transaction that is committed afterwards. """
+        if self.remote is not None:
+            if fn not in self.names:
+                raise TypeError(f'{fn.__qualname__} has to be registered to be written through the writer service. ')
+            return await self.remote.call(self.names[fn], args)
+        queued = time.perf_counter() if self.metrics is not None else None
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self._run, fn, args, True, queued)
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def execute(self, sql: str, params=()):
+        """Run a single write statement and return the id of the last inserted row. """
+        return await self.write(execute, sql, params)
+
+    async def executemany(self, sql: str, seq_of_params):
+        return await self.write(executemany, sql, list(seq_of_params))
+
+    def close(self):
+        if self.remote is not None:
+            self.remote.close()
+        else:
+            self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
@@ -0,0 +1,102 @@
+"""Coalesced updates of the stats embeds posted under each potd.
+
+Changes only mark a problem's embed as dirty. A single task flushes dirty embeds at most once per
+interval with the latest stats, so a burst of submissions costs one edit per problem per interval
+rather than a fetch and an edit per submission. """
+import asyncio
+import logging
+
+import discord
+
+
+class EmbedUpdater:
+    def __init__(self, bot, build_embed, interval: float = 5, max_retries: int = 5, cache_size: int = 64):
+        """build_embed(potd_id) is awaited to get the latest embed for a problem. """
+        self.bot = bot
+        self.build_embed = build_embed
+        self.interval = interval
+        self.max_retries = max_retries
+        self.cache_size = cache_size
+        self.logger = logging.getLogger('embeds')
+
+        self.dirty = set()
+        self.messages = {}  # potd id -> discord.Message, oldest first
+        self.wakeup = asyncio.Event()
+        self.edits = 0
+
+    def mark_dirty(self, potd_id: int):
+        self.dirty.add(potd_id)
+        self.wakeup.set()
+
+    def track(self, potd_id: int, message: discord.Message):
+        """Remember a freshly sent stats message so that it never needs to be fetched. """
+        self.messages.pop(potd_id, None)
+        self.messages[potd_id] = message
+        while len(self.messages) > self.cache_size:
+            del self.messages[next(iter(self.messages))]
+
+    async def _message(self, potd_id: int):
+        if potd_id in self.messages:
+            return self.messages[potd_id]
+
+        # Find the message ID in the database
+        result = await self.bot.db.fetchall('SELECT problems.stats_message_id, seasons.server_id from problems '
+                                            'join seasons on seasons.id = problems.season where problems.id = ?',
+                                            (potd_id,))
+        if len(result) == 0:
+            self.logger.error(f'No problem with id {potd_id}. Failed to refresh. ')
+            return None
+        message_id, server_id = result[0]
+        if message_id is None:
+            self.logger.warning(f'No stats message registered for potd {potd_id}. ')
+            return None
+
+        # Find the correct channel, which is the potd_channel of the season's community
+        channel_id = self.bot.guild_config.get(server_id, 'potd_channel')
+        channel = self.bot.get_channel(channel_id)
+        if channel is None and self.bot.db.remote is not None:
+            # Its guild is on another process's shards, but the message can still be edited from here
+            channel = await self.bot.fetch_channel(channel_id)
+        if channel is None:
+            self.logger.error(f'Could not find potd_channel {channel_id}')
+            return None
+
+        message = await channel.fetch_message(message_id)
+        self.track(potd_id, message)
+        return message
+
+    async def flush(self, potd_id: int):
+        for attempt in range(self.max_retries + 1):
+            try:
+                message = await self._message(potd_id)
+                if message is None:
+                    return
+                await message.edit(embed=await self.build_embed(potd_id))
+                self.edits += 1
+                return
+            except discord.NotFound:
+                self.logger.warning(f'Stats message for potd {potd_id} no longer exists. ')
+                self.messages.pop(potd_id, None)
+                return
+            except discord.HTTPException as e:
+                if attempt == self.max_retries:
+                    self.logger.error(f'Giving up on updating the stats embed for potd {potd_id}: {e}')
+                    return
+                backoff = 2 ** attempt
+                self.logger.warning(f'Failed to update the stats embed for potd {potd_id}, '
+                                    f'retrying in {backoff}s: {e}')
+                await asyncio.sleep(backoff)
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            dirty, self.dirty = self.dirty, set()
+
+            results = await asyncio.gather(*[self.flush(potd_id) for potd_id in dirty], return_exceptions=True)
+            for potd_id, result in zip(dirty, results):
+                if isinstance(result, Exception):
+                    self.logger.error(f'Failed to update the stats embed for potd {potd_id}: {result!r}')
+
+            # Anything marked dirty in the meantime is picked up after the interval
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,115 @@
+"""Running one bot for several communities.
+
+Every guild listed under `guilds` in the config is its own community, with its own seasons
+(seasons.server_id), its own potd_channel, ping_role_id, solved_role_id and posting_time, and its own
+submission queue. Seasons without a server_id belong to the default community, which uses the top
+level config, so without `guilds` the bot behaves exactly as a single guild bot.
+
+Anyone can take part in the default community's seasons. A guild's seasons are for the users who
+`register` for them, and DM answers are routed to the right one by an in-memory index of who is
+registered for which running season. """
+import logging
+
+# Config variables that a guild can set for itself
+SETTINGS = ('potd_channel', 'ping_role_id', 'solved_role_id', 'posting_time')
+
+
+class GuildConfig:
+    def __init__(self, config: dict):
+        self.config = config
+        self.guilds = {int(guild_id): overrides or {} for guild_id, overrides in (config.get('guilds') or {}).items()}
+        for guild_id, overrides in self.guilds.items():
+            unknown = set(overrides) - set(SETTINGS)
+            if unknown:
+                logging.getLogger('guilds').warning(f'Guild {guild_id} sets {", ".join(unknown)}, which can only be '
+                                                    f'set for the whole bot. ')
+
+    def server_ids(self) -> list:
+        """Every community, starting with the default one (None). """
+        return [None, *self.guilds]
+
+    def server_id(self, guild) -> int:
+        """The community that a command run in guild (None in DMs) is about. """
+        if guild is not None and guild.id in self.guilds:
+            return guild.id
+        return None
+
+    def get(self, server_id: int, key: str):
+        """A config variable as seen by a community. """
+        overrides = self.guilds.get(server_id, {})
+        return overrides[key] if key in overrides else self.config.get(key)
+
+    def role_ids(self) -> dict:
+        """Every configured role id by where it was configured, for roles.RoleIndex. """
+        role_ids = {key: self.config.get(key) for key in ('solved_role_id', 'ping_role_id')}
+        for guild_id, overrides in self.guilds.items():
+            for key in ('solved_role_id', 'ping_role_id'):
+                if key in overrides:
+                    role_ids[f'guilds.{guild_id}.{key}'] = overrides[key]
+        return role_ids
+
+
+class SeasonRouter:
+    """Which running seasons each user's DM answers can go to.
+
+    Lives on the event loop, like the leaderboard cache. It is loaded lazily, reloaded after any
+    change to the seasons table and told about new registrations as they are committed. """
+
+    def __init__(self, db):
+        self.db = db
+        self.running = None  # running season id -> (server id, name), None until loaded
+        self.current = {}  # running season id -> its current problem (latest_potd)
+        self.registered = {}  # user id -> set of running season ids they're registered for
+        self.version = 0
+
+    def invalidate(self):
+        """Call after committing a change to the seasons table. """
+        self.version += 1
+        self.running = None
+
+    async def load(self):
+        version = self.version
+
+        def read(conn):
+            running = conn.execute('SELECT id, server_id, name, latest_potd from seasons where running = ?',
+                                   (True,)).fetchall()
+            registrations = conn.execute('SELECT registrations.user_id, registrations.season_id from seasons '
+                                         'join registrations on registrations.season_id = seasons.id '
+                                         'where seasons.running = ?', (True,)).fetchall()
+            return running, registrations
+
+        running, registrations = await self.db.read(read)
+        registered = {}
+        for user_id, season_id in registrations:
+            registered.setdefault(user_id, set()).add(season_id)
+        if self.version == version:
+            self.running = {season_id: (server_id, name) for season_id, server_id, name, _ in running}
+            self.current = {season_id: latest_potd for season_id, _, _, latest_potd in running}
+            self.registered = registered
+
+    def register(self, user_id: int, season_id: int):
+        """Call after committing a registration. """
+        if self.running is not None and season_id in self.running:
+            self.registered.setdefault(user_id, set()).add(season_id)
+
+    async def route(self, user_id: int) -> list:
+        """Running seasons a DM answer from user_id could be for: the ones they registered for and the
+        default community's. """
+        while self.running is None:
+            # Try again if the seasons changed while loading
+            await self.load()
+        open_seasons = {season_id for season_id, (server_id, _) in self.running.items() if server_id is None}
+        return sorted(season_id for season_id in self.registered.get(user_id, set()) | open_seasons
+                      if season_id in self.running)
+
+    def current_potd(self, season_id: int):
+        """The current problem of a running season as of the last load. Posting one changes the seasons table,
+        so it is reloaded then. """
+        return self.current.get(season_id)
+
+    def server_of(self, season_id: int):
+        return self.running[season_id][0] if self.running and season_id in self.running else None
+
+    def describe(self, seasons: list) -> str:
+        return ', '.join(f'`{season_id}` ({self.running[season_id][1]})' for season_id in seasons
+                         if self.running and season_id in self.running)
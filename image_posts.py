@@ -0,0 +1,92 @@
+"""Posting problem images without uploading them again every time.
+
+A problem's images are uploaded together, as one message with up to ten attachments. The message and
+its attachment URLs are recorded, and later posts of the same problem just link those attachments.
+Discord's attachment URLs expire, so an expired set is refreshed by fetching the original message,
+and the images are only uploaded again once that message is gone. """
+import logging
+import time
+from urllib.parse import parse_qs, urlparse
+
+import discord
+
+# Discord doesn't allow more files than this in one message
+MAX_FILES = 10
+
+# Refresh URLs this many seconds before they actually expire
+EXPIRY_MARGIN = 600
+
+
+def expired(url: str) -> bool:
+    """Whether url has expired or is about to. A URL without an expiry never expires, but one whose expiry
+    can't be read counts as expired, so that it is refreshed instead of posted broken. """
+    expiry = parse_qs(urlparse(url).query).get('ex')
+    if not expiry:
+        return False
+    try:
+        return int(expiry[0], 16) - EXPIRY_MARGIN < time.time()
+    except ValueError:
+        return True
+
+
+class ImagePoster:
+    def __init__(self, bot):
+        self.bot = bot
+        self.logger = logging.getLogger('image_posts')
+
+    async def _cached_urls(self, potd_id: int, channel_id: int = None):
+        """URLs of the recorded upload of this problem's images, or None if they have to be uploaded. If
+        channel_id is given, only an upload to that channel will do. """
+        result = await self.bot.db.fetchall('SELECT channel_id, message_id, urls from image_posts where potd_id = ?',
+                                            (potd_id,))
+        if len(result) == 0 or (channel_id is not None and result[0][0] != channel_id):
+            return None
+        channel_id, message_id, urls = result[0]
+        urls = urls.split('\n')
+        if not any(expired(url) for url in urls):
+            return urls
+
+        # Get fresh URLs from the original message
+        try:
+            channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+            message = await channel.fetch_message(message_id)
+        except (discord.NotFound, discord.Forbidden):
+            self.logger.info(f'Recorded images for potd {potd_id} are gone, uploading them again. ')
+            return None
+        urls = [attachment.url for attachment in message.attachments]
+        if len(urls) == 0:
+            return None
+        await self.bot.db.execute('UPDATE image_posts SET urls = ? WHERE potd_id = ?', ('\n'.join(urls), potd_id))
+        return urls
+
+    async def send(self, destination: discord.abc.Messageable, content: str, potd_id: int,
+                   record: bool = False) -> bool:
+        """Send content along with the problem's images. Returns False if the problem has no images.
+
+        Only an upload with record set, i.e. the post in the potd channel, is recorded for others to link to, so
+        that nothing ever links attachments in a private channel or DM. """
+        urls = await self._cached_urls(potd_id, destination.id if record else None)
+        if urls is not None:
+            await destination.send('\n'.join([content] + urls))
+            return True
+
+        images = await self.bot.db.fetchall('SELECT sha256, image from images where potd_id = ?', (potd_id,))
+        if len(images) == 0:
+            return False
+
+        files = self.bot.images.files(images, potd_id)
+        messages = [await destination.send(content, files=files[:MAX_FILES])]
+        for i in range(MAX_FILES, len(files), MAX_FILES):
+            messages.append(await destination.send(files=files[i:i + MAX_FILES]))
+
+        # Only one message can be recorded, so problems with too many images are always uploaded
+        if record and len(messages) == 1:
+            urls = [attachment.url for attachment in messages[0].attachments]
+            await self.bot.db.execute('INSERT OR REPLACE INTO image_posts (potd_id, channel_id, message_id, urls) '
+                                      'VALUES (?, ?, ?, ?)',
+                                      (potd_id, messages[0].channel.id, messages[0].id, '\n'.join(urls)))
+        return True
+
+    async def forget(self, potd_id: int):
+        """Make the next post upload the images again, e.g. because they changed. """
+        await self.bot.db.execute('DELETE FROM image_posts WHERE potd_id = ?', (potd_id,))
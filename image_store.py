@@ -0,0 +1,82 @@
+"""Content addressed storage for problem images.
+
+Images are kept on disk under the sha256 of their contents, so identical uploads are only stored
+once, and the images table only keeps that hash. Sending an image streams it straight from disk. """
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+
+import discord
+
+
+class ImageStore:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data: bytes) -> str:
+        """Store an image and return its hash. Does nothing but hash it if it is already stored. """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write to a temporary file first so that a half written image is never visible
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as tmp:
+                    tmp.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        return digest
+
+    def put_file(self, f, chunk_size: int = 64 * 1024) -> str:
+        """Store an image read from the file object f a chunk at a time, so that it is never all in memory,
+        and return its hash. """
+        sha256 = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+            digest = sha256.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    async def put_async(self, data: bytes) -> str:
+        return await asyncio.get_running_loop().run_in_executor(None, self.put, data)
+
+    def file(self, digest: str, filename: str) -> discord.File:
+        """A discord.File that reads the image from disk while it is being uploaded. """
+        return discord.File(self.path(digest), filename=filename)
+
+    def files(self, rows, potd_id: int) -> list:
+        """discord.Files for rows of (sha256, image) from the images table.
+
+        Rows whose image has not been moved out of the db yet are sent from the BLOB. """
+        files = []
+        for i, (digest, blob) in enumerate(rows):
+            filename = f'POTD-{potd_id}-{i}.png'
+            if digest is not None:
+                files.append(self.file(digest, filename))
+            else:
+                files.append(discord.File(io.BytesIO(blob), filename=filename))
+        return files
+
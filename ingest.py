@@ -0,0 +1,122 @@
+"""Burst tolerant ingestion of DM submissions.
+
+Submissions are put on a bounded queue. A single worker takes them off in batches and records each
+batch in one transaction, so a burst of answers costs one commit per batch instead of several per
+answer. Every submission still gets its own result back, in the order it was queued. """
+import asyncio
+import logging
+import sqlite3
+import time
+
+
+def begin(conn: sqlite3.Connection):
+    """Open a transaction for a batch unless one is already open. Without one, the first savepoint would
+    start a transaction of its own and releasing it would commit every submission separately. """
+    if not conn.in_transaction:
+        conn.execute('BEGIN')
+
+
+def isolated(conn: sqlite3.Connection, fn, *args):
+    """Run fn(conn, *args) inside a savepoint so that a failure only undoes its own writes. Call begin first.
+
+    Returns the result, or the exception if one was raised. """
+    conn.execute('SAVEPOINT submission')
+    try:
+        result = fn(conn, *args)
+    except Exception as e:
+        conn.execute('ROLLBACK TO submission')
+        result = e
+    conn.execute('RELEASE submission')
+    return result
+
+
+class SubmissionQueue:
+    def __init__(self, db, handler, max_size: int = 1000, max_batch: int = 50, max_delay: float = 0.05,
+                 report_interval: float = 60):
+        """handler(conn, batch) runs on the db writer and returns one result (or exception) per submission. """
+        self.db = db
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.report_interval = report_interval
+        self.queue = asyncio.Queue(max_size)
+        self.logger = logging.getLogger('ingest')
+
+        # Backpressure metrics since startup, and since the last report
+        self.totals = {'submissions': 0, 'batches': 0, 'largest_batch': 0, 'max_depth': 0, 'full': 0}
+        self.window = dict(self.totals)
+        self.last_report = time.monotonic()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def metrics(self):
+        return {**self.totals, 'depth': self.depth()}
+
+    async def submit(self, *args):
+        """Queue a submission and wait for its result. Waits for space if the queue is full. """
+        future = asyncio.get_running_loop().create_future()
+        if self.queue.full():
+            self._count(full=1)
+        await self.queue.put((args, future))
+        self._count(max_depth=self.depth())
+        return await future
+
+    def _count(self, **values):
+        for counters in (self.totals, self.window):
+            for key, value in values.items():
+                if key in ('largest_batch', 'max_depth'):
+                    counters[key] = max(counters[key], value)
+                else:
+                    counters[key] += value
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                results = await self.db.write(self.handler, [args for args, _ in batch])
+            except Exception as e:
+                self.logger.exception(f'Failed to record a batch of {len(batch)} submissions. ')
+                results = [e] * len(batch)
+
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+            self._count(submissions=len(batch), batches=1, largest_batch=len(batch))
+            self.logger.debug(f'Recorded a batch of {len(batch)} submissions, {self.depth()} still queued. ')
+            self._report()
+
+    def _report(self):
+        if time.monotonic() - self.last_report < self.report_interval:
+            return
+        window = self.window
+        if window['batches'] > 0:
+            self.logger.info(f'{window["submissions"]} submissions in {window["batches"]} batches '
+                             f'(mean {window["submissions"] / window["batches"]:.1f}, '
+                             f'largest {window["largest_batch"]}), max queue depth {window["max_depth"]}, '
+                             f'queue full {window["full"]} times. ')
+        self.window = {key: 0 for key in self.totals}
+        self.last_report = time.monotonic()
@@ -0,0 +1,123 @@
+"""Cached leaderboard pages for the rank and score commands.
+
+Rendered pages and user ranks are cached per season under a ranking version, which is bumped
+whenever a commit changes that season's rankings. Pages are rendered lazily and one at a time, so
+showing a page only ever reads that page's rows. Finalized seasons are read from their snapshot
+(see snapshot.py), which already has every page rendered. """
+import logging
+
+PAGE_SIZE = 20
+
+
+def render(rankings) -> str:
+    """A page of the leaderboard from rows of (rank, score, user id). """
+    return '\n'.join([f'{rank}. {score:.2f} [<@!{user_id}>]' for (rank, score, user_id) in rankings])
+
+
+class Leaderboard:
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger('leaderboard')
+        self.versions = {}  # season id -> ranking version
+        self.pages = {}  # season id -> (version, number of pages, {page number: rendered page})
+        self.user_ranks = {}  # season id -> (version, {user id: (rank, score) or None})
+        self.seasons = None  # season id -> (name, running, server id, pages in its snapshot or None)
+
+    def invalidate(self, season_id: int = None):
+        """Call after committing a change to a season's rankings, or to any season's if none is given. """
+        if season_id is None:
+            for season in set(self.versions) | set(self.pages) | set(self.user_ranks):
+                self.invalidate(season)
+            return
+        self.versions[season_id] = self.versions.get(season_id, 0) + 1
+
+    def invalidate_seasons(self):
+        """Call after committing a change to the seasons table. """
+        self.seasons = None
+
+    async def season(self, season_id: int = None, server_id: int = None):
+        """(id, name) of the given season, or of the community's running season if none is given. None if there
+        isn't one. """
+        if self.seasons is None:
+            rows = await self.db.fetchall('SELECT seasons.id, seasons.name, seasons.running, seasons.server_id, '
+                                          'season_snapshots.pages from seasons '
+                                          'left join season_snapshots on season_snapshots.season_id = seasons.id')
+            self.seasons = {season: (name, running, server, pages) for season, name, running, server, pages in rows}
+
+        if season_id is None:
+            running = [season for season, (_, is_running, server, _) in self.seasons.items()
+                       if is_running and server == server_id]
+            if len(running) == 0:
+                return None
+            season_id = running[0]
+        if season_id not in self.seasons:
+            return None
+        return season_id, self.seasons[season_id][0]
+
+    async def final_pages(self, season_id: int):
+        """Number of pages in a finalized season's snapshot, or None if it hasn't been finalized. """
+        if self.seasons is None:
+            await self.season(season_id)
+        return self.seasons[season_id][3] if season_id in self.seasons else None
+
+    def _pages(self, season_id: int):
+        version = self.versions.get(season_id, 0)
+        if season_id not in self.pages or self.pages[season_id][0] != version:
+            self.pages[season_id] = (version, None, {})
+        return version, self.pages[season_id]
+
+    async def page_count(self, season_id: int) -> int:
+        final = await self.final_pages(season_id)
+        if final is not None:
+            return final
+        version, (_, count, rendered) = self._pages(season_id)
+        if count is None:
+            ranked = (await self.db.fetchone('SELECT count(1) from rankings where season_id = ?', (season_id,)))[0]
+            count = max(1, (ranked + PAGE_SIZE - 1) // PAGE_SIZE)
+            if self.versions.get(season_id, 0) == version:
+                self.pages[season_id] = (version, count, rendered)
+        return count
+
+    async def page(self, season_id: int, page: int) -> str:
+        """Render a page of the leaderboard. Pages are numbered from 1. """
+        version, (_, count, rendered) = self._pages(season_id)
+        if page not in rendered and await self.final_pages(season_id) is not None:
+            row = await self.db.fetchone('SELECT text from final_pages where season_id = ? and page = ?',
+                                         (season_id, page))
+            rendered[page] = row[0] if row is not None else ''
+        elif page not in rendered:
+            rankings = await self.db.fetchall('SELECT rank, score, user_id from rankings where season_id = ? '
+                                              'and rank > ? and rank <= ? order by rank',
+                                              (season_id, (page - 1) * PAGE_SIZE, page * PAGE_SIZE))
+            text = render(rankings)
+            if self.versions.get(season_id, 0) != version:
+                # The rankings changed while we were reading, don't cache what we got
+                return text
+            rendered[page] = text
+        return rendered[page]
+
+    async def user_rank(self, season_id: int, user_id: int):
+        """Return (rank, score) of a user in a season, or None if they're not ranked. For a finalized season
+        it's (rank, score, problems solved, attempts at them). """
+        version = self.versions.get(season_id, 0)
+        if season_id not in self.user_ranks or self.user_ranks[season_id][0] != version:
+            self.user_ranks[season_id] = (version, {})
+        ranks = self.user_ranks[season_id][1]
+        if user_id not in ranks:
+            if await self.final_pages(season_id) is not None:
+                rank = await self.db.fetchone('SELECT rank, score, solved, attempts from final_standings '
+                                              'where season_id = ? and user_id = ?', (season_id, user_id))
+            else:
+                rank = await self.db.fetchone('SELECT rank, score from rankings where season_id = ? and user_id = ?',
+                                              (season_id, user_id))
+            if self.versions.get(season_id, 0) != version:
+                return rank
+            ranks[user_id] = rank
+        return ranks[user_id]
+
+    async def page_of(self, season_id: int, user_id: int):
+        """The page a user is on, or None if they're not ranked. """
+        rank = await self.user_rank(season_id, user_id)
+        if rank is None or rank[0] is None:
+            return None
+        return (rank[0] - 1) // PAGE_SIZE + 1
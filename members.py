@@ -0,0 +1,85 @@
+"""Looking up guild members without keeping every member of every guild in memory.
+
+With the gateway member cache on, lookups are served straight from it. In low memory mode the bot
+doesn't chunk or cache members, so the few members it needs (for solved roles and nicknames) are
+fetched on demand and kept in a small LRU cache whose entries expire after a while. """
+import logging
+import time
+from collections import OrderedDict
+
+import discord
+
+# Discord doesn't allow querying more members than this at once
+QUERY_LIMIT = 100
+
+
+class MemberCache:
+    def __init__(self, size: int = 1000, ttl: float = 600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (guild id, user id) -> (expiry, member or None)
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger('members')
+
+    def _cached(self, guild: discord.Guild, user_id: int):
+        """(True, member or None) if the lookup is cached, otherwise (False, None). """
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.hits += 1
+            return True, member
+
+        key = (guild.id, user_id)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+        self.misses += 1
+        return False, None
+
+    def _store(self, guild_id: int, user_id: int, member):
+        self.entries[(guild_id, user_id)] = (time.monotonic() + self.ttl, member)
+        self.entries.move_to_end((guild_id, user_id))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    async def get(self, guild: discord.Guild, user_id: int):
+        """The member of guild with this id, or None if they're not in it. """
+        cached, member = self._cached(guild, user_id)
+        if cached:
+            return member
+
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            member = None
+        self._store(guild.id, user_id, member)
+        return member
+
+    async def get_many(self, guild: discord.Guild, user_ids) -> list:
+        """The members of guild among user_ids. Uncached ones are queried in batches over the gateway. """
+        members = []
+        missing = []
+        for user_id in user_ids:
+            cached, member = self._cached(guild, user_id)
+            if not cached:
+                missing.append(user_id)
+            elif member is not None:
+                members.append(member)
+
+        for i in range(0, len(missing), QUERY_LIMIT):
+            batch = missing[i:i + QUERY_LIMIT]
+            found = {member.id: member for member in
+                     await guild.query_members(user_ids=batch, limit=len(batch))}
+            for user_id in batch:
+                self._store(guild.id, user_id, found.get(user_id))
+            members.extend(found.values())
+        return members
+
+    def forget(self, guild_id: int, user_id: int):
+        self.entries.pop((guild_id, user_id), None)
+
+    def status(self) -> str:
+        return f'{len(self.entries)}/{self.size} members cached, {self.hits} hits, {self.misses} misses'
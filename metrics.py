@@ -0,0 +1,230 @@
+"""In-memory latency metrics for commands, DM submissions, SQL statements and the event loop.
+
+Latencies go into fixed log-scale histograms, so recording one is a bisect and an increment and
+memory use doesn't grow with traffic. Percentiles are accurate to within one bucket (20%). SQL is
+timed by the connection and cursor classes below, which the db opens its connections with. """
+import asyncio
+import bisect
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Bucket upper bounds in seconds, from 10us up to about two minutes
+BOUNDS = [1e-5 * 1.2 ** i for i in range(90)]
+
+# Distinct SQL statements to keep apart, anything after that is lumped together
+MAX_STATEMENTS = 500
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.buckets[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {'count': self.count, 'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'p50_ms': self.percentile(50) * 1000, 'p95_ms': self.percentile(95) * 1000,
+                'p99_ms': self.percentile(99) * 1000, 'max_ms': self.max * 1000}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()  # SQL is recorded from the db threads
+        self.started = time.time()
+        self.timings = {}  # name -> Histogram
+        self.statements = {}  # SQL -> Histogram
+        self.counters = {}
+        self.loop_lag = Histogram()
+        self.sources = {}  # name -> callable returning a dict of extra metrics
+        self.logger = logging.getLogger('metrics')
+
+    def record(self, name: str, seconds: float):
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = Histogram()
+            self.timings[name].record(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record_sql(self, sql: str, seconds: float):
+        sql = ' '.join(sql.split())
+        with self.lock:
+            if sql not in self.statements:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    sql = '(other statements)'
+                self.statements.setdefault(sql, Histogram())
+            self.statements[sql].record(seconds)
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_source(self, name: str, source):
+        """Include source() in every snapshot, e.g. the ingest queue's own metrics. """
+        self.sources[name] = source
+
+    def slowest_statements(self, n: int = 10):
+        """(SQL, summary) of the n statements that took the most time in total. """
+        with self.lock:
+            statements = sorted(self.statements.items(), key=lambda item: item[1].total, reverse=True)[:n]
+            return [(sql, histogram.summary()) for sql, histogram in statements]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            timings = {name: histogram.summary() for name, histogram in self.timings.items()}
+            counters = dict(self.counters)
+        snapshot = {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'timings': timings,
+            'slowest_sql': [{'sql': sql, **summary} for sql, summary in self.slowest_statements(20)],
+            'sql_statements': sum(histogram.count for histogram in list(self.statements.values())),
+            'loop_lag': self.loop_lag.summary(),
+            'counters': counters,
+        }
+        for name, source in self.sources.items():
+            try:
+                snapshot[name] = source()
+            except Exception:
+                self.logger.exception(f'Could not collect metrics from {name}. ')
+        return snapshot
+
+    def report(self) -> str:
+        """A short human readable summary for the log. """
+        lines = []
+        with self.lock:
+            timings = sorted(self.timings.items(), key=lambda item: item[1].count, reverse=True)
+            lines += [f'{name}: {histogram.count} calls, p50 {histogram.percentile(50) * 1000:.1f}ms, '
+                      f'p95 {histogram.percentile(95) * 1000:.1f}ms, p99 {histogram.percentile(99) * 1000:.1f}ms'
+                      for name, histogram in timings]
+        lines.append(f'loop lag: p99 {self.loop_lag.percentile(99) * 1000:.1f}ms, '
+                     f'max {self.loop_lag.max * 1000:.1f}ms')
+        return '\n'.join(lines)
+
+    def write(self, path: str):
+        """Atomically write a JSON snapshot to path, for anything that wants to scrape it. """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(self.snapshot(), tmp, indent=2)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    async def sample_loop_lag(self, interval: float = 0.5):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.record(max(0.0, loop.time() - expected))
+
+    async def run(self, log_interval: float = 0, scrape_file: str = None, lag_interval: float = 0.5):
+        sampler = asyncio.get_running_loop().create_task(self.sample_loop_lag(lag_interval))
+        try:
+            while log_interval:
+                await asyncio.sleep(log_interval)
+                self.logger.info(f'Metrics:\n{self.report()}')
+                if scrape_file:
+                    try:
+                        self.write(scrape_file)
+                    except OSError:
+                        self.logger.exception(f'Could not write metrics to {scrape_file}. ')
+            await sampler
+        finally:
+            sampler.cancel()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Records how long each statement takes. For queries that includes fetching their rows, which is
+    where most of the time goes, so those are recorded on the first fetch, or when the cursor moves on. """
+    pending = None  # (SQL, seconds so far) of a query whose rows haven't been fetched yet
+
+    def _flush(self):
+        if self.pending is not None:
+            self.connection.metrics.record_sql(*self.pending)
+            self.pending = None
+
+    def _timed(self, run, sql, *args):
+        self._flush()
+        start = time.perf_counter()
+        try:
+            return run(sql, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.description is not None:
+                self.pending = (sql, elapsed)
+            else:
+                self.connection.metrics.record_sql(sql, elapsed)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self.pending is not None:
+                self.pending = (self.pending[0], self.pending[1] + time.perf_counter() - start)
+                self._flush()
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, size or self.arraysize)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __del__(self):
+        self._flush()
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors time their statements. Set metrics after connecting. """
+    metrics = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
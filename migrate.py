@@ -0,0 +1,328 @@
+"""Versioned schema migrations.
+
+schema.sql is the version 0 schema. Every entry in MIGRATIONS is applied in order, in its own
+transaction, and the version reached is recorded in the db with PRAGMA user_version.
+
+Run `python migrate.py [db path]` to migrate a db by hand and then check that none of the bot's
+hot queries needs a full table scan. The hot queries are every statement written out in the modules
+listed in HOT_MODULES, and tests/test_migrate.py runs the same check on an empty db. """
+import ast
+import logging
+import os
+import re
+import sqlite3
+import sys
+import warnings
+
+logger = logging.getLogger('migrate')
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def add_column(table: str, column: str, definition: str):
+    """Migration step that adds a column unless someone already added it by hand. """
+
+    def step(cursor: sqlite3.Cursor):
+        cursor.execute(f'PRAGMA table_info("{table}")')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+
+    return step
+
+
+# (description, list of SQL strings or callables taking a cursor). Never edit a migration that has
+# been released, add a new one instead.
+MIGRATIONS = [
+    ('Add problems.stats_message_id', [
+        add_column('problems', 'stats_message_id', 'INTEGER'),
+    ]),
+    ('Add hot path indexes', [
+        'CREATE INDEX IF NOT EXISTS attempts_potd_user ON attempts (potd_id, user_id, official)',
+        'CREATE INDEX IF NOT EXISTS solves_problem_user ON solves (problem_id, user)',
+        'CREATE INDEX IF NOT EXISTS solves_problem_official ON solves (problem_id, official, user, num_attempts)',
+        'CREATE INDEX IF NOT EXISTS problems_date ON problems (date, public)',
+        'CREATE INDEX IF NOT EXISTS problems_season_date ON problems (season, date)',
+        'CREATE INDEX IF NOT EXISTS images_potd ON images (potd_id)',
+        'CREATE INDEX IF NOT EXISTS rankings_season_rank ON rankings (season_id, rank, score, user_id)',
+        'CREATE INDEX IF NOT EXISTS seasons_running ON seasons (running)',
+        'CREATE INDEX IF NOT EXISTS seasons_latest_potd ON seasons (latest_potd)',
+    ]),
+    ('Add images.sha256 for images kept in the image store', [
+        add_column('images', 'sha256', 'TEXT'),
+    ]),
+    ('Add image_posts to remember uploaded problem images', [
+        'CREATE TABLE IF NOT EXISTS "image_posts" ('
+        '"potd_id" INTEGER NOT NULL PRIMARY KEY, '
+        '"channel_id" INTEGER NOT NULL, '
+        '"message_id" INTEGER NOT NULL, '
+        '"urls" TEXT NOT NULL, '
+        'FOREIGN KEY("potd_id") REFERENCES "problems"("id"))',
+    ]),
+    ('Add scheduled_runs to remember when each scheduled job last ran', [
+        'CREATE TABLE IF NOT EXISTS "scheduled_runs" ("name" TEXT NOT NULL PRIMARY KEY, "last_run" DATETIME)',
+    ]),
+    ('Add problem_stats, kept up to date by triggers on solves and attempts', [
+        'CREATE TABLE IF NOT EXISTS "problem_stats" ('
+        '"problem_id" INTEGER NOT NULL PRIMARY KEY, '
+        '"official_solves" INTEGER NOT NULL DEFAULT 0, '
+        '"unofficial_solves" INTEGER NOT NULL DEFAULT 0, '
+        '"attempts" INTEGER NOT NULL DEFAULT 0, '
+        '"attempters" INTEGER NOT NULL DEFAULT 0, '
+        'FOREIGN KEY("problem_id") REFERENCES "problems"("id"))',
+        'INSERT OR REPLACE INTO problem_stats (problem_id, official_solves, unofficial_solves, attempts, attempters) '
+        'SELECT problems.id, '
+        '(SELECT count(1) from solves where problem_id = problems.id and official IS 1), '
+        '(SELECT count(1) from solves where problem_id = problems.id and official IS 0), '
+        '(SELECT count(1) from attempts where potd_id = problems.id), '
+        '(SELECT count(DISTINCT user_id) from attempts where potd_id = problems.id) '
+        'from problems',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_problem_insert AFTER INSERT ON problems BEGIN '
+        'INSERT OR IGNORE INTO problem_stats (problem_id) VALUES (NEW.id); END',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_problem_delete AFTER DELETE ON problems BEGIN '
+        'DELETE FROM problem_stats WHERE problem_id = OLD.id; END',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_solve_insert AFTER INSERT ON solves BEGIN '
+        'INSERT OR IGNORE INTO problem_stats (problem_id) VALUES (NEW.problem_id); '
+        'UPDATE problem_stats SET official_solves = official_solves + (NEW.official IS 1), '
+        'unofficial_solves = unofficial_solves + (NEW.official IS 0) WHERE problem_id = NEW.problem_id; END',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_solve_delete AFTER DELETE ON solves BEGIN '
+        'UPDATE problem_stats SET official_solves = official_solves - (OLD.official IS 1), '
+        'unofficial_solves = unofficial_solves - (OLD.official IS 0) WHERE problem_id = OLD.problem_id; END',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_solve_update AFTER UPDATE OF problem_id, official ON solves BEGIN '
+        'UPDATE problem_stats SET official_solves = official_solves - (OLD.official IS 1), '
+        'unofficial_solves = unofficial_solves - (OLD.official IS 0) WHERE problem_id = OLD.problem_id; '
+        'INSERT OR IGNORE INTO problem_stats (problem_id) VALUES (NEW.problem_id); '
+        'UPDATE problem_stats SET official_solves = official_solves + (NEW.official IS 1), '
+        'unofficial_solves = unofficial_solves + (NEW.official IS 0) WHERE problem_id = NEW.problem_id; END',
+        # An attempt adds an attempter if it's that user's first at the problem, and removing one takes the
+        # attempter away again if it was their last
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_attempt_insert AFTER INSERT ON attempts BEGIN '
+        'INSERT OR IGNORE INTO problem_stats (problem_id) VALUES (NEW.potd_id); '
+        'UPDATE problem_stats SET attempts = attempts + 1, attempters = attempters + NOT EXISTS '
+        '(SELECT 1 from attempts where potd_id = NEW.potd_id and user_id = NEW.user_id and id != NEW.id) '
+        'WHERE problem_id = NEW.potd_id; END',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_attempt_delete AFTER DELETE ON attempts BEGIN '
+        'UPDATE problem_stats SET attempts = attempts - 1, attempters = attempters - NOT EXISTS '
+        '(SELECT 1 from attempts where potd_id = OLD.potd_id and user_id = OLD.user_id) '
+        'WHERE problem_id = OLD.potd_id; END',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_attempt_update AFTER UPDATE OF potd_id, user_id ON attempts BEGIN '
+        'UPDATE problem_stats SET attempts = attempts - 1, attempters = attempters - NOT EXISTS '
+        '(SELECT 1 from attempts where potd_id = OLD.potd_id and user_id = OLD.user_id) '
+        'WHERE problem_id = OLD.potd_id; '
+        'INSERT OR IGNORE INTO problem_stats (problem_id) VALUES (NEW.potd_id); '
+        'UPDATE problem_stats SET attempts = attempts + 1, attempters = attempters + NOT EXISTS '
+        '(SELECT 1 from attempts where potd_id = NEW.potd_id and user_id = NEW.user_id and id != NEW.id) '
+        'WHERE problem_id = NEW.potd_id; END',
+    ]),
+    ('Add user_problem_state, kept up to date by triggers on attempts and solves', [
+        'CREATE TABLE IF NOT EXISTS "user_problem_state" ('
+        '"problem_id" INTEGER NOT NULL, '
+        '"user_id" INTEGER NOT NULL, '
+        '"official_attempts" INTEGER NOT NULL DEFAULT 0, '
+        '"unofficial_attempts" INTEGER NOT NULL DEFAULT 0, '
+        '"solved" BOOLEAN NOT NULL DEFAULT 0, '
+        '"first_solve_time" DATETIME, '
+        'PRIMARY KEY("problem_id", "user_id"), '
+        'FOREIGN KEY("problem_id") REFERENCES "problems"("id"), '
+        'FOREIGN KEY("user_id") REFERENCES "users"("discord_id")) WITHOUT ROWID',
+        'INSERT OR REPLACE INTO user_problem_state (problem_id, user_id, official_attempts, unofficial_attempts) '
+        'SELECT potd_id, user_id, sum(official IS 1), sum(official IS 0) from attempts group by potd_id, user_id',
+        'INSERT OR IGNORE INTO user_problem_state (problem_id, user_id) SELECT problem_id, user from solves',
+        # A solve is first made by the earliest attempt with the right answer
+        'UPDATE user_problem_state SET solved = 1, first_solve_time = '
+        '(SELECT min(attempts.submit_time) from attempts join problems on problems.id = attempts.potd_id '
+        'where attempts.potd_id = user_problem_state.problem_id and attempts.user_id = user_problem_state.user_id '
+        'and attempts.submission = problems.answer) '
+        'WHERE EXISTS (SELECT 1 from solves where problem_id = user_problem_state.problem_id '
+        'and solves.user = user_problem_state.user_id)',
+        'CREATE TRIGGER IF NOT EXISTS user_problem_state_attempt_insert AFTER INSERT ON attempts BEGIN '
+        'INSERT OR IGNORE INTO user_problem_state (problem_id, user_id) VALUES (NEW.potd_id, NEW.user_id); '
+        'UPDATE user_problem_state SET official_attempts = official_attempts + (NEW.official IS 1), '
+        'unofficial_attempts = unofficial_attempts + (NEW.official IS 0) '
+        'WHERE problem_id = NEW.potd_id and user_id = NEW.user_id; END',
+        'CREATE TRIGGER IF NOT EXISTS user_problem_state_attempt_delete AFTER DELETE ON attempts BEGIN '
+        'UPDATE user_problem_state SET official_attempts = official_attempts - (OLD.official IS 1), '
+        'unofficial_attempts = unofficial_attempts - (OLD.official IS 0) '
+        'WHERE problem_id = OLD.potd_id and user_id = OLD.user_id; END',
+        'CREATE TRIGGER IF NOT EXISTS user_problem_state_attempt_update AFTER UPDATE OF potd_id, user_id, official '
+        'ON attempts BEGIN '
+        'UPDATE user_problem_state SET official_attempts = official_attempts - (OLD.official IS 1), '
+        'unofficial_attempts = unofficial_attempts - (OLD.official IS 0) '
+        'WHERE problem_id = OLD.potd_id and user_id = OLD.user_id; '
+        'INSERT OR IGNORE INTO user_problem_state (problem_id, user_id) VALUES (NEW.potd_id, NEW.user_id); '
+        'UPDATE user_problem_state SET official_attempts = official_attempts + (NEW.official IS 1), '
+        'unofficial_attempts = unofficial_attempts + (NEW.official IS 0) '
+        'WHERE problem_id = NEW.potd_id and user_id = NEW.user_id; END',
+        'CREATE TRIGGER IF NOT EXISTS user_problem_state_solve_insert AFTER INSERT ON solves BEGIN '
+        'INSERT OR IGNORE INTO user_problem_state (problem_id, user_id) VALUES (NEW.problem_id, NEW.user); '
+        'UPDATE user_problem_state SET solved = 1, first_solve_time = coalesce(first_solve_time, '
+        '(SELECT min(attempts.submit_time) from attempts join problems on problems.id = attempts.potd_id '
+        'where attempts.potd_id = NEW.problem_id and attempts.user_id = NEW.user '
+        'and attempts.submission = problems.answer)) '
+        'WHERE problem_id = NEW.problem_id and user_id = NEW.user; END',
+        'CREATE TRIGGER IF NOT EXISTS user_problem_state_solve_delete AFTER DELETE ON solves '
+        'WHEN NOT EXISTS (SELECT 1 from solves where problem_id = OLD.problem_id and user = OLD.user) BEGIN '
+        'UPDATE user_problem_state SET solved = 0, first_solve_time = NULL '
+        'WHERE problem_id = OLD.problem_id and user_id = OLD.user; END',
+    ]),
+    ('Add seasons.server_id and registrations for running several guilds', [
+        add_column('seasons', 'server_id', 'INTEGER'),
+        'CREATE TABLE IF NOT EXISTS "registrations" ('
+        '"season_id" INTEGER NOT NULL, '
+        '"user_id" INTEGER NOT NULL, '
+        'PRIMARY KEY("season_id", "user_id"), '
+        'FOREIGN KEY("season_id") REFERENCES "seasons"("id"), '
+        'FOREIGN KEY("user_id") REFERENCES "users"("discord_id")) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS seasons_server_running ON seasons (server_id, running)',
+    ]),
+    ('Add seasons.archived, and keep the counters of archived seasons when their attempts move out', [
+        add_column('seasons', 'archived', 'BOOLEAN NOT NULL DEFAULT 0'),
+        # One trigger for both counters so that attempters can be counted from user_problem_state before it's
+        # updated. Unlike the attempts table, it still knows about attempts that have been archived.
+        'DROP TRIGGER IF EXISTS problem_stats_attempt_insert',
+        'DROP TRIGGER IF EXISTS user_problem_state_attempt_insert',
+        'CREATE TRIGGER IF NOT EXISTS counters_attempt_insert AFTER INSERT ON attempts BEGIN '
+        'INSERT OR IGNORE INTO problem_stats (problem_id) VALUES (NEW.potd_id); '
+        'UPDATE problem_stats SET attempts = attempts + 1, attempters = attempters + NOT EXISTS '
+        '(SELECT 1 from user_problem_state where problem_id = NEW.potd_id and user_id = NEW.user_id '
+        'and official_attempts + unofficial_attempts > 0) '
+        'WHERE problem_id = NEW.potd_id; '
+        'INSERT OR IGNORE INTO user_problem_state (problem_id, user_id) VALUES (NEW.potd_id, NEW.user_id); '
+        'UPDATE user_problem_state SET official_attempts = official_attempts + (NEW.official IS 1), '
+        'unofficial_attempts = unofficial_attempts + (NEW.official IS 0) '
+        'WHERE problem_id = NEW.potd_id and user_id = NEW.user_id; END',
+        # Moving an archived season's attempts to the archive db doesn't change its counters
+        'DROP TRIGGER IF EXISTS problem_stats_attempt_delete',
+        'DROP TRIGGER IF EXISTS user_problem_state_attempt_delete',
+        'CREATE TRIGGER IF NOT EXISTS problem_stats_attempt_delete AFTER DELETE ON attempts '
+        'WHEN NOT EXISTS (SELECT 1 from problems join seasons on seasons.id = problems.season '
+        'where problems.id = OLD.potd_id and seasons.archived = 1) BEGIN '
+        'UPDATE problem_stats SET attempts = attempts - 1, attempters = attempters - NOT EXISTS '
+        '(SELECT 1 from attempts where potd_id = OLD.potd_id and user_id = OLD.user_id) '
+        'WHERE problem_id = OLD.potd_id; END',
+        'CREATE TRIGGER IF NOT EXISTS user_problem_state_attempt_delete AFTER DELETE ON attempts '
+        'WHEN NOT EXISTS (SELECT 1 from problems join seasons on seasons.id = problems.season '
+        'where problems.id = OLD.potd_id and seasons.archived = 1) BEGIN '
+        'UPDATE user_problem_state SET official_attempts = official_attempts - (OLD.official IS 1), '
+        'unofficial_attempts = unofficial_attempts - (OLD.official IS 0) '
+        'WHERE problem_id = OLD.potd_id and user_id = OLD.user_id; END',
+    ]),
+    ('Add season snapshots, the frozen results of finalized seasons', [
+        'CREATE TABLE IF NOT EXISTS "season_snapshots" ('
+        '"season_id" INTEGER NOT NULL PRIMARY KEY, '
+        '"finalized_at" DATETIME NOT NULL, '
+        '"ranked" INTEGER NOT NULL, '
+        '"pages" INTEGER NOT NULL, '
+        'FOREIGN KEY("season_id") REFERENCES "seasons"("id"))',
+        'CREATE TABLE IF NOT EXISTS "final_standings" ('
+        '"season_id" INTEGER NOT NULL, '
+        '"user_id" INTEGER NOT NULL, '
+        '"rank" INTEGER NOT NULL, '
+        '"score" REAL NOT NULL, '
+        '"solved" INTEGER NOT NULL, '
+        '"attempts" INTEGER NOT NULL, '
+        'PRIMARY KEY("season_id", "user_id"), '
+        'FOREIGN KEY("season_id") REFERENCES "seasons"("id"), '
+        'FOREIGN KEY("user_id") REFERENCES "users"("discord_id")) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS "final_problems" ('
+        '"season_id" INTEGER NOT NULL, '
+        '"problem_id" INTEGER NOT NULL, '
+        '"weighted_solves" REAL NOT NULL, '
+        '"base_points" REAL NOT NULL, '
+        '"official_solves" INTEGER NOT NULL, '
+        'PRIMARY KEY("season_id", "problem_id"), '
+        'FOREIGN KEY("season_id") REFERENCES "seasons"("id"), '
+        'FOREIGN KEY("problem_id") REFERENCES "problems"("id")) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS "final_pages" ('
+        '"season_id" INTEGER NOT NULL, '
+        '"page" INTEGER NOT NULL, '
+        '"text" TEXT NOT NULL, '
+        'PRIMARY KEY("season_id", "page"), '
+        'FOREIGN KEY("season_id") REFERENCES "seasons"("id")) WITHOUT ROWID',
+        # Snapshots are never changed, and nothing can be added to one once it's been taken
+        *[f'CREATE TRIGGER IF NOT EXISTS {table}_{action.lower()}_frozen BEFORE {action} ON {table} BEGIN '
+          f"SELECT RAISE(ABORT, 'Season snapshots can not be changed'); END"
+          for table in ('season_snapshots', 'final_standings', 'final_problems', 'final_pages')
+          for action in ('UPDATE', 'DELETE')],
+        *[f'CREATE TRIGGER IF NOT EXISTS {table}_insert_frozen BEFORE INSERT ON {table} '
+          f'WHEN EXISTS (SELECT 1 from season_snapshots where season_id = NEW.season_id) BEGIN '
+          f"SELECT RAISE(ABORT, 'Season snapshots can not be changed'); END"
+          for table in ('final_standings', 'final_problems', 'final_pages')],
+    ]),
+]
+
+# Modules holding the statements the bot runs on its hot paths. Every statement written out in full in one of
+# them is checked, so a new query can't skip the check by not being listed anywhere.
+HOT_MODULES = ['cogs/interface.py', 'leaderboard.py', 'guilds.py', 'problem_cache.py', 'ranking.py', 'image_posts.py',
+               'snapshot.py', 'shared.py', 'embeds.py', 'scoring.py']
+
+SQL_STATEMENT = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE)\s', re.IGNORECASE)
+
+
+def hot_queries() -> list:
+    """(module, line, query) of every complete statement in HOT_MODULES. Statements put together at runtime,
+    in f-strings or by concatenation, can't be checked. """
+    queries = []
+    for module in HOT_MODULES:
+        with open(os.path.join(REPO, module)) as f, warnings.catch_warnings():
+            # Warnings about the module's own code, e.g. invalid escapes, aren't ours to report
+            warnings.simplefilter('ignore')
+            tree = ast.parse(f.read())
+        # String pieces of f-strings and concatenations are only fragments of a statement
+        fragments = {id(child) for node in ast.walk(tree) if isinstance(node, (ast.JoinedStr, ast.BinOp))
+                     for child in ast.iter_child_nodes(node)}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str) and id(node) not in fragments \
+                    and SQL_STATEMENT.match(node.value) and node.value.lstrip()[0].isupper():
+                queries.append((module, node.lineno, node.value))
+    return queries
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection):
+    """Apply every migration newer than the db's version. """
+    version = schema_version(conn)
+    for number, (description, steps) in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f'Applying migration {number}: {description}')
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN')
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(f'PRAGMA user_version = {number}')
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+    return schema_version(conn)
+
+
+def full_scans(conn: sqlite3.Connection):
+    """Return (where, query, plan detail) for every hot query whose plan contains a full table scan. A statement
+    without a where clause reads the whole table on purpose, so it isn't counted. """
+    offenders = []
+    for module, line, query in hot_queries():
+        if not re.search(r'\bwhere\b', query, re.IGNORECASE):
+            continue
+        # The plan doesn't depend on the values, so any will do
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', [None] * query.count('?')).fetchall():
+            detail = row[-1]
+            if detail.startswith('SCAN') and 'CONSTANT ROW' not in detail:
+                offenders.append((f'{module}:{line}', query, detail))
+    return offenders
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(name)s %(levelname)s] %(message)s')
+    db = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'data/data.db', isolation_level=None)
+    logger.info(f'Schema is at version {migrate(db)}')
+    scans = full_scans(db)
+    for where, query, detail in scans:
+        logger.error(f'{where} {detail}: {query}')
+    assert not scans, f'{len(scans)} hot queries do a full scan'
+    logger.info(f'None of the {len(hot_queries())} hot queries does a full scan. ')
@@ -1,29 +1,84 @@
+import argparse
 import logging
+import os
 import re
-import threading
 import time
 import traceback
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
 import discord
-import schedule
 from discord.ext import commands
 from ruamel import yaml
 
-import sqlite3
+import database
+import guilds
+import image_posts
+import image_store
+import members
+import metrics
+import problem_cache
+import roles
+import scheduler
 
 cfgfile = open("config/config.yml")
 config = yaml.safe_load(cfgfile)
 
 
-class OpenPOTD(commands.Bot):
-    def __init__(self, prefix):
+class OpenPOTD(commands.AutoShardedBot):
+    def __init__(self, prefix, shard_ids: list = None, shard_count: int = None, headless: bool = False):
+        """Pass shard_ids and shard_count to run only those shards, as one of several processes that write
+        through the writer service. headless is for the writer service itself, which never connects. """
+        self.started = time.monotonic()
+        self.ready_time = None
+        self.headless = headless
         intents = discord.Intents.default()
         intents.members = True
-        super().__init__(prefix, intents=intents)
+        self.low_memory = config.get('low_memory_members', False)
+        if self.low_memory:
+            # Don't download and keep every member of every guild, members are fetched when needed instead
+            super().__init__(prefix, intents=intents, member_cache_flags=discord.MemberCacheFlags.none(),
+                             chunk_guilds_at_startup=False, shard_ids=shard_ids, shard_count=shard_count)
+        else:
+            super().__init__(prefix, intents=intents, shard_ids=shard_ids, shard_count=shard_count)
         self.config = config
-        self.db = sqlite3.connect('data/data.db')
-        logging.basicConfig(level=logging.INFO, format='[%(name)s %(levelname)s] %(message)s')
+        if headless:
+            self.process_name = 'writer'
+        elif shard_ids is not None:
+            self.process_name = 'shards-' + '-'.join(map(str, shard_ids))
+        else:
+            self.process_name = None
+        process = f'{self.process_name} ' if self.process_name else ''
+        logging.basicConfig(level=logging.INFO, format=f'[{process}%(name)s %(levelname)s] %(message)s')
         self.logger = logging.getLogger('bot')
+        self.members = members.MemberCache(size=config.get('member_cache_size', 1000),
+                                           ttl=config.get('member_cache_ttl', 600))
+        self.metrics = metrics.Metrics()
+        writer_socket = config.get('writer_socket', 'data/writer.sock') if shard_ids is not None else None
+        self.db = database.Database('data/data.db', readers=config.get('db_readers', 4),
+                                    mmap_size=config.get('db_mmap_size', 256 * 1024 * 1024),
+                                    cache_size=config.get('db_cache_size', 16 * 1024), metrics=self.metrics,
+                                    writer_socket=writer_socket, archive_path=config.get('archive_db'))
+        scrape_file = config.get('metrics_file')
+        if scrape_file and self.process_name:
+            # Every process writes its own
+            root, extension = os.path.splitext(scrape_file)
+            scrape_file = f'{root}-{self.process_name}{extension}'
+        self.metrics_task = self.loop.create_task(self.metrics.run(log_interval=config.get('metrics_log_interval', 0),
+                                                                   scrape_file=scrape_file))
+        self.before_invoke(self.start_command_timer)
+        self.after_invoke(self.stop_command_timer)
+        self.guild_config = guilds.GuildConfig(config)
+        self.current_problems = problem_cache.CurrentProblems()
+        self.images = image_store.ImageStore(config.get('image_dir', 'data/images'))
+        self.image_posts = image_posts.ImagePoster(self)
+        self.scheduler = scheduler.Scheduler(self.db, self.loop)
+        self.roles = roles.RoleFanout(concurrency=config.get('role_concurrency', 5), rate=config.get('role_rate', 5))
+        self.role_index = roles.RoleIndex(self, self.guild_config.role_ids())
         try:
             with open(f'config/{config["blacklist"]}', 'r') as blacklist:
                 self.blacklist = list(map(
@@ -35,8 +90,13 @@ class OpenPOTD(commands.Bot):
     async def on_ready(self):
         self.logger.info('Connected to Discord')
         self.logger.info('Guilds  : {}'.format(len(self.guilds)))
-        self.logger.info('Users   : {}'.format(len(set(self.get_all_members()))))
+        self.logger.info('Users   : {}'.format(sum(guild.member_count or 0 for guild in self.guilds)))
         self.logger.info('Channels: {}'.format(len(list(self.get_all_channels()))))
+        self.role_index.build()
+        if self.ready_time is None:
+            self.ready_time = time.monotonic() - self.started
+            self.logger.info(f'Ready in {self.ready_time:.1f}s ({"low memory" if self.low_memory else "full"} '
+                             f'member cache), {self.memory_usage()}')
         await self.set_presence(self.config['presence'])
 
         for cog in self.config['cogs']:
@@ -47,13 +107,42 @@ class OpenPOTD(commands.Bot):
             else:
                 self.logger.info('Loaded cog {}.'.format(cog))
 
-        self.logger.info(f'Schedule: {schedule.jobs}')
+        self.logger.info(f'Schedule: {self.scheduler.describe()}')
+
+    async def on_guild_join(self, guild):
+        self.role_index.add_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.role_index.remove_guild(guild)
+
+    async def on_guild_role_create(self, role):
+        self.role_index.add_role(role)
+
+    async def on_guild_role_delete(self, role):
+        self.role_index.remove_role(role)
+
+    async def start_command_timer(self, ctx: commands.Context):
+        ctx.started = time.perf_counter()
+
+    async def stop_command_timer(self, ctx: commands.Context):
+        self.metrics.record(f'{self.config["prefix"]}{ctx.command.qualified_name}', time.perf_counter() - ctx.started)
+
+    async def close(self):
+        self.metrics_task.cancel()
+        await super().close()
+        self.db.close()
 
     async def on_message(self, message):
         if message.author.bot: return
         if message.author.id in self.blacklist: return
         await self.process_commands(message)
 
+    def memory_usage(self) -> str:
+        if resource is None:
+            return 'memory usage unknown'
+        # ru_maxrss is in KiB on Linux
+        return f'peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB'
+
     async def set_presence(self, text):
         game = discord.Game(name=text)
         await self.change_presence(activity=game)
@@ -118,16 +207,15 @@ class OpenPOTD(commands.Bot):
             self.logger.error('Unhandled command exception - {}'.format(''.join(info)))
 
 
-def executor():
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
-
-
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the bot, or some of its shards alongside `python writer.py`. ')
+    parser.add_argument('--shard-ids', type=int, nargs='+', help='shards to run in this process')
+    parser.add_argument('--shard-count', type=int, help='number of shards across all processes')
+    args = parser.parse_args()
+    if (args.shard_ids is None) != (args.shard_count is None):
+        parser.error('--shard-ids and --shard-count go together')
+
     with open(f'config/{config["token"]}') as tokfile:
         token = tokfile.readline().rstrip('\n')
 
-    x = threading.Thread(target=executor, args=(), daemon=True)
-    x.start()
-    OpenPOTD(config['prefix']).run(token)
+    OpenPOTD(config['prefix'], shard_ids=args.shard_ids, shard_count=args.shard_count).run(token)
@@ -0,0 +1,81 @@
+"""In-memory state of the problems currently accepting DM answers, one per running season.
+
+Everything here only changes through the bot's own writes, so it is loaded once and then kept up to
+date by the submission path, which means checking an answer needs no reads. It must only be touched
+from the db writer thread, which also keeps it in step with the transactions that change it. """
+import sqlite3
+
+
+class CurrentProblemCache:
+    def __init__(self, season_id: int):
+        self.loaded = False
+        self.potd_id = None
+        self.season_id = season_id
+        self.answer = None
+        self.solved = set()  # Users who have solved the current problem
+        self.attempts = {}  # user id -> number of attempts at the current problem
+
+    def invalidate(self):
+        """Forget everything, so that it is reloaded from the db on next use. """
+        self.loaded = False
+
+    def load(self, conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute('SELECT answer, problems.id from seasons join problems on problems.id = seasons.latest_potd '
+                       'where seasons.id = ? and seasons.running = ?', (self.season_id, True))
+        result = cursor.fetchall()
+        if len(result) == 0:
+            self.potd_id, self.answer = None, None
+            self.solved, self.attempts = set(), {}
+        else:
+            self.answer, self.potd_id = result[0]
+            cursor.execute('SELECT user_id, official_attempts + unofficial_attempts, solved from user_problem_state '
+                           'where problem_id = ?', (self.potd_id,))
+            rows = cursor.fetchall()
+            self.solved = {user for user, _, solved in rows if solved}
+            self.attempts = {user: attempts for user, attempts, _ in rows if attempts}
+        self.loaded = True
+
+    def get(self, conn: sqlite3.Connection):
+        """Return the cache, loading it if needed, or None if there is no current problem. """
+        if not self.loaded:
+            self.load(conn)
+        return self if self.potd_id is not None else None
+
+    def record_attempt(self, user_id: int) -> int:
+        self.attempts[user_id] = self.attempts.get(user_id, 0) + 1
+        return self.attempts[user_id]
+
+    def record_solve(self, user_id: int):
+        self.solved.add(user_id)
+
+
+class CurrentProblems:
+    """A CurrentProblemCache for each season that has been asked about. Only touched from the db writer. """
+
+    def __init__(self):
+        self.seasons = {}  # season id -> CurrentProblemCache
+
+    def get(self, conn: sqlite3.Connection, season_id: int):
+        """The season's current problem, or None if it has none or isn't running. """
+        if season_id not in self.seasons:
+            self.seasons[season_id] = CurrentProblemCache(season_id)
+        return self.seasons[season_id].get(conn)
+
+    def load(self, conn: sqlite3.Connection, season_id: int):
+        """Reload a season's current problem, e.g. after it changed. """
+        if season_id not in self.seasons:
+            self.seasons[season_id] = CurrentProblemCache(season_id)
+        self.seasons[season_id].load(conn)
+
+    def invalidate(self, season_id: int = None):
+        """Forget a season's current problem, or every season's if none is given. """
+        for season in (self.seasons if season_id is None else [season_id]):
+            if season in self.seasons:
+                self.seasons[season].invalidate()
+
+    def potd_id(self, season_id: int):
+        """The season's current problem as last loaded. Fine to read from the event loop, as long as being a
+        moment out of date doesn't matter. """
+        problem = self.seasons.get(season_id)
+        return problem.potd_id if problem is not None else None
@@ -0,0 +1,318 @@
+"""Bulk import of a season's problems from an archive.
+
+An archive is a zip file (or, from the command line, a directory) holding a manifest and the images it
+names. The manifest is problems.yml, a list of problems, or problems.csv with a header row. Each
+problem has a date, answer and statement, and optionally a difficulty, source, public flag and images
+(a list, or separated by `;` in CSV), which are paths relative to the manifest.
+
+The whole manifest is checked before anything is written, and every problem in it is reported on. Then
+images are streamed from the archive into the image store in chunks, and every problem and image row is
+inserted in one transaction, so an import lands completely or not at all.
+
+    python problem_import.py season3.zip --season 3
+"""
+import argparse
+import asyncio
+import csv
+import io
+import logging
+import os
+import posixpath
+import sqlite3
+import time
+import zipfile
+from datetime import date
+
+from ruamel import yaml
+
+MANIFESTS = ('problems.yml', 'problems.yaml', 'problems.csv')
+FIELDS = ('date', 'answer', 'statement', 'difficulty', 'source', 'public', 'images')
+REQUIRED = ('date', 'answer', 'statement')
+IMAGE_TYPES = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger('import')
+
+
+class InvalidArchive(Exception):
+    def __init__(self, errors: list):
+        super().__init__(f'{len(errors)} problems with the archive')
+        self.errors = errors
+
+
+class Archive:
+    """Read access to the files in a zip file or a directory, by their / separated path. """
+
+    def __init__(self, source):
+        """source is a path or a seekable file object. """
+        if isinstance(source, str) and os.path.isdir(source):
+            self.root, self.zip = source, None
+            self.sizes = {}
+            for directory, _, files in os.walk(source):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    self.sizes[os.path.relpath(path, source).replace(os.sep, '/')] = os.path.getsize(path)
+        else:
+            self.root = None
+            try:
+                self.zip = zipfile.ZipFile(source)
+            except zipfile.BadZipFile:
+                raise InvalidArchive(['Not a zip file. '])
+            self.sizes = {info.filename: info.file_size for info in self.zip.infolist() if not info.is_dir()}
+
+    def open(self, name: str):
+        if self.zip is not None:
+            return self.zip.open(name)
+        return open(os.path.join(self.root, name), 'rb')
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_manifest(archive: Archive) -> tuple:
+    """Find and parse the manifest. Returns the directory it is in and its entries. """
+    found = sorted((name.count('/'), name) for name in archive.sizes if posixpath.basename(name) in MANIFESTS)
+    if not found:
+        raise InvalidArchive([f'No manifest, expected one of {", ".join(MANIFESTS)}. '])
+    name = found[0][1]
+    with archive.open(name) as f:
+        text = io.TextIOWrapper(f, encoding='utf-8-sig')
+        try:
+            if name.endswith('.csv'):
+                entries = [{key: value for key, value in row.items() if value not in (None, '')}
+                           for row in csv.DictReader(text, restkey='(unnamed columns)')]
+            else:
+                entries = yaml.safe_load(text)
+        except (yaml.YAMLError, csv.Error, UnicodeDecodeError) as e:
+            raise InvalidArchive([f'Could not read {name}: {e}'])
+
+    if isinstance(entries, dict) and 'problems' in entries:
+        entries = entries['problems']
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise InvalidArchive([f'{name} should be a list of problems. '])
+    return posixpath.dirname(name), entries
+
+
+def _integer(value):
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, int):
+        return value
+    return int(str(value).strip())
+
+
+def _boolean(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('true', 'yes', '1'):
+        return True
+    if text in ('false', 'no', '0'):
+        return False
+    raise ValueError
+
+
+def validate(entries: list, base: str, archive: Archive, taken_dates: set) -> list:
+    """Check every entry and return them as problems to insert, with paths to their images. Raises
+    InvalidArchive listing everything wrong with them. taken_dates are dates the season already has. """
+    errors, problems, dates = [], [], {}
+    if not entries:
+        errors.append('The manifest has no problems. ')
+
+    for number, entry in enumerate(entries, start=1):
+        where = f'Problem {number}'
+        problem = {}
+        if entry.get('date') not in (None, ''):
+            try:
+                problem['date'] = date.fromisoformat(str(entry['date']).strip()).isoformat()
+                where = f'Problem {number} ({problem["date"]})'
+                if problem['date'] in taken_dates:
+                    errors.append(f'{where}: the season already has a problem on this date. ')
+                elif problem['date'] in dates:
+                    errors.append(f'{where}: same date as problem {dates[problem["date"]]}. ')
+                dates.setdefault(problem['date'], number)
+            except ValueError:
+                errors.append(f'{where}: date {entry["date"]} is not a yyyy-mm-dd date. ')
+
+        for field in sorted(map(str, set(entry) - set(FIELDS))):
+            errors.append(f'{where}: unknown field {field}. ')
+        for field in REQUIRED:
+            if entry.get(field) in (None, ''):
+                errors.append(f'{where}: {field} is missing. ')
+
+        for field, parse, description in (('answer', _integer, 'an integer'), ('difficulty', _integer, 'an integer'),
+                                          ('public', _boolean, 'true or false')):
+            if entry.get(field) not in (None, ''):
+                try:
+                    problem[field] = parse(entry[field])
+                except ValueError:
+                    errors.append(f'{where}: {field} should be {description}, not {entry[field]}. ')
+        problem['statement'] = str(entry.get('statement', '')).strip()
+        problem['source'] = str(entry['source']).strip() if entry.get('source') not in (None, '') else None
+        problem.setdefault('difficulty', None)
+        problem.setdefault('public', False)
+
+        images = entry.get('images') or []
+        if isinstance(images, str):
+            images = [image.strip() for image in images.split(';') if image.strip()]
+        elif not isinstance(images, list):
+            errors.append(f'{where}: images should be a list. ')
+            images = []
+        problem['images'] = []
+        for image in images:
+            path = posixpath.normpath(posixpath.join(base, str(image)))
+            if path not in archive.sizes:
+                errors.append(f'{where}: image {image} is not in the archive. ')
+            elif not path.lower().endswith(IMAGE_TYPES):
+                errors.append(f'{where}: {image} is not an image ({", ".join(IMAGE_TYPES)}). ')
+            elif archive.sizes[path] == 0:
+                errors.append(f'{where}: image {image} is empty. ')
+            else:
+                problem['images'].append(path)
+        problems.append(problem)
+
+    if errors:
+        raise InvalidArchive(errors)
+    return problems
+
+
+def store_images(archive: Archive, problems: list, images) -> tuple:
+    """Stream every image the problems use into the image store (image_store.ImageStore), replacing
+    their paths with hashes. Returns how many distinct images there were and their total size. """
+    digests = {}
+    for problem in problems:
+        for path in problem['images']:
+            if path not in digests:
+                with archive.open(path) as f:
+                    digests[path] = images.put_file(f, CHUNK_SIZE)
+        problem['images'] = [digests[path] for path in problem['images']]
+    return len(digests), sum(archive.sizes[path] for path in digests)
+
+
+def taken_dates(conn: sqlite3.Connection, season_id: int) -> set:
+    return {str(problem_date) for problem_date,
+            in conn.execute('SELECT "date" from problems where season = ?', (season_id,)).fetchall()}
+
+
+def insert_problems(conn: sqlite3.Connection, season_id: int, problems: list) -> list:
+    """Insert problems from validate() (after store_images()) and their images. Returns their ids. """
+    if conn.execute('SELECT 1 from seasons where id = ?', (season_id,)).fetchone() is None:
+        raise ValueError(f'No season with id {season_id}. ')
+    # Checked again here in case problems were added since the archive was validated
+    clashes = taken_dates(conn, season_id) & {problem['date'] for problem in problems}
+    if clashes:
+        raise ValueError(f'The season already has problems on {", ".join(sorted(clashes))}. ')
+
+    ids, image_rows = [], []
+    for problem in problems:
+        potd_id = conn.execute('INSERT INTO problems ("date", season, statement, answer, difficulty, source, public) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (problem['date'], season_id, problem['statement'], problem['answer'],
+                                problem['difficulty'], problem['source'], problem['public'])).lastrowid
+        ids.append(potd_id)
+        image_rows.extend((potd_id, digest) for digest in problem['images'])
+    conn.executemany('INSERT INTO images (potd_id, sha256) VALUES (?, ?)', image_rows)
+    return ids
+
+
+async def import_archive(db, images, source, season_id: int, dry_run: bool = False) -> dict:
+    """Validate and import an archive into a season through db (database.Database, with insert_problems
+    registered), storing its images in images. Returns counts and how long each step took. """
+    loop = asyncio.get_running_loop()
+    timings = {}
+    start = time.perf_counter()
+    if await db.read(lambda conn: conn.execute('SELECT 1 from seasons where id = ?', (season_id,)).fetchone()) is None:
+        raise InvalidArchive([f'No season with id {season_id}. '])
+    taken = await db.read(taken_dates, season_id)
+
+    archive = await loop.run_in_executor(None, Archive, source)
+    try:
+        def check():
+            base, entries = read_manifest(archive)
+            return validate(entries, base, archive, taken)
+
+        problems = await loop.run_in_executor(None, check)
+        timings['validate'] = time.perf_counter() - start
+        report = {'problems': len(problems), 'images': len({path for problem in problems
+                                                            for path in problem['images']})}
+        if dry_run:
+            return {**report, 'bytes': 0, 'seconds': timings}
+
+        start = time.perf_counter()
+        report['images'], report['bytes'] = await loop.run_in_executor(None, store_images, archive, problems, images)
+        timings['images'] = time.perf_counter() - start
+    finally:
+        archive.close()
+
+    start = time.perf_counter()
+    report['ids'] = await db.write(insert_problems, season_id, problems)
+    timings['write'] = time.perf_counter() - start
+    return {**report, 'seconds': timings}
+
+
+def describe(report: dict) -> str:
+    total = sum(report['seconds'].values())
+    if 'write' not in report['seconds']:
+        return f'{report["problems"]} problems with {report["images"]} images are ready to import. '
+    megabytes = report['bytes'] / 1024 / 1024
+    image_seconds = report['seconds']['images']
+    return (f'Imported {report["problems"]} problems with {report["images"]} images ({megabytes:.1f} MB) in '
+            f'{total:.2f}s, {report["problems"] / total:.0f} problems/s. Validating took '
+            f'{report["seconds"]["validate"]:.2f}s, images {image_seconds:.2f}s'
+            f'{f" ({megabytes / image_seconds:.1f} MB/s)" if image_seconds else ""} '
+            f'and the transaction {report["seconds"]["write"]:.2f}s. ')
+
+
+async def download(url: str, f):
+    """Stream an uploaded archive into the file object f. """
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                f.write(chunk)
+
+
+def main():
+    import database
+    import image_store
+
+    logging.basicConfig(level=logging.INFO, format='[%(name)s %(levelname)s] %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('archive', help='zip file or directory')
+    parser.add_argument('--season', type=int, required=True, help='id of the season to add the problems to')
+    parser.add_argument('--db', default='data/data.db')
+    parser.add_argument('--dry-run', action='store_true', help='only check the archive')
+    args = parser.parse_args()
+
+    with open('config/config.yml') as f:
+        config = yaml.safe_load(f)
+
+    async def run():
+        db = database.Database(args.db, readers=1)
+        db.register(insert_problems)
+        try:
+            return await import_archive(db, image_store.ImageStore(config.get('image_dir', 'data/images')),
+                                        args.archive, args.season, args.dry_run)
+        finally:
+            db.close()
+
+    try:
+        report = asyncio.run(run())
+    except InvalidArchive as e:
+        for error in e.errors:
+            logger.error(error)
+        raise SystemExit('Nothing was imported. ')
+    logger.info(describe(report))
+
+
+if __name__ == '__main__':
+    main()
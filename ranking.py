@@ -0,0 +1,163 @@
+"""Incremental season rankings. """
+import bisect
+import logging
+import math
+import sqlite3
+
+
+class SeasonRanking:
+    """In-memory ranking model for a single season.
+
+    It is seeded once from the solves and rankings tables. After that, refreshing a problem only
+    touches that problem's solvers, and only the rows whose stored values changed are written back. """
+
+    def __init__(self, season_id: int, base_points: float, score_fn):
+        self.season_id = season_id
+        self.base_points = base_points
+        self.score_fn = score_fn
+
+        self.solvers = {}  # problem id -> {user id: num_attempts}
+        self.problems = {}  # problem id -> (weighted_solves, base_points)
+        self.user_points = {}  # user id -> {problem id: points}
+        self.scores = {}  # user id -> score
+        self.order = []  # Sorted list of (-score, user id). A user's rank is their index + 1.
+
+        # What we believe is currently in the db, so that we only write what changed
+        self.stored_ranks = {}  # user id -> (rank, score)
+        self.stored_problems = {}  # problem id -> (weighted_solves, base_points)
+
+        self.dirty_lo, self.dirty_hi = None, None
+        self.dirty_problems = set()
+
+    def load(self, cursor: sqlite3.Cursor):
+        cursor.execute('SELECT solves.user, solves.problem_id, solves.num_attempts from solves '
+                       'join problems on problems.id = solves.problem_id '
+                       'where problems.season = ? and solves.official = ?', (self.season_id, True))
+        self.solvers = {}
+        for user, problem_id, num_attempts in cursor.fetchall():
+            self.solvers.setdefault(problem_id, {})[user] = num_attempts
+
+        cursor.execute('SELECT user_id, rank, score from rankings where season_id = ?', (self.season_id,))
+        ranked = cursor.fetchall()
+        self.stored_ranks = {user: (rank, score) for user, rank, score in ranked}
+
+        cursor.execute('SELECT id, weighted_solves, base_points from problems where season = ?', (self.season_id,))
+        self.stored_problems = {problem_id: (weighted, points) for problem_id, weighted, points in cursor.fetchall()}
+
+        self.problems = {}
+        self.user_points = {user: {} for user, _, _ in ranked}
+        for problem_id in self.solvers:
+            self._score_problem(problem_id)
+            self.dirty_problems.add(problem_id)
+
+        self.scores = {user: math.fsum(self.user_points[user].values()) for user in self.user_points}
+        self.order = sorted((-score, user) for user, score in self.scores.items())
+        self._mark_dirty(0, len(self.order) - 1)
+
+    def _score_problem(self, problem_id: int):
+        """Recompute a problem's weighted solves and the points each of its solvers gets from it. """
+        solvers = self.solvers.get(problem_id, {})
+        weighted = math.fsum(self.score_fn(num_attempts) for num_attempts in solvers.values())
+        if weighted == 0:
+            self.problems.pop(problem_id, None)
+            return
+        points = self.base_points / weighted
+        self.problems[problem_id] = (weighted, points)
+        for user, num_attempts in solvers.items():
+            self.user_points.setdefault(user, {})[problem_id] = points * self.score_fn(num_attempts)
+
+    def _mark_dirty(self, lo: int, hi: int):
+        if hi < lo:
+            return
+        self.dirty_lo = lo if self.dirty_lo is None else min(self.dirty_lo, lo)
+        self.dirty_hi = hi if self.dirty_hi is None else max(self.dirty_hi, hi)
+
+    def _set_score(self, user: int, score: float):
+        """Move a user to their new position in the order, marking every shifted position dirty. """
+        if user in self.scores:
+            old_index = bisect.bisect_left(self.order, (-self.scores[user], user))
+            del self.order[old_index]
+        else:
+            old_index = len(self.order)
+        self.scores[user] = score
+        new_index = bisect.bisect_left(self.order, (-score, user))
+        self.order.insert(new_index, (-score, user))
+        self._mark_dirty(min(old_index, new_index), max(old_index, new_index))
+
+    def add_user(self, user: int):
+        """Rank a user who has not solved anything yet. """
+        if user not in self.scores:
+            self.user_points.setdefault(user, {})
+            self._set_score(user, 0)
+
+    def refresh_problem(self, cursor: sqlite3.Cursor, problem_id: int):
+        """Re-read one problem's official solves and rescore only the users who solved it. """
+        cursor.execute('SELECT user, num_attempts from solves where problem_id = ? and official = ?',
+                       (problem_id, True))
+        solvers = dict(cursor.fetchall())
+        if solvers == self.solvers.get(problem_id, {}):
+            return
+
+        affected = set(self.solvers.get(problem_id, {})) | set(solvers)
+        for user in affected:
+            self.user_points.get(user, {}).pop(problem_id, None)
+        self.solvers[problem_id] = solvers
+        self._score_problem(problem_id)
+        self.dirty_problems.add(problem_id)
+
+        for user in affected:
+            self._set_score(user, math.fsum(self.user_points[user].values()))
+
+    def rank_of(self, user: int):
+        if user not in self.scores:
+            return None
+        return bisect.bisect_left(self.order, (-self.scores[user], user)) + 1
+
+    def flush(self, cursor: sqlite3.Cursor):
+        """Write back only the problem and ranking rows that differ from what is stored. """
+        problem_rows = []
+        for problem_id in self.dirty_problems:
+            if problem_id in self.problems and self.stored_problems.get(problem_id) != self.problems[problem_id]:
+                problem_rows.append((*self.problems[problem_id], problem_id))
+                self.stored_problems[problem_id] = self.problems[problem_id]
+        self.dirty_problems = set()
+
+        ranking_rows = []
+        if self.dirty_lo is not None:
+            for index in range(self.dirty_lo, min(self.dirty_hi + 1, len(self.order))):
+                score, user = -self.order[index][0], self.order[index][1]
+                if self.stored_ranks.get(user) != (index + 1, score):
+                    ranking_rows.append((index + 1, score, user, self.season_id))
+                    self.stored_ranks[user] = (index + 1, score)
+        self.dirty_lo, self.dirty_hi = None, None
+
+        cursor.executemany('UPDATE problems SET weighted_solves = ?, base_points = ? WHERE problems.id = ?',
+                           problem_rows)
+        cursor.executemany('UPDATE rankings SET rank = ?, score = ? WHERE user_id = ? and season_id = ?',
+                           ranking_rows)
+        return len(problem_rows), len(ranking_rows)
+
+
+class RankingEngine:
+    """Keeps a SeasonRanking for every season that has been touched since startup. """
+
+    def __init__(self, base_points: float, score_fn):
+        self.base_points = base_points
+        self.score_fn = score_fn
+        self.seasons = {}
+        self.logger = logging.getLogger('ranking')
+
+    def season(self, cursor: sqlite3.Cursor, season_id: int) -> SeasonRanking:
+        if season_id not in self.seasons:
+            season_ranking = SeasonRanking(season_id, self.base_points, self.score_fn)
+            season_ranking.load(cursor)
+            self.seasons[season_id] = season_ranking
+            self.logger.info(f'Loaded rankings for season {season_id} ({len(season_ranking.order)} users). ')
+        return self.seasons[season_id]
+
+    def invalidate(self, season_id: int = None):
+        """Drop cached state so that it is reloaded from the db on next use. """
+        if season_id is None:
+            self.seasons = {}
+        else:
+            self.seasons.pop(season_id, None)
@@ -0,0 +1,188 @@
+"""Granting and revoking roles in bulk, in the background.
+
+Role changes go through one limiter per guild, since Discord rate limits the member role routes per
+guild. Each limiter bounds the number of requests in flight and spaces them out to a steady rate, so
+a fan-out to thousands of members doesn't just collect 429s. """
+import asyncio
+import logging
+import time
+
+import discord
+
+
+class RouteLimiter:
+    def __init__(self, concurrency: int, rate: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 1 / rate
+        self.next_slot = 0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        slot = max(loop.time(), self.next_slot)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - loop.time())
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
+class FanoutJob:
+    def __init__(self, description: str, total: int):
+        self.description = description
+        self.total = total
+        self.done = 0
+        self.failed = []  # (member id, error)
+        self.started = time.monotonic()
+        self.finished = None
+        self.task = None
+
+    def status(self) -> str:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        state = 'finished' if self.finished else 'running'
+        return f'{self.description}: {self.done}/{self.total} done, {len(self.failed)} failed, {state} ({elapsed:.0f}s)'
+
+
+class RemoteRole:
+    """A role in a guild on another process's shards. """
+
+    def __init__(self, role_id: int, guild_id: int):
+        self.id = role_id
+        self.name = str(role_id)
+        self.guild = discord.Object(guild_id)
+
+
+class RemoteMember:
+    """A member of a guild on another process's shards, whose roles are changed through the REST API. """
+
+    def __init__(self, http, guild_id: int, user_id: int):
+        self.http = http
+        self.guild_id = guild_id
+        self.id = user_id
+
+    async def add_roles(self, role, reason: str = None):
+        await self.http.add_role(self.guild_id, self.id, role.id, reason=reason)
+
+    async def remove_roles(self, role, reason: str = None):
+        await self.http.remove_role(self.guild_id, self.id, role.id, reason=reason)
+
+
+class RoleFanout:
+    def __init__(self, concurrency: int = 5, rate: float = 5, report_interval: float = 10, history: int = 10):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.report_interval = report_interval
+        self.history = history
+        self.limiters = {}  # guild id -> RouteLimiter
+        self.jobs = []  # Bulk changes, most recent last
+        self.logger = logging.getLogger('roles')
+
+    def _limiter(self, guild_id: int) -> RouteLimiter:
+        if guild_id not in self.limiters:
+            self.limiters[guild_id] = RouteLimiter(self.concurrency, self.rate)
+        return self.limiters[guild_id]
+
+    def apply(self, members, role: discord.Role, add: bool, reason: str = None) -> FanoutJob:
+        """Start adding (or removing) role to (or from) every member in the background.
+
+        Only changes for more than one member are kept in jobs, so that the roles granted to each solver don't
+        push the daily revoke out of the history. """
+        members = list(members)
+        verb = 'Granting' if add else 'Revoking'
+        job = FanoutJob(f'{verb} {role.name} for {len(members)} members', len(members))
+        job.task = asyncio.get_running_loop().create_task(self._run(job, members, role, add, reason))
+        if job.total > 1:
+            self.jobs.append(job)
+            del self.jobs[:-self.history]
+        return job
+
+    async def _change(self, job: FanoutJob, member: discord.Member, role: discord.Role, add: bool, reason: str):
+        async with self._limiter(role.guild.id):
+            try:
+                if add:
+                    await member.add_roles(role, reason=reason)
+                else:
+                    await member.remove_roles(role, reason=reason)
+            except discord.HTTPException as e:
+                job.failed.append((member.id, e))
+            except Exception as e:
+                # Anything else is a bug, but it mustn't stop the rest of the fan-out
+                self.logger.exception(f'Changing {role.name} for {member.id} failed. ')
+                job.failed.append((member.id, e))
+            job.done += 1
+
+    async def _report(self, job: FanoutJob):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.logger.info(job.status())
+
+    async def _run(self, job: FanoutJob, members, role: discord.Role, add: bool, reason: str):
+        reporter = asyncio.get_running_loop().create_task(self._report(job)) if job.total > 1 else None
+        try:
+            results = await asyncio.gather(*[self._change(job, member, role, add, reason) for member in members],
+                                           return_exceptions=True)
+            for member, result in zip(members, results):
+                if isinstance(result, Exception):
+                    self.logger.error(f'Changing {role.name} for {member.id} failed: {result!r}')
+                    job.failed.append((member.id, result))
+        finally:
+            job.finished = time.monotonic()
+            if reporter is not None:
+                reporter.cancel()
+
+        if job.failed:
+            self.logger.error(f'{job.status()}. First failures: '
+                              + ', '.join(f'{member_id} ({error})' for member_id, error in job.failed[:5]))
+        elif job.total > 1:
+            self.logger.info(job.status())
+
+
+class RoleIndex:
+    """Which guild each configured role lives in, so finding a role doesn't mean scanning every guild.
+
+    Built once the bot is ready and kept current through role and guild events. """
+
+    def __init__(self, client: discord.Client, role_ids: dict):
+        """role_ids maps config variable names to the role ids they are set to (or None). """
+        self.client = client
+        self.role_ids = role_ids
+        self.guild_ids = {}  # role id -> guild id
+        self.reported = False
+        self.logger = logging.getLogger('roles')
+
+    def build(self):
+        self.guild_ids = {}
+        for guild in self.client.guilds:
+            self.add_guild(guild)
+
+        # Report misconfiguration once instead of on every use
+        if not self.reported:
+            for name, role_id in self.role_ids.items():
+                if role_id is None:
+                    self.logger.warning(f'Config variable {name} is not set!')
+                elif role_id not in self.guild_ids:
+                    self.logger.error(f'No guild found with a role matching the id set in {name}!')
+            self.reported = True
+
+    def add_guild(self, guild: discord.Guild):
+        for role_id in self.role_ids.values():
+            if role_id is not None and guild.get_role(role_id) is not None:
+                self.guild_ids[role_id] = guild.id
+
+    def remove_guild(self, guild: discord.Guild):
+        self.guild_ids = {role_id: guild_id for role_id, guild_id in self.guild_ids.items() if guild_id != guild.id}
+
+    def add_role(self, role: discord.Role):
+        if role.id in self.role_ids.values():
+            self.guild_ids[role.id] = role.guild.id
+
+    def remove_role(self, role: discord.Role):
+        if self.guild_ids.pop(role.id, None) is not None:
+            self.logger.error(f'Configured role {role.id} was deleted!')
+
+    def get(self, role_id: int):
+        """The role with this id if it is one of the configured roles and still exists, otherwise None. """
+        guild = self.client.get_guild(self.guild_ids.get(role_id))
+        if guild is None:
+            return None
+        return guild.get_role(role_id)
@@ -0,0 +1,100 @@
+"""Daily jobs scheduled on the event loop.
+
+Each job sleeps until exactly its next run instead of polling. The last run of every job is recorded
+in the db, so a run missed earlier the same day while the bot was down can be caught up on startup. Registering a job
+with the same name again replaces it instead of adding a duplicate. """
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+
+def parse_time(at: str) -> tuple:
+    """The hour and minute of a time of day given as 'HH:MM' or 'HH:MM:SS'. """
+    hour, minute = (int(x) for x in at.split(':')[:2])
+    return hour, minute
+
+
+class Job:
+    def __init__(self, name: str, at: str, callback, catch_up: bool):
+        self.name = name
+        self.at = at
+        self.hour, self.minute = parse_time(at)
+        self.callback = callback
+        self.catch_up = catch_up
+        self.next_run = None
+
+    def next_after(self, moment: datetime) -> datetime:
+        """The first time this job should run strictly after moment. """
+        run = moment.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if run <= moment:
+            run += timedelta(days=1)
+        return run
+
+
+class Scheduler:
+    def __init__(self, db, loop: asyncio.AbstractEventLoop):
+        self.db = db
+        self.loop = loop
+        self.jobs = {}
+        self.tasks = {}
+        self.logger = logging.getLogger('scheduler')
+
+    def every_day(self, name: str, at: str, callback, catch_up: bool = False):
+        """Await callback() every day at the local time at ('HH:MM').
+
+        If catch_up is set and a run was missed earlier today, e.g. because the bot was down, it runs straight
+        away. A run missed on an earlier day is skipped, since running it today would be running it early. """
+        previous = self.jobs.get(name)
+        self.jobs[name] = Job(name, at, callback, catch_up)
+        if previous is not None and previous.at == at and not self.tasks[name].done():
+            # Already scheduled at that time, so just use the new callback from the next run on
+            return
+        if name in self.tasks:
+            self.tasks[name].cancel()
+        self.tasks[name] = self.loop.create_task(self._run(name))
+
+    def cancel(self, name: str):
+        if name in self.tasks:
+            self.tasks.pop(name).cancel()
+            self.jobs.pop(name)
+
+    def describe(self):
+        return ', '.join(f'{job.name} at {job.at} (next {job.next_run})' for job in self.jobs.values())
+
+    async def _run(self, name: str):
+        result = await self.db.fetchall('SELECT last_run from scheduled_runs where name = ?', (name,))
+        if len(result) == 0:
+            # Never run before, so there is nothing to catch up on
+            last_run = datetime.now()
+            await self._record(name, last_run)
+        else:
+            last_run = datetime.fromisoformat(result[0][0])
+
+        while True:
+            job = self.jobs[name]
+            now = datetime.now()
+            job.next_run = job.next_after(last_run)
+            if job.next_run <= now:
+                if job.catch_up and job.next_run.date() == now.date():
+                    self.logger.warning(f'Missed {name} at {job.next_run}, running it now. ')
+                    job.next_run = now
+                else:
+                    job.next_run = job.next_after(now)
+
+            # Sleep until it's time. Check again after waking in case the clock changed underneath us.
+            delay = (job.next_run - datetime.now()).total_seconds()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = (job.next_run - datetime.now()).total_seconds()
+
+            self.logger.info(f'Running {name}. ')
+            try:
+                await job.callback()
+            except Exception:
+                self.logger.exception(f'Scheduled job {name} failed. ')
+            last_run = datetime.now()
+            await self._record(name, last_run)
+
+    async def _record(self, name: str, last_run: datetime):
+        await self.db.execute('INSERT OR REPLACE INTO scheduled_runs (name, last_run) VALUES (?, ?)',
+                              (name, last_run.isoformat()))
@@ -0,0 +1,133 @@
+"""What-if scoring: rescore a whole season under other formulas without touching the db.
+
+A season's official solves are loaded once into NumPy arrays of user index, problem index and
+attempts. Weighted solves, problem points and scores are then group-by sums over those arrays
+(np.bincount), so even large seasons are rescored in milliseconds. The scoring itself matches
+ranking.SeasonRanking: a problem is worth base_points / (sum of its solvers' weights), and a solver
+gets that times their own weight. Ties are broken by user id, also like SeasonRanking.
+
+NumPy is optional. Without it, available() is False and nothing else here can be used. """
+import sqlite3
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Formulas for the weight of a solve after some number of attempts, by name. Specs with a parameter
+# look like decay:0.8, and any spec can end with @base_points, e.g. harmonic@500.
+FAMILIES = {
+    'decay': lambda r: lambda attempts: r ** (attempts - 1),
+    'linear': lambda k: lambda attempts: np.maximum(0.0, 1 - k * (attempts - 1)),
+    'harmonic': lambda: lambda attempts: 1 / attempts,
+    'flat': lambda: lambda attempts: np.ones_like(attempts),
+}
+
+
+def available() -> bool:
+    return np is not None
+
+
+def parse_formula(spec: str):
+    """(weight function, base points or None) for a spec like decay:0.8 or harmonic@500. """
+    formula, _, base_points = spec.partition('@')
+    family, _, parameter = formula.partition(':')
+    if family not in FAMILIES:
+        raise ValueError(f'Unknown formula {family}. Try one of {", ".join(FAMILIES)}. ')
+    try:
+        fn = FAMILIES[family](float(parameter)) if parameter else FAMILIES[family]()
+        return fn, float(base_points) if base_points else None
+    except (TypeError, ValueError):
+        raise ValueError(f'Could not understand the formula {spec}. ')
+
+
+class SeasonSolves:
+    """A season's official solves as arrays. """
+
+    def __init__(self, conn: sqlite3.Connection, season_id: int):
+        self.season_id = season_id
+        rows = conn.execute('SELECT solves.user, solves.problem_id, solves.num_attempts from solves '
+                            'join problems on problems.id = solves.problem_id '
+                            'where problems.season = ? and solves.official = ?', (season_id, True)).fetchall()
+        ranked = conn.execute('SELECT user_id from rankings where season_id = ?', (season_id,)).fetchall()
+
+        solves = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        # Everyone ranked gets a score, even if they haven't solved anything
+        ranked = np.array(ranked, dtype=np.int64).ravel()
+        self.users, user_index = np.unique(np.concatenate([solves[:, 0], ranked]), return_inverse=True)
+        self.user_index = user_index[:len(solves)]
+        self.problems, self.problem_index = np.unique(solves[:, 1], return_inverse=True)
+        self.attempts = solves[:, 2].astype(np.float64)
+
+    def __len__(self):
+        return len(self.attempts)
+
+    def scores(self, score_fn, base_points: float):
+        """Score of every user in self.users. """
+        weights = np.asarray(score_fn(self.attempts), dtype=np.float64)
+        weighted_solves = np.bincount(self.problem_index, weights=weights, minlength=len(self.problems))
+        with np.errstate(divide='ignore'):
+            points = np.where(weighted_solves > 0, base_points / weighted_solves, 0.0)
+        return np.bincount(self.user_index, weights=points[self.problem_index] * weights,
+                           minlength=len(self.users))
+
+    def ranks(self, scores):
+        """Rank of every user in self.users, given their scores. """
+        order = np.lexsort((self.users, -scores))
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(1, len(order) + 1)
+        return ranks
+
+
+def compare(conn: sqlite3.Connection, season_id: int, formulas: list, base_points: float, top: int = 10,
+            movers: int = 10) -> str:
+    """Rank a season under each (name, weight function, base points or None for the default) and describe
+    the differences. The first formula is the baseline that the others are compared against. """
+    start = time.perf_counter()
+    season = SeasonSolves(conn, season_id)
+    if len(season.users) == 0:
+        return f'Season {season_id} has no ranked users. '
+    loaded = time.perf_counter()
+    results = []
+    for name, score_fn, formula_base_points in formulas:
+        scores = season.scores(score_fn, base_points if formula_base_points is None else formula_base_points)
+        ranks = season.ranks(scores)
+        results.append((name, scores, ranks, np.argsort(ranks)))
+    load_ms, score_ms = (loaded - start) * 1000, (time.perf_counter() - loaded) * 1000
+
+    # Names of everyone we're about to show
+    shown = set()
+    for _, _, _, order in results:
+        shown.update(season.users[order[:top]].tolist())
+    baseline = results[0][2]
+    moves = []
+    for name, _, ranks, _ in results[1:]:
+        change = baseline - ranks
+        biggest = np.argsort(-np.abs(change), kind='stable')[:movers]
+        moves.append((name, [(int(season.users[i]), int(baseline[i]), int(ranks[i])) for i in biggest if change[i]],
+                      int(np.count_nonzero(change))))
+        shown.update(user for user, _, _ in moves[-1][1])
+    nicknames = dict(conn.execute(f'SELECT discord_id, nickname from users where discord_id in '
+                                  f'({", ".join("?" * len(shown))})', list(shown)).fetchall())
+
+    def name_of(user: int) -> str:
+        return (nicknames.get(user) or str(user))[:14]
+
+    width = 24
+    lines = [f'Season {season_id}: {len(season.users)} users, {len(season)} solves, '
+             f'loaded in {load_ms:.1f}ms, {len(formulas)} formulas scored in {score_ms:.1f}ms', '',
+             '#   ' + ''.join(f'{name[:width - 1]:<{width}}' for name, _, _, _ in results)]
+    for position in range(min(top, len(season.users))):
+        row = f'{position + 1:<4}'
+        for _, scores, _, order in results:
+            i = int(order[position])
+            row += f'{name_of(int(season.users[i])):<15}{scores[i]:>8.1f} '
+        lines.append(row)
+
+    for name, moved, total in moves:
+        lines.append('')
+        lines.append(f'{name} vs {results[0][0]}: {total} users change rank')
+        lines += [f'  {name_of(user):<15} {before:>5} -> {after:<5} ({before - after:+d})'
+                  for user, before, after in moved]
+    return '\n'.join(lines)
@@ -0,0 +1,74 @@
+"""Run the bot as several processes on one machine, which spreads the gateway load over more cores.
+
+    python shards.py --processes 4 --shard-count 16
+
+Starts the writer service (writer.py) and waits for its socket. Then it starts openpotd.py once per
+process, each with its share of the shards. If any of them exits, the rest are stopped too. """
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from ruamel import yaml
+
+logger = logging.getLogger('shards')
+
+
+def split(shard_count: int, processes: int) -> list:
+    """The shard ids each process runs. """
+    return [list(range(process, shard_count, processes)) for process in range(processes)]
+
+
+def stop(children: list):
+    # The writer goes last so that the shards' final writes get through
+    for child in reversed(children):
+        if child.poll() is None:
+            child.terminate()
+            try:
+                child.wait(10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='[%(name)s %(levelname)s] %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='number of shard processes')
+    parser.add_argument('--shard-count', type=int, help='number of shards in total, one per process by default')
+    args = parser.parse_args()
+    shard_count = args.shard_count or args.processes
+    if shard_count < args.processes:
+        parser.error('every process needs at least one shard')
+
+    with open('config/config.yml') as f:
+        socket_path = yaml.safe_load(f).get('writer_socket', 'data/writer.sock')
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    children = [subprocess.Popen([sys.executable, 'writer.py'])]
+    try:
+        while not os.path.exists(socket_path):
+            if children[0].poll() is not None:
+                raise SystemExit('The writer service failed to start. ')
+            time.sleep(0.1)
+
+        for shard_ids in split(shard_count, args.processes):
+            logger.info(f'Starting shards {shard_ids} of {shard_count}')
+            children.append(subprocess.Popen([sys.executable, 'openpotd.py', '--shard-ids', *map(str, shard_ids),
+                                              '--shard-count', str(shard_count)]))
+
+        while all(child.poll() is None for child in children):
+            time.sleep(1)
+        for child in children:
+            if child.poll() is not None:
+                logger.error(f'{" ".join(child.args[1:])} exited with {child.returncode}, stopping everything. ')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop(children)
+
+
+if __name__ == '__main__':
+    main()
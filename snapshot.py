@@ -0,0 +1,44 @@
+"""Frozen results of finalized seasons.
+
+Finalizing a season (which end_season does) brings its rankings up to date one last time and copies
+them into a snapshot: every ranked user's final rank and score with how many problems they solved and
+in how many attempts, what each problem ended up being worth, and the rendered leaderboard pages. The
+rank and score commands serve finalized seasons straight from the snapshot.
+
+Triggers stop a snapshot from being changed once it's been taken, and update_rankings refuses to touch
+a finalized season, so its rankings rows can't drift away from the snapshot either. """
+import sqlite3
+from datetime import datetime
+
+import leaderboard
+
+
+def finalized(conn: sqlite3.Connection, season_id: int) -> bool:
+    return conn.execute('SELECT 1 from season_snapshots where season_id = ?', (season_id,)).fetchone() is not None
+
+
+def take(conn: sqlite3.Connection, season_id: int) -> tuple:
+    """Snapshot a season whose rankings are up to date. Returns the number of ranked users and of pages. """
+    conn.execute('INSERT INTO final_standings (season_id, user_id, rank, score, solved, attempts) '
+                 'SELECT rankings.season_id, rankings.user_id, rankings.rank, rankings.score, '
+                 'coalesce(totals.solved, 0), coalesce(totals.attempts, 0) from rankings '
+                 'left join (SELECT solves.user, count(1) as solved, sum(solves.num_attempts) as attempts from solves '
+                 'join problems on problems.id = solves.problem_id where problems.season = ? and solves.official = ? '
+                 'group by solves.user) totals on totals.user = rankings.user_id '
+                 'where rankings.season_id = ?', (season_id, True, season_id))
+    conn.execute('INSERT INTO final_problems (season_id, problem_id, weighted_solves, base_points, official_solves) '
+                 'SELECT problems.season, problems.id, problems.weighted_solves, problems.base_points, '
+                 'coalesce(problem_stats.official_solves, 0) from problems '
+                 'left join problem_stats on problem_stats.problem_id = problems.id where problems.season = ?',
+                 (season_id,))
+
+    standings = conn.execute('SELECT rank, score, user_id from final_standings where season_id = ? order by rank',
+                             (season_id,)).fetchall()
+    size = leaderboard.PAGE_SIZE
+    pages = [(season_id, number, leaderboard.render(standings[start:start + size]))
+             for number, start in enumerate(range(0, max(1, len(standings)), size), start=1)]
+    conn.executemany('INSERT INTO final_pages (season_id, page, text) VALUES (?, ?, ?)', pages)
+
+    conn.execute('INSERT INTO season_snapshots (season_id, finalized_at, ranked, pages) VALUES (?, ?, ?, ?)',
+                 (season_id, datetime.now(), len(standings), len(pages)))
+    return len(standings), len(pages)
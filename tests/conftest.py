@@ -0,0 +1,22 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# The bot's modules live at the top of the repository rather than in a package
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import migrate  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    """An empty db with the bot's current schema. """
+    conn = sqlite3.connect(':memory:')
+    with open(os.path.join(REPO, 'schema.sql')) as f:
+        conn.executescript(f.read())
+    migrate.migrate(conn)
+    yield conn
+    conn.close()
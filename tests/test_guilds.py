@@ -0,0 +1,52 @@
+import asyncio
+
+import guilds
+
+
+class LocalDatabase:
+    """Just enough of database.Database for the router. """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def read(self, fn, *args):
+        return fn(self.conn, *args)
+
+
+def add_season(db, name: str, server_id: int = None, running: bool = True) -> int:
+    season_id = db.execute('INSERT INTO seasons (running, name, server_id) VALUES (?, ?, ?)',
+                           (running, name, server_id)).lastrowid
+    potd_id = db.execute('INSERT INTO problems (date, season, statement, answer, public) VALUES (?, ?, ?, ?, ?)',
+                         ('2020-01-01', season_id, 'Statement', 1, True)).lastrowid
+    db.execute('UPDATE seasons SET latest_potd = ? where id = ?', (potd_id, season_id))
+    return season_id
+
+
+def test_route_and_current_potd(db):
+    open_season = add_season(db, 'Open')
+    guild_season = add_season(db, 'Guild', server_id=42)
+    add_season(db, 'Over', running=False)
+    db.execute('INSERT INTO registrations (user_id, season_id) VALUES (?, ?)', (7, guild_season))
+    router = guilds.SeasonRouter(LocalDatabase(db))
+
+    assert asyncio.run(router.route(1)) == [open_season]
+    assert asyncio.run(router.route(7)) == [open_season, guild_season]
+    assert router.server_of(guild_season) == 42
+
+    # Throttle buckets are keyed by the current problems the router loaded
+    latest = db.execute('SELECT latest_potd from seasons where id = ?', (guild_season,)).fetchone()[0]
+    assert router.current_potd(guild_season) == latest
+    assert router.current_potd(None) is None
+
+
+def test_invalidate_picks_up_a_new_problem(db):
+    season_id = add_season(db, 'Open')
+    router = guilds.SeasonRouter(LocalDatabase(db))
+    asyncio.run(router.route(1))
+    potd_id = db.execute('INSERT INTO problems (date, season, statement, answer, public) VALUES (?, ?, ?, ?, ?)',
+                         ('2020-01-02', season_id, 'Statement', 2, True)).lastrowid
+    db.execute('UPDATE seasons SET latest_potd = ? where id = ?', (potd_id, season_id))
+
+    router.invalidate()
+    asyncio.run(router.route(1))
+    assert router.current_potd(season_id) == potd_id
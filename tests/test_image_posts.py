@@ -0,0 +1,26 @@
+import time
+
+import pytest
+
+# image_posts sends through discord.py
+pytest.importorskip('discord')
+
+import image_posts  # noqa: E402
+
+
+def url(query: str) -> str:
+    return f'https://cdn.discordapp.com/attachments/1/2/potd.png{query}'
+
+
+def test_expired():
+    later = int(time.time()) + 2 * image_posts.EXPIRY_MARGIN
+    assert not image_posts.expired(url(f'?ex={later:x}&is=0&hm=0'))
+    assert image_posts.expired(url(f'?ex={int(time.time()):x}&is=0&hm=0'))
+
+
+def test_url_without_expiry_is_valid():
+    assert not image_posts.expired(url(''))
+
+
+def test_unreadable_expiry_counts_as_expired():
+    assert image_posts.expired(url('?ex=nothex&is=0'))
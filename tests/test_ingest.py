@@ -0,0 +1,60 @@
+import sqlite3
+
+import pytest
+
+import ingest
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE attempts (user_id INTEGER, answer INTEGER)')
+    yield conn
+    conn.close()
+
+
+def record(conn, user_id, answer):
+    conn.execute('INSERT INTO attempts (user_id, answer) VALUES (?, ?)', (user_id, answer))
+    if answer < 0:
+        raise ValueError('negative answer')
+    return user_id
+
+
+def attempts(conn):
+    return conn.execute('SELECT user_id, answer from attempts order by user_id').fetchall()
+
+
+def test_failure_only_undoes_its_own_writes(conn):
+    ingest.begin(conn)
+    results = [ingest.isolated(conn, record, *submission) for submission in [(1, 5), (2, -1), (3, 7)]]
+    assert results[0] == 1 and results[2] == 3
+    assert isinstance(results[1], ValueError)
+    assert attempts(conn) == [(1, 5), (3, 7)]
+
+
+def test_batch_is_one_transaction(conn):
+    ingest.begin(conn)
+    for submission in [(1, 5), (2, 6)]:
+        ingest.isolated(conn, record, *submission)
+    # Releasing the savepoints mustn't have committed anything
+    assert conn.in_transaction
+    conn.rollback()
+    assert attempts(conn) == []
+
+
+def test_batch_commits_once(conn):
+    ingest.begin(conn)
+    for submission in [(1, 5), (2, -1)]:
+        ingest.isolated(conn, record, *submission)
+    conn.commit()
+    conn.rollback()
+    assert attempts(conn) == [(1, 5)]
+
+
+def test_begin_joins_an_open_transaction(conn):
+    record(conn, 1, 5)
+    assert conn.in_transaction
+    ingest.begin(conn)
+    ingest.isolated(conn, record, 2, 6)
+    conn.rollback()
+    assert attempts(conn) == []
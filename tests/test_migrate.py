@@ -0,0 +1,28 @@
+import sqlite3
+
+import migrate
+
+
+def test_migrations_reach_the_latest_version(db):
+    assert migrate.schema_version(db) == len(migrate.MIGRATIONS)
+    # Migrating again changes nothing
+    assert migrate.migrate(db) == len(migrate.MIGRATIONS)
+
+
+def test_hot_queries_are_found():
+    queries = [query for _, _, query in migrate.hot_queries()]
+    assert any('from rankings' in query for query in queries)
+    assert all(migrate.SQL_STATEMENT.match(query) for query in queries)
+
+
+def test_no_hot_query_does_a_full_scan(db):
+    assert migrate.full_scans(db) == []
+
+
+def test_full_scans_are_reported(db, tmp_path, monkeypatch):
+    module = tmp_path / 'slow.py'
+    module.write_text("QUERY = 'SELECT 1 from attempts where submission = ?'\n"
+                      "ALL = 'SELECT id from seasons'\n"
+                      "DYNAMIC = f'SELECT 1 from attempts where submission = {1}'\n")
+    monkeypatch.setattr(migrate, 'HOT_MODULES', [str(module)])
+    assert [where for where, _, _ in migrate.full_scans(db)] == [f'{module}:1']
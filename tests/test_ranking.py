@@ -0,0 +1,103 @@
+import math
+
+import pytest
+
+import ranking
+
+
+def weighted_score(attempts: int):
+    return 0.9 ** (attempts - 1)
+
+
+BASE_POINTS = 1000
+
+
+@pytest.fixture
+def season(db):
+    """A season of three problems and four ranked users, solved as in SOLVES. """
+    season_id = db.execute('INSERT INTO seasons (running, name) VALUES (?, ?)', (True, 'Season')).lastrowid
+    problems = [db.execute('INSERT INTO problems (date, season, statement, answer, public) VALUES (?, ?, ?, ?, ?)',
+                           (f'2020-01-0{day}', season_id, 'Statement', day, True)).lastrowid for day in (1, 2, 3)]
+    for user in (1, 2, 3, 4):
+        db.execute('INSERT INTO rankings (season_id, user_id) VALUES (?, ?)', (season_id, user))
+    solves = [(1, problems[0], 1), (2, problems[0], 3), (1, problems[1], 2), (3, problems[1], 1)]
+    db.executemany('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, 1)', solves)
+    return season_id, problems
+
+
+def expected_scores(db, season_id: int) -> dict:
+    """Everyone's score computed from scratch, straight from the solves. """
+    scores = {user: 0.0 for user, in db.execute('SELECT user_id from rankings where season_id = ?', (season_id,))}
+    solves = db.execute('SELECT problem_id, user, num_attempts from solves join problems on problems.id = problem_id '
+                        'where problems.season = ? and official = 1', (season_id,)).fetchall()
+    for problem_id in {problem_id for problem_id, _, _ in solves}:
+        solvers = [(user, attempts) for problem, user, attempts in solves if problem == problem_id]
+        points = BASE_POINTS / math.fsum(weighted_score(attempts) for _, attempts in solvers)
+        for user, attempts in solvers:
+            scores[user] += points * weighted_score(attempts)
+    return scores
+
+
+def stored(db, season_id: int) -> dict:
+    return {user: (rank, score) for user, rank, score in
+            db.execute('SELECT user_id, rank, score from rankings where season_id = ?', (season_id,))}
+
+
+def assert_matches_recompute(db, season_id: int):
+    scores = expected_scores(db, season_id)
+    rows = stored(db, season_id)
+    assert rows.keys() == scores.keys()
+    for user, score in scores.items():
+        assert rows[user][1] == pytest.approx(score)
+    # Ranked by score, ties broken by user id
+    order = sorted(scores, key=lambda user: (-round(scores[user], 9), user))
+    assert [rows[user][0] for user in order] == list(range(1, len(order) + 1))
+
+
+def test_load_and_flush_match_a_recompute(db, season):
+    season_id, _ = season
+    season_ranking = ranking.SeasonRanking(season_id, BASE_POINTS, weighted_score)
+    season_ranking.load(db.cursor())
+    season_ranking.flush(db.cursor())
+    assert_matches_recompute(db, season_id)
+    assert season_ranking.rank_of(1) == 1
+    assert season_ranking.rank_of(4) == 4
+
+
+def test_refresh_problem_matches_a_recompute(db, season):
+    season_id, problems = season
+    season_ranking = ranking.SeasonRanking(season_id, BASE_POINTS, weighted_score)
+    season_ranking.load(db.cursor())
+    season_ranking.flush(db.cursor())
+
+    db.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, 1)',
+               (4, problems[2], 1))
+    season_ranking.refresh_problem(db.cursor(), problems[2])
+    season_ranking.flush(db.cursor())
+    assert_matches_recompute(db, season_id)
+    # The only solver of a problem gets all its points, which puts them behind only user 1
+    assert season_ranking.rank_of(4) == 2
+
+
+def test_flush_only_writes_what_changed(db, season):
+    season_id, problems = season
+    season_ranking = ranking.SeasonRanking(season_id, BASE_POINTS, weighted_score)
+    season_ranking.load(db.cursor())
+    season_ranking.flush(db.cursor())
+    assert season_ranking.flush(db.cursor()) == (0, 0)
+
+    # Nothing about the problem changed, so nothing is written
+    season_ranking.refresh_problem(db.cursor(), problems[0])
+    assert season_ranking.flush(db.cursor()) == (0, 0)
+
+
+def test_engine_reloads_after_invalidate(db, season):
+    season_id, problems = season
+    engine = ranking.RankingEngine(BASE_POINTS, weighted_score)
+    engine.season(db.cursor(), season_id).flush(db.cursor())
+
+    # A change the engine doesn't hear about, like %update or %execute_sql
+    db.execute('DELETE FROM solves WHERE user = ?', (3,))
+    engine.invalidate()
+    engine.season(db.cursor(), season_id).flush(db.cursor())
+    assert_matches_recompute(db, season_id)
@@ -0,0 +1,18 @@
+from datetime import datetime
+
+import pytest
+
+import scheduler
+
+
+@pytest.mark.parametrize('at, expected', [('09:30', (9, 30)), ('09:30:15', (9, 30)), ('0:05', (0, 5))])
+def test_parse_time(at, expected):
+    assert scheduler.parse_time(at) == expected
+
+
+def test_next_after():
+    job = scheduler.Job('post', '12:00', None, catch_up=True)
+    assert job.next_after(datetime(2020, 1, 1, 11, 59)) == datetime(2020, 1, 1, 12, 0)
+    # Strictly after, so a run that just happened isn't due again
+    assert job.next_after(datetime(2020, 1, 1, 12, 0)) == datetime(2020, 1, 2, 12, 0)
+    assert job.next_after(datetime(2020, 12, 31, 13, 0)) == datetime(2021, 1, 1, 12, 0)
@@ -0,0 +1,64 @@
+import pytest
+
+import throttle
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle.time, 'monotonic', clock)
+    return clock
+
+
+def test_burst_then_refill(clock):
+    bucket = throttle.Throttle(burst=3, refill=10)
+    assert all(bucket.allow(1, 5) for _ in range(3))
+    assert not bucket.allow(1, 5)
+    assert bucket.retry_after(1, 5) == pytest.approx(10)
+
+    clock.now += 10
+    assert bucket.allow(1, 5)
+    assert not bucket.allow(1, 5)
+    assert bucket.metrics()['rejected'] == 2
+
+
+def test_buckets_are_per_user_and_problem(clock):
+    bucket = throttle.Throttle(burst=1, refill=10)
+    assert bucket.allow(1, 5)
+    assert not bucket.allow(1, 5)
+    assert bucket.allow(1, 6)
+    assert bucket.allow(2, 5)
+
+
+def test_warn_once_per_run_of_rejections(clock):
+    bucket = throttle.Throttle(burst=1, refill=10)
+    bucket.allow(1, 5)
+    bucket.allow(1, 5)
+    assert bucket.warn(1, 5)
+    assert not bucket.warn(1, 5)
+
+    clock.now += 10
+    assert bucket.allow(1, 5)
+    bucket.allow(1, 5)
+    assert bucket.warn(1, 5)
+
+
+def test_full_buckets_are_swept(clock):
+    bucket = throttle.Throttle(burst=2, refill=10)
+    bucket.allow(1, 5)
+    clock.now += 21
+    bucket.allow(2, 5)
+    assert list(bucket.buckets) == [(2, 5)]
+
+
+def test_disabled():
+    bucket = throttle.Throttle(burst=0)
+    assert all(bucket.allow(1, 5) for _ in range(100))
@@ -0,0 +1,105 @@
+"""The counters that migrations keep up to date with triggers, and the triggers freezing snapshots. """
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import archive
+import snapshot
+
+
+@pytest.fixture
+def problem(db):
+    season_id = db.execute('INSERT INTO seasons (running, name) VALUES (?, ?)', (False, 'Season')).lastrowid
+    return db.execute('INSERT INTO problems (date, season, statement, answer, public) VALUES (?, ?, ?, ?, ?)',
+                      ('2020-01-01', season_id, 'Statement', 42, True)).lastrowid
+
+
+def attempt(db, user_id: int, potd_id: int, submission: int, official: bool = True) -> int:
+    submit_time = datetime(2020, 1, 1, user_id)
+    return db.execute('INSERT INTO attempts (user_id, potd_id, official, submission, submit_time) '
+                      'VALUES (?, ?, ?, ?, ?)', (user_id, potd_id, official, submission, submit_time)).lastrowid
+
+
+def stats(db, potd_id: int):
+    return db.execute('SELECT official_solves, unofficial_solves, attempts, attempters from problem_stats '
+                      'where problem_id = ?', (potd_id,)).fetchone()
+
+
+def state(db, potd_id: int, user_id: int):
+    return db.execute('SELECT official_attempts, unofficial_attempts, solved from user_problem_state '
+                      'where problem_id = ? and user_id = ?', (potd_id, user_id)).fetchone()
+
+
+def test_new_problem_gets_stats(db, problem):
+    assert stats(db, problem) == (0, 0, 0, 0)
+
+
+def test_attempts_and_solves_are_counted(db, problem):
+    attempt(db, 1, problem, 7)
+    attempt(db, 1, problem, 42)
+    attempt(db, 2, problem, 42, official=False)
+    db.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+               (1, problem, 2, True))
+    db.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+               (2, problem, 1, False))
+
+    assert stats(db, problem) == (1, 1, 3, 2)
+    assert state(db, problem, 1) == (2, 0, 1)
+    assert state(db, problem, 2) == (0, 1, 1)
+    first_solve = db.execute('SELECT first_solve_time from user_problem_state where problem_id = ? and user_id = ?',
+                             (problem, 1)).fetchone()[0]
+    assert first_solve == str(datetime(2020, 1, 1, 1))
+
+
+def test_deletes_are_counted(db, problem):
+    first = attempt(db, 1, problem, 7)
+    attempt(db, 1, problem, 8)
+    db.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+               (1, problem, 2, True))
+
+    db.execute('DELETE FROM attempts WHERE id = ?', (first,))
+    assert stats(db, problem) == (1, 0, 1, 1)
+    db.execute('DELETE FROM attempts WHERE user_id = ?', (1,))
+    db.execute('DELETE FROM solves WHERE user = ?', (1,))
+    assert stats(db, problem) == (0, 0, 0, 0)
+    assert state(db, problem, 1) == (0, 0, 0)
+
+
+def test_archiving_keeps_the_counters(db, problem, tmp_path):
+    path = str(tmp_path / 'archive.db')
+    db.commit()
+    archive.create(db, path)
+    archive.attach(db, path, read_only=False)
+    attempt(db, 1, problem, 7)
+    attempt(db, 2, problem, 42)
+    season_id = db.execute('SELECT season from problems where id = ?', (problem,)).fetchone()[0]
+
+    assert archive.roll_up(db, season_id) == 2
+    db.commit()
+    assert archive.remove_archived(db, season_id) == 2
+    db.commit()
+    assert db.execute('SELECT count(1) from main.attempts').fetchone()[0] == 0
+    assert db.execute('SELECT count(1) from archive.attempts').fetchone()[0] == 2
+    assert stats(db, problem) == (0, 0, 2, 2)
+    assert state(db, problem, 1) == (1, 0, 0)
+
+    # Attempts made after archiving still count
+    attempt(db, 1, problem, 8)
+    assert stats(db, problem) == (0, 0, 3, 2)
+    assert state(db, problem, 1) == (2, 0, 0)
+
+
+def test_snapshots_are_frozen(db, problem):
+    season_id = db.execute('SELECT season from problems where id = ?', (problem,)).fetchone()[0]
+    db.execute('INSERT INTO rankings (season_id, user_id, rank, score) VALUES (?, ?, ?, ?)', (season_id, 1, 1, 0.0))
+    assert snapshot.take(db, season_id) == (1, 1)
+    assert snapshot.finalized(db, season_id)
+
+    for statement in ['UPDATE final_standings SET score = 1', 'DELETE FROM final_pages',
+                      'UPDATE season_snapshots SET ranked = 2', 'DELETE FROM final_problems']:
+        with pytest.raises(sqlite3.IntegrityError):
+            db.execute(statement)
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute('INSERT INTO final_standings (season_id, user_id, rank, score, solved, attempts) '
+                   'VALUES (?, ?, ?, ?, ?, ?)', (season_id, 2, 2, 0.0, 0, 0))
@@ -0,0 +1,80 @@
+"""Token bucket throttling of answer submissions, per user and problem.
+
+Each (user, problem) gets a bucket of burst tokens that refills by one every refill seconds, and every
+submission takes a token. A submission that finds the bucket empty is rejected before it gets anywhere
+near the db, so someone brute forcing an answer can't slow down everyone else's submissions. Buckets
+that have filled back up are the same as new ones, so they're dropped every so often. """
+import time
+
+
+class Bucket:
+    __slots__ = ('tokens', 'updated', 'warned')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.warned = False  # Whether they've been told they're throttled since their last accepted submission
+
+
+class Throttle:
+    def __init__(self, burst: int = 10, refill: float = 30):
+        self.burst = burst
+        self.refill = refill
+        self.buckets = {}  # (user id, problem id) -> Bucket
+        self.last_sweep = time.monotonic()
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.burst > 0
+
+    def _refill(self, bucket: Bucket, now: float):
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) / self.refill)
+        bucket.updated = now
+
+    def _sweep(self, now: float):
+        """Forget every bucket that would be full by now. """
+        full_after = self.burst * self.refill
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket.updated < full_after}
+        self.last_sweep = now
+
+    def allow(self, user_id: int, potd_id) -> bool:
+        """Take a token for a submission by user_id to potd_id, or return False if there are none left. """
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        if now - self.last_sweep > self.burst * self.refill:
+            self._sweep(now)
+
+        key = (user_id, potd_id)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket(self.burst, now)
+        else:
+            self._refill(bucket, now)
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return True
+        self.rejected += 1
+        return False
+
+    def warn(self, user_id: int, potd_id) -> bool:
+        """Whether a rejected user should be told about it, which is only the first time in a row. """
+        bucket = self.buckets.get((user_id, potd_id))
+        if bucket is None or bucket.warned:
+            return False
+        bucket.warned = True
+        return True
+
+    def retry_after(self, user_id: int, potd_id) -> float:
+        """Seconds until user_id can submit to potd_id again. """
+        bucket = self.buckets.get((user_id, potd_id))
+        if bucket is None:
+            return 0.0
+        self._refill(bucket, time.monotonic())
+        return max(0.0, (1 - bucket.tokens) * self.refill)
+
+    def metrics(self) -> dict:
+        return {'buckets': len(self.buckets), 'rejected': self.rejected}
@@ -0,0 +1,215 @@
+"""Single writer service, for running the bot as several shard processes.
+
+SQLite takes one writer at a time, and the bot keeps in-memory state (the current problems and the
+rankings) in step with its writes, so with several processes every write goes through one writer
+process. It loads the same cogs as a shard, without connecting to Discord, and runs the write
+procedures they register with the db when a shard asks for one by name over a Unix socket. Shards
+still read the db directly.
+
+Requests and responses are lines of JSON. After every write the service tells the other shards
+which procedure ran, so they can drop any caches it may have made stale.
+
+    python writer.py
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+from datetime import date, datetime
+
+# Largest line either side will read, which bounds the size of a procedure's arguments or result
+LINE_LIMIT = 64 * 1024 * 1024
+
+
+class WriterError(Exception):
+    """A procedure failed in the writer service. """
+
+
+def encode(value):
+    """Make a procedure's arguments or result JSON serialisable. Exceptions are kept apart so that
+    per-item failures in a result (see ingest.isolated) survive the trip. """
+    if isinstance(value, Exception):
+        return {'__error__': f'{type(value).__name__}: {value}'}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    if isinstance(value, (date, datetime)):
+        # The same text sqlite3 stores them as
+        return str(value)
+    return value
+
+
+def decode(value):
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, dict):
+        if '__error__' in value:
+            return WriterError(value['__error__'])
+        return {key: decode(item) for key, item in value.items()}
+    return value
+
+
+def send(stream: asyncio.StreamWriter, message: dict):
+    stream.write(json.dumps(message).encode() + b'\n')
+
+
+class WriterService:
+    def __init__(self, db, path: str):
+        """db is a local database.Database with the procedures registered. """
+        self.db = db
+        self.path = path
+        self.clients = set()
+        self.server = None
+        self.requests = 0
+        self.failures = 0
+        self.logger = logging.getLogger('writer')
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a previous run
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, self.path, limit=LINE_LIMIT)
+        os.chmod(self.path, 0o600)
+        self.logger.info(f'Serving {len(self.db.procedures)} write procedures on {self.path}')
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def metrics(self) -> dict:
+        return {'clients': len(self.clients), 'requests': self.requests, 'failures': self.failures}
+
+    async def _serve(self, reader: asyncio.StreamReader, stream: asyncio.StreamWriter):
+        self.clients.add(stream)
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # Writes run one at a time in the order they were started, so this keeps each shard's order
+                task = asyncio.get_running_loop().create_task(self._handle(json.loads(line), stream))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self.clients.discard(stream)
+            stream.close()
+
+    async def _handle(self, request: dict, stream: asyncio.StreamWriter):
+        self.requests += 1
+        name = request['procedure']
+        try:
+            if name not in self.db.procedures:
+                raise KeyError(f'No write procedure called {name}')
+            result = await self.db.write(self.db.procedures[name], *decode(request['args']))
+        except Exception as e:
+            self.failures += 1
+            self.logger.exception(f'Write procedure {name} failed. ')
+            send(stream, {'id': request['id'], 'error': f'{type(e).__name__}: {e}'})
+            return
+
+        send(stream, {'id': request['id'], 'result': encode(result)})
+        for client in list(self.clients):
+            if client is not stream:
+                send(client, {'event': 'write', 'procedure': name})
+        await stream.drain()
+
+
+class WriterClient:
+    """Connection from a shard to the writer service. Connects on first use and again after losing it. """
+
+    def __init__(self, path: str, connect_timeout: float = 30):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.stream = None
+        self.pending = {}  # request id -> future
+        self.ids = itertools.count()
+        self.listeners = []  # Called with the name of every procedure another shard ran
+        self.lock = None
+        self.logger = logging.getLogger('writer')
+
+    async def _connect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.stream is not None:
+                return
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.connect_timeout
+            while True:
+                try:
+                    reader, self.stream = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if loop.time() > deadline:
+                        raise
+                    await asyncio.sleep(0.1)
+            loop.create_task(self._read(reader))
+
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if 'event' in message:
+                    for listener in self.listeners:
+                        try:
+                            listener(message['procedure'])
+                        except Exception:
+                            self.logger.exception('Write listener failed. ')
+                    continue
+
+                future = self.pending.pop(message['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(WriterError(message['error']))
+                else:
+                    future.set_result(decode(message['result']))
+        finally:
+            self.logger.warning('Lost the connection to the writer service. ')
+            self.stream = None
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Lost the connection to the writer service. '))
+
+    async def call(self, procedure: str, args) -> object:
+        if self.stream is None:
+            await self._connect()
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        send(self.stream, {'id': request_id, 'procedure': procedure, 'args': encode(args)})
+        await self.stream.drain()
+        return await future
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+
+def main():
+    import openpotd
+
+    bot = openpotd.OpenPOTD(openpotd.config['prefix'], headless=True)
+    for cog in bot.config['cogs']:
+        bot.load_extension(cog)
+    service = WriterService(bot.db, bot.config.get('writer_socket', 'data/writer.sock'))
+    bot.metrics.add_source('writer', service.metrics)
+    try:
+        bot.loop.run_until_complete(service.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bot.db.close()
+
+
+if __name__ == '__main__':
+    main()